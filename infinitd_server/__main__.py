@@ -8,6 +8,8 @@ import ssl
 import signal
 
 import cattr
+import tornado.httpserver
+import tornado.netutil
 import tornado.web
 import firebase_admin
 from firebase_admin import credentials
@@ -16,6 +18,8 @@ from infinitd_server.game import Game
 from infinitd_server.game_config import GameConfig, GameConfigData
 from infinitd_server.battleground_state import BattlegroundState, BgTowersState, BgTowerState
 from infinitd_server.logger import Logger
+from infinitd_server.pubsub import UnixSocketPubSub
+from infinitd_server.remote_battle_worker import parseAddress
 
 from infinitd_server.handler.user import UserHandler
 from infinitd_server.handler.users import UsersHandler
@@ -30,6 +34,8 @@ from infinitd_server.handler.recorded_battle import RecordedBattleHandler
 from infinitd_server.handler.delete_account import DeleteAccountHandler
 from infinitd_server.handler.debug_logs import DebugLogsHandler
 from infinitd_server.handler.debug_battle_input import DebugBattleInputHandler
+from infinitd_server.handler.debug_battle_queues import DebugBattleQueuesHandler
+from infinitd_server.handler.debug_streams import DebugStreamsHandler
 from infinitd_server.handler.admin.reset_game import ResetGameHandler
 from infinitd_server.handler.stream import StreamHandler
 
@@ -60,6 +66,8 @@ def make_app(game, debug):
     debug_handlers = [
         (r"/debug/logs", DebugLogsHandler, dict(game=game)),
         (r"/debug/battleInput/(.*)/(.*)", DebugBattleInputHandler, dict(game=game)),
+        (r"/debug/battleQueues", DebugBattleQueuesHandler, dict(game=game)),
+        (r"/debug/streams", DebugStreamsHandler, dict(game=game)),
     ]
     return tornado.web.Application(prod_handlers + debug_handlers, **settings)
 
@@ -76,6 +84,14 @@ def main():
     parser.add_argument('-v', '--verbosity', action="store", type=int, default=0)
     parser.add_argument('-p', '--port', action="store", type=int, default=8794)
     parser.add_argument('--reset-battles', action="store_true")
+    parser.add_argument('--battle-worker', action="append", type=str, default=[],
+        help="host:port or unix:path of a battle worker daemon. May be repeated.")
+    parser.add_argument('--pubsub', action="store", type=str, default="",
+        help="Unix socket of a pub/sub broker to share stream updates with other server processes.")
+    parser.add_argument('--reuse-port', action="store_true",
+        help="Let other server processes listen on the same port.")
+    parser.add_argument('--skip-background-tasks', action="store_true",
+        help="Leave accumulating gold and calculating battles to another process sharing the database.")
     parser.add_argument('--ssl_cert', action="store", type=str, default="localhost.crt")
     parser.add_argument('--ssl_key', action="store", type=str, default="localhost.key")
     args = parser.parse_args()
@@ -88,9 +104,16 @@ def main():
     logger = Logger("data/logs.db", printVerbosity=args.verbosity, debug=args.debug)
     Logger.setDefault(logger)
     logger.info("startup", -1, f"Starting with options {args}.")
-    game = Game(gameConfig, debug=args.debug)
-    # Make sure no one is stuck in a battle.
-    game.clearInBattle()
+    pubsub = None
+    if args.pubsub:
+        pubsub = UnixSocketPubSub(args.pubsub)
+        pubsub.start()
+    game = Game(gameConfig, debug=args.debug, pubsub=pubsub)
+    if not args.skip_background_tasks:
+        # Make sure no one is stuck in a battle.
+        game.clearInBattle()
+        # Pick up any battles which were being calculated when the server stopped.
+        game.resumeBattleJobs()
     if args.reset_battles:
         game.resetBattles()
     app = make_app(game, args.debug)
@@ -106,11 +129,22 @@ def main():
             "certfile": args.ssl_cert,
             "keyfile": args.ssl_key,
         }
-        app.listen(args.port, ssl_options=sslContext)
+        server = tornado.httpserver.HTTPServer(app, ssl_options=sslContext)
+        server.add_sockets(tornado.netutil.bind_sockets(args.port, reuse_port=args.reuse_port))
         logger.info("startup", -1, f"Listening on port {args.port} (with SSL enabled) as PID {os.getpid()}.")
     else:
-        app.listen(args.port)
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(tornado.netutil.bind_sockets(args.port, reuse_port=args.reuse_port))
         logger.info("startup", -1, f"Listening on port {args.port} (without SSL enabled) as PID {os.getpid()}.")
+    loop = asyncio.get_event_loop()
+    for address in args.battle_worker:
+        game.addBattleWorker(parseAddress(address))
+    # Every process keeps its own battles for streaming.
+    tornado.ioloop.PeriodicCallback(game.evictIdleBattles, 60_000).start()
+    if args.skip_background_tasks:
+        logger.info("startup", -1, "Startup finished without background tasks.")
+        loop.run_forever()
+        return
     async def accumulateGold():
         await game.accumulateGold()
     tornado.ioloop.PeriodicCallback(accumulateGold, 60_000).start()
@@ -122,7 +156,12 @@ def main():
             await game.calculateMissingBattles()
         except Exception as e:
             logger.error("calculate_missing_battles", -1, f"Exception: {e}")
-    loop = asyncio.get_event_loop()
+    async def processBattleJobs():
+        try:
+            await game.processBattleJobs()
+        except Exception as e:
+            logger.error("battle_jobs", -1, f"Exception: {e}")
+    tornado.ioloop.PeriodicCallback(processBattleJobs, 5_000).start()
     # Schedule this out-of-phase with accumulateGold
     scheduleCallbackTask = loop.create_task(
         schedulePeriodicCallbackIn(30, calculateMissingBattles, 60_000))
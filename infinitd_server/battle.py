@@ -341,7 +341,15 @@ class Battle:
     events: List[BattleEvent]
     results: BattleResults
 
-    def encodeEventsFb(self) -> bytearray:
+    def encodeEventsFb(self) -> bytes:
+        # Imported here since the extension itself imports this module.
+        from infinitd_server.cpp_battle_computer.battle_computer import encodeBattleEvents
+        return encodeBattleEvents(self.events)
+
+    def encodeEventsFbWithBuilder(self) -> bytearray:
+        """Encodes events using the pure-Python FlatBuffers builder.
+
+        This is much slower than encodeEventsFb and is kept as a reference."""
         builder = flatbuffers.Builder(1024)
         fbEventOffsets = [event.toFb(builder) for event in reversed(self.events)]
 
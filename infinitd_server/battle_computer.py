@@ -22,6 +22,20 @@ class BattleCalculationException(Exception):
         self.battleground_json = battleground.to_json()
         self.message = message
 
+# A flattened battleground and wave.
+BattleKey = Tuple[Tuple[int, ...], Tuple[ConfigId, ...]]
+
+def battleKey(battleground: BattlegroundState, wave: List[ConfigId]) -> BattleKey:
+    "Everything the outcome of a battle depends on, as a hashable value."
+    flattenedBattleground = []
+    for row in battleground.towers.towers:
+        for maybeTower in row:
+            if maybeTower is None:
+                flattenedBattleground.append(-1)
+            else:
+                flattenedBattleground.append(maybeTower.id)
+    return (tuple(flattenedBattleground), tuple(wave))
+
 @dataclass(frozen=False)
 class TowerState:
     id: int
@@ -74,7 +88,12 @@ class BattleComputer:
                 nextId += 1
         return towerStates
 
-    def computeBattle(self, battleground: BattlegroundState, wave: List[ConfigId]) -> BattleCalcResults:
+    def computeBattle(self, battleground: BattlegroundState, wave: List[ConfigId],
+            cancelFlagAddress: int = 0) -> BattleCalcResults:
+        """Calculates the outcome of wave attacking battleground.
+
+        If cancelFlagAddress is given the calculation is abandoned with a
+        BattleCalculationException once the byte at that address becomes non-zero."""
         if not wave:
             raise ValueError("Cannot compute battle with empty wave.")
 
@@ -86,22 +105,14 @@ class BattleComputer:
             raise ValueError("Cannot compute battle with no path.")
 
         # Make any changes to the wave or towers change the paths enemies take.
-        flattenedBattleground = []
-        for row in battleground.towers.towers:
-            for maybeTower in row:
-                if maybeTower is None:
-                    flattenedBattleground.append(-1)
-                else:
-                    flattenedBattleground.append(maybeTower.id)
-        battlegroundWaveTuple = (tuple(flattenedBattleground), tuple(wave))
-        rand = Random(hash(battlegroundWaveTuple))
+        rand = Random(hash(battleKey(battleground, wave)))
         # Calculate paths for all enemies ahead of time.
         paths = []
         for _ in wave:
             paths.append(compressPath(pathMap.getRandomPath(
                 self.gameConfig.playfield.monsterEnter, rand)))
 
-        result = self.cppBattleComputer.computeBattle(battleground, wave, paths)
+        result = self.cppBattleComputer.computeBattle(battleground, wave, paths, cancelFlagAddress)
         battleCalcFb = BattleCalcResultsFb.BattleCalcResultsFb.GetRootAsBattleCalcResultsFb(result, 0)
         if cppErr := battleCalcFb.Error():
             raise BattleCalculationException(battleground, wave, cppErr)
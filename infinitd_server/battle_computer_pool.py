@@ -1,28 +1,422 @@
 import asyncio
+import collections
 import concurrent.futures
-from typing import List
+import ctypes
+from enum import Enum, unique
+import multiprocessing
+import os
+import time
+from typing import Any, Awaitable, Deque, Dict, List, Optional, Set, Union
+import weakref
 
+import attr
+import numpy as np
+
+from infinitd_server.battle import BattleResults
 from infinitd_server.battleground_state import BattlegroundState
-from infinitd_server.battle_computer import BattleComputer, BattleCalcResults
+from infinitd_server.battle_computer import BattleComputer, BattleCalcResults, BattleKey, battleKey
 from infinitd_server.game_config import GameConfig, ConfigId
+from infinitd_server.remote_battle_worker import Address, BattleWorkerUnavailable, RemoteBattleWorker
+import InfiniTDFb.BattleCalcResultsFb as BattleCalcResultsFb
+
+@attr.s(auto_attribs=True, frozen=True)
+class _SharedResults:
+    "Results whose FlatBuffer was written to the result arena instead of being pickled."
+    results: BattleResults
+    length: int
 
-def initWorker(gameConfig: GameConfig, gameTickSecs: float, debug: bool):
-    global battleComputer
+def initWorker(gameConfig: GameConfig, gameTickSecs: float, debug: bool, cancelFlags, resultMemory):
+    global battleComputer, workerCancelFlags, workerResultMemory
     battleComputer = BattleComputer(gameConfig, gameTickSecs, debug)
+    workerCancelFlags = cancelFlags
+    workerResultMemory = resultMemory
+
+def computeBattle(battleground: BattlegroundState, wave: List[ConfigId], slot: int,
+        block: Optional[int], blockSize: int) -> Union[BattleCalcResults, _SharedResults]:
+    global battleComputer, workerCancelFlags, workerResultMemory
+    cancelFlagAddress = ctypes.addressof(workerCancelFlags) + slot * ctypes.sizeof(ctypes.c_byte)
+    battleCalcResults = battleComputer.computeBattle(battleground, wave, cancelFlagAddress)
+    fbBytes = battleCalcResults.fb._tab.Bytes
+    if block is None or len(fbBytes) > blockSize:
+        return battleCalcResults # Fall back to sending everything through the pipe.
+    ctypes.memmove(ctypes.addressof(workerResultMemory) + block, fbBytes, len(fbBytes))
+    return _SharedResults(battleCalcResults.results, len(fbBytes))
+
+class ResultArena:
+    """Fixed size blocks of memory shared with the workers for returning results.
+
+    A block is reserved for each running battle and only reused once nothing
+    refers to the results read out of it anymore."""
+    memory: Any
+    blockSize: int
+    # Offsets of unused blocks. Blocks are freed by whichever thread drops the
+    # last reference to their results, which deque's append and pop allow.
+    freeBlocks: Deque[int]
+
+    def __init__(self, numBlocks: int, blockSize: int):
+        self.memory = multiprocessing.RawArray(ctypes.c_ubyte, numBlocks * blockSize)
+        self.blockSize = blockSize
+        self.freeBlocks = collections.deque(range(0, numBlocks * blockSize, blockSize))
+
+    def reserve(self) -> Optional[int]:
+        try:
+            return self.freeBlocks.pop()
+        except IndexError:
+            return None
+
+    def release(self, block: int):
+        self.freeBlocks.append(block)
+
+    def read(self, block: int, length: int) -> BattleCalcResultsFb.BattleCalcResultsFb:
+        "Wrap the FlatBuffer in block without copying it. The block is released once it's unused."
+        view = np.frombuffer(self.memory, dtype=np.uint8, count=length, offset=block)
+        # Anything read from the FlatBuffer which still refers to the block keeps view alive.
+        weakref.finalize(view, self.release, block)
+        return BattleCalcResultsFb.BattleCalcResultsFb.GetRootAsBattleCalcResultsFb(view, 0)
 
-def computeBattle(battleground: BattlegroundState, wave: List[ConfigId]) -> BattleCalcResults:
-    global battleComputer
-    return battleComputer.computeBattle(battleground, wave)
+class StaleBattleException(Exception):
+    "The attacker's wave or defender's battleground changed before the battle was calculated."
+    pass
+
+@unique
+class BattlePriority(Enum):
+    "Highest priority first."
+    INTERACTIVE = 0 # A player is starting a live battle.
+    VIEW = 1 # A player is opening a recorded battle.
+    BACKGROUND = 2 # Precalculating battles between rivals.
+
+@attr.s(auto_attribs=True, frozen=True)
+class BattleTag:
+    "Who a battle is being calculated for, and which version of their inputs it uses."
+    attackerUid: str
+    waveVersion: int
+    defenderUid: str
+    battlegroundVersion: int
+
+@attr.s(auto_attribs=True)
+class PriorityStats:
+    queued: int = 0
+    running: int = 0
+    numStarted: int = 0
+    numCancelled: int = 0
+    # How long battles waited for a worker.
+    totalWaitSecs: float = 0.0
+    maxWaitSecs: float = 0.0
+
+@attr.s(auto_attribs=True, eq=False)
+class _Request:
+    tag: Optional[BattleTag]
+    future: asyncio.Future
+
+@attr.s(auto_attribs=True, eq=False)
+class _Job:
+    key: BattleKey
+    battleground: BattlegroundState
+    wave: List[ConfigId]
+    priority: BattlePriority
+    queuedAt: float
+    requests: List[_Request] = attr.Factory(list)
+    # Which cancel flag the job's worker watches while it's running.
+    slot: Optional[int] = None
+    # Where the worker writes the job's results, if a block was free.
+    block: Optional[int] = None
+    # The remote worker calculating the job instead of a local one.
+    remoteWorker: Optional[RemoteBattleWorker] = None
+    remoteFuture: Optional[asyncio.Future] = None
+    numAttempts: int = 0
+
+    @property
+    def queued(self) -> bool:
+        "Whether the job is still waiting for a local or remote worker."
+        return self.slot is None and self.remoteFuture is None
 
 class BattleComputerPool:
+    """Calculates battles in worker processes.
+
+    Battles wait in a queue per priority and are only handed to a worker once
+    one is free, so a higher priority battle never waits behind a backlog of
+    lower priority ones. Background battles can't use every worker.
+
+    Workers write results into a ResultArena when there's room, so only a
+    small summary has to be pickled and sent back through the pipe.
+
+    Once every local worker is busy, battles go to the least loaded healthy
+    remote worker, if any were added. Battles whose remote worker is lost
+    are queued again, up to maxRemoteAttempts times.
+
+    Battles which no one is waiting for anymore are dropped from the queue or,
+    if they've already started, told to stop through a flag shared with the worker."""
+    gameConfig: GameConfig
     executor: concurrent.futures.ProcessPoolExecutor
+    numWorkers: int
+    # Defaults to all but one worker, including remote ones.
+    maxBackground: Optional[int]
+    # How many local workers are busy.
+    numRunning: int
+    remoteWorkers: List[RemoteBattleWorker]
+    maxRemoteAttempts: int = 3
+    queues: Dict[BattlePriority, Deque[_Job]]
+    stats: Dict[BattlePriority, PriorityStats]
+    # Battles currently queued or being computed. Requests for the same battle share one job.
+    inFlight: Dict[BattleKey, _Job]
+    # In flight jobs requested on behalf of each attacker or defender.
+    jobsByUid: Dict[str, Set[_Job]]
+    # One flag per worker. Only the parent process writes them.
+    cancelFlags: Any
+    freeSlots: List[int]
+    resultArena: ResultArena
+    numDeduplicated: int
+    numSharedResults: int
+    numPipedResults: int
+    numRemoteResults: int
+    numRetried: int
 
-    def __init__(self, gameConfig: GameConfig, gameTickSecs: float = 0.01, debug = False):
+    def __init__(self, gameConfig: GameConfig, gameTickSecs: float = 0.01, debug = False,
+            numWorkers: Optional[int] = None, maxBackground: Optional[int] = None,
+            resultBlockSize: int = 1 << 20):
+        self.gameConfig = gameConfig
+        self.numWorkers = numWorkers or os.cpu_count() or 1
+        self.maxBackground = maxBackground
+        self.remoteWorkers = []
+        self.cancelFlags = multiprocessing.RawArray(ctypes.c_byte, self.numWorkers)
+        self.freeSlots = list(range(self.numWorkers))
+        # Leave enough blocks for results which are still being saved while workers start new battles.
+        self.resultArena = ResultArena(2 * self.numWorkers, resultBlockSize)
         self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.numWorkers,
             initializer=initWorker,
-            initargs=(gameConfig, gameTickSecs, debug),
+            initargs=(gameConfig, gameTickSecs, debug, self.cancelFlags, self.resultArena.memory),
             )
+        self.numRunning = 0
+        self.queues = {priority: collections.deque() for priority in BattlePriority}
+        self.stats = {priority: PriorityStats() for priority in BattlePriority}
+        self.inFlight = {}
+        self.jobsByUid = {}
+        self.numDeduplicated = 0
+        self.numSharedResults = 0
+        self.numPipedResults = 0
+        self.numRemoteResults = 0
+        self.numRetried = 0
+
+    def addRemoteWorker(self, address: Address, healthCheckSecs: float = 5.0) -> RemoteBattleWorker:
+        "Start sending battles to a battle worker daemon once it's healthy. Must be called from the event loop."
+        worker = RemoteBattleWorker(address, self.gameConfig, healthCheckSecs, onHealthy = self.__startJobs)
+        self.remoteWorkers.append(worker)
+        worker.start()
+        return worker
+
+    def close(self):
+        for worker in self.remoteWorkers:
+            worker.close()
+        self.executor.shutdown()
+
+    def computeBattle(self, battleground: BattlegroundState, wave: List[ConfigId],
+            priority: BattlePriority = BattlePriority.VIEW,
+            tag: Optional[BattleTag] = None) -> Awaitable[BattleCalcResults]:
+        """Must be called from the event loop.
+
+        If tag is given the battle fails with StaleBattleException once cancelStale
+        learns the tagged wave or battleground has changed."""
+        key = battleKey(battleground, wave)
+        job = self.inFlight.get(key)
+        if job is None:
+            job = _Job(key, battleground, wave, priority, time.monotonic())
+            self.inFlight[key] = job
+            self.queues[priority].append(job)
+            self.stats[priority].queued += 1
+        else:
+            self.numDeduplicated += 1
+            if job.queued and priority.value < job.priority.value:
+                # Move the queued job up to the more urgent request's priority.
+                self.queues[job.priority].remove(job)
+                self.stats[job.priority].queued -= 1
+                job.priority = priority
+                self.queues[priority].append(job)
+                self.stats[priority].queued += 1
+        request = _Request(tag, asyncio.get_event_loop().create_future())
+        job.requests.append(request)
+        if tag is not None:
+            for uid in (tag.attackerUid, tag.defenderUid):
+                self.jobsByUid.setdefault(uid, set()).add(job)
+        # Cancelling one request doesn't affect anyone else waiting on the same battle.
+        request.future.add_done_callback(lambda _: self.__dropIfUnwanted(job))
+        self.__startJobs()
+        return request.future
+
+    def cancelStale(self, waveVersions: Dict[str, int], battlegroundVersions: Dict[str, int]):
+        """Fail requests using an older wave or battleground than the given versions.
+
+        Both map user IDs to their latest version. Must be called from the event loop."""
+        for uid in set(waveVersions).union(battlegroundVersions):
+            for job in list(self.jobsByUid.get(uid, ())):
+                for request in job.requests:
+                    if request.tag is None or request.future.done():
+                        continue
+                    tag = request.tag
+                    if (tag.attackerUid in waveVersions and tag.waveVersion < waveVersions[tag.attackerUid]) or \
+                            (tag.defenderUid in battlegroundVersions and
+                                tag.battlegroundVersion < battlegroundVersions[tag.defenderUid]):
+                        request.future.set_exception(StaleBattleException())
+
+    def getStats(self) -> Dict[str, Any]:
+        return {
+            "numWorkers": self.numWorkers,
+            "maxBackground": self.__maxBackground(),
+            "numRunning": self.numRunning,
+            "numDeduplicated": self.numDeduplicated,
+            "numSharedResults": self.numSharedResults,
+            "numPipedResults": self.numPipedResults,
+            "freeResultBlocks": len(self.resultArena.freeBlocks),
+            "numRemoteResults": self.numRemoteResults,
+            "numRetried": self.numRetried,
+            "remoteWorkers": [{
+                "address": str(worker.address),
+                "healthy": worker.healthy,
+                "capacity": worker.capacity,
+                "numRunning": worker.numRunning,
+            } for worker in self.remoteWorkers],
+            "priorities": {priority.name.lower(): attr.asdict(stats) for (priority, stats) in self.stats.items()},
+        }
+
+    def __untrack(self, job: _Job):
+        if self.inFlight.get(job.key) is job:
+            del self.inFlight[job.key]
+        for request in job.requests:
+            if request.tag is None:
+                continue
+            for uid in (request.tag.attackerUid, request.tag.defenderUid):
+                jobs = self.jobsByUid.get(uid)
+                if jobs is not None:
+                    jobs.discard(job)
+                    if not jobs:
+                        del self.jobsByUid[uid]
+
+    def __dropIfUnwanted(self, job: _Job):
+        "Stop working on job if every request for it has already finished."
+        if self.inFlight.get(job.key) is not job:
+            return # The job already finished or was dropped.
+        if not all(request.future.done() for request in job.requests):
+            return
+        self.__untrack(job)
+        self.stats[job.priority].numCancelled += 1
+        if job.remoteFuture is not None:
+            job.remoteFuture.cancel()
+        elif job.queued:
+            self.queues[job.priority].remove(job)
+            self.stats[job.priority].queued -= 1
+        else:
+            self.cancelFlags[job.slot] = 1
+
+    def __maxBackground(self) -> int:
+        if self.maxBackground is not None:
+            return self.maxBackground
+        # By default leave a worker free for interactive battles.
+        remoteCapacity = sum(worker.capacity for worker in self.remoteWorkers if worker.healthy)
+        return max(self.numWorkers + remoteCapacity - 1, 1)
+
+    def __pickRemoteWorker(self) -> Optional[RemoteBattleWorker]:
+        "Returns the least loaded remote worker with room for another battle."
+        available = [worker for worker in self.remoteWorkers
+            if worker.healthy and worker.numRunning < worker.capacity]
+        return min(available, key=lambda worker: worker.numRunning / worker.capacity, default=None)
+
+    def __nextJob(self) -> Optional[_Job]:
+        for priority in BattlePriority:
+            if not self.queues[priority]:
+                continue
+            if priority == BattlePriority.BACKGROUND and self.stats[priority].running >= self.__maxBackground():
+                continue
+            return self.queues[priority].popleft()
+        return None
+
+    def __startJobs(self):
+        while True:
+            remoteWorker = None
+            if self.numRunning >= self.numWorkers:
+                remoteWorker = self.__pickRemoteWorker()
+                if remoteWorker is None:
+                    return
+            job = self.__nextJob()
+            if job is None:
+                return
+            stats = self.stats[job.priority]
+            waitSecs = time.monotonic() - job.queuedAt
+            stats.queued -= 1
+            stats.running += 1
+            stats.numStarted += 1
+            stats.totalWaitSecs += waitSecs
+            stats.maxWaitSecs = max(stats.maxWaitSecs, waitSecs)
+            if remoteWorker is not None:
+                self.__startRemoteJob(job, remoteWorker)
+                continue
+            self.numRunning += 1
+            job.slot = self.freeSlots.pop()
+            self.cancelFlags[job.slot] = 0
+            job.block = self.resultArena.reserve()
+            workerFuture = asyncio.wrap_future(self.executor.submit(computeBattle,
+                job.battleground, job.wave, job.slot, job.block, self.resultArena.blockSize))
+            workerFuture.add_done_callback(lambda workerFuture, job=job: self.__finishJob(job, workerFuture))
+
+    def __finishJob(self, job: _Job, workerFuture: asyncio.Future):
+        self.numRunning -= 1
+        self.stats[job.priority].running -= 1
+        self.freeSlots.append(job.slot)
+        self.__untrack(job)
+        # Always retrieve the exception, even when no one is waiting for it anymore.
+        exception = None if workerFuture.cancelled() else workerFuture.exception()
+        results = None
+        if exception is None and not workerFuture.cancelled():
+            results = workerFuture.result()
+            if isinstance(results, _SharedResults):
+                self.numSharedResults += 1
+                results = BattleCalcResults(
+                    fb = self.resultArena.read(job.block, results.length), results = results.results)
+                job.block = None # Now released by the results.
+            else:
+                self.numPipedResults += 1
+        if job.block is not None:
+            self.resultArena.release(job.block)
+        self.__resolveRequests(job, workerFuture, results)
+        self.__startJobs()
+
+    def __startRemoteJob(self, job: _Job, remoteWorker: RemoteBattleWorker):
+        job.remoteWorker = remoteWorker
+        job.numAttempts += 1
+        try:
+            job.remoteFuture = remoteWorker.computeBattle(job.battleground, job.wave, job.priority.value)
+        except BattleWorkerUnavailable as e:
+            job.remoteFuture = asyncio.get_event_loop().create_future()
+            job.remoteFuture.set_exception(e)
+        job.remoteFuture.add_done_callback(lambda remoteFuture, job=job: self.__finishRemoteJob(job, remoteFuture))
+
+    def __finishRemoteJob(self, job: _Job, remoteFuture: asyncio.Future):
+        stats = self.stats[job.priority]
+        stats.running -= 1
+        job.remoteWorker = None
+        job.remoteFuture = None
+        exception = None if remoteFuture.cancelled() else remoteFuture.exception()
+        if isinstance(exception, BattleWorkerUnavailable) and job.numAttempts < self.maxRemoteAttempts \
+                and self.inFlight.get(job.key) is job:
+            # Try again on whichever worker is free next.
+            self.numRetried += 1
+            self.queues[job.priority].appendleft(job)
+            stats.queued += 1
+            self.__startJobs()
+            return
+        self.__untrack(job)
+        if exception is None and not remoteFuture.cancelled():
+            self.numRemoteResults += 1
+        self.__resolveRequests(job, remoteFuture,
+            None if exception is not None or remoteFuture.cancelled() else remoteFuture.result())
+        self.__startJobs()
 
-    def computeBattle(self, battleground: BattlegroundState, wave: List[ConfigId]) -> BattleCalcResults:
-        concurrentFuture = self.executor.submit(computeBattle, battleground, wave)
-        return asyncio.wrap_future(concurrentFuture)
\ No newline at end of file
+    def __resolveRequests(self, job: _Job, workerFuture: asyncio.Future, results: Optional[BattleCalcResults]):
+        for request in job.requests:
+            if request.future.done():
+                continue
+            if workerFuture.cancelled():
+                request.future.cancel()
+            elif workerFuture.exception() is not None:
+                request.future.set_exception(workerFuture.exception())
+            else:
+                request.future.set_result(results)
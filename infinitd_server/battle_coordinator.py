@@ -1,13 +1,19 @@
 import asyncio
 from collections import deque
+import json
+import math
 from dataclasses import dataclass
 from enum import Enum, unique, auto
+import sys
 import time
-from typing import List, Dict, Union, Callable, Deque, Awaitable, Optional
+from typing import List, Dict, Set, Tuple, Union, Callable, Deque, Awaitable, Optional
 
+import cattr
 from dataclasses_json import dataclass_json
 
-from infinitd_server.battle import Battle, BattleEvent, BattleResults
+from infinitd_server.battle import (Battle, BattleEvent, BattleResults, EventType, ObjectType, DamageEvent,
+    DeleteEvent)
+from infinitd_server.memory_usage import approxBytes
 from infinitd_server.sse import SseQueues
 from infinitd_server.logger import Logger
 
@@ -30,7 +36,96 @@ class BattleMetadata:
 class LiveBattleMetadata(BattleMetadata):
     time: float = 0.0
 
+class BattleEventFrame:
+    """Several events of a live battle sent together to clients streaming frames.
+
+    Each encoding is made at most once and shared by every client."""
+    events: List[BattleEvent]
+    _json: Optional[str]
+    _fb: Optional[bytes]
+
+    def __init__(self, events: List[BattleEvent]):
+        self.events = events
+        self._json = None
+        self._fb = None
+
+    def toJson(self) -> str:
+        if self._json is None:
+            self._json = json.dumps({"events": cattr.unstructure(self.events)})
+        return self._json
+
+    def toFb(self) -> bytes:
+        "The events as a BattleEventsFb."
+        if self._fb is None:
+            # Imported here since the extension itself imports battle.
+            from infinitd_server.cpp_battle_computer.battle_computer import encodeBattleEvents
+            self._fb = encodeBattleEvents(self.events)
+        return self._fb
+
+class BattleSnapshot:
+    """The state of a live battle as the fewest events which recreate it.
+
+    For every object it keeps the move it's making, its latest health, and
+    any moves, damage or deletion already sent for the near future. Clients
+    joining late get these instead of every past event."""
+    # Each object's events in the order they were sent, by type and ID.
+    objects: Dict[Tuple[ObjectType, int], List[BattleEvent]]
+    # Deletions which haven't happened yet, oldest first.
+    pendingDeletes: Deque[DeleteEvent]
+
+    def __init__(self):
+        self.objects = {}
+        self.pendingDeletes = deque()
+
+    @staticmethod
+    def objectKey(event: BattleEvent) -> Tuple[ObjectType, int]:
+        if isinstance(event, DamageEvent):
+            return (ObjectType.MONSTER, event.id)
+        return (event.objType, event.id)
+
+    @staticmethod
+    def current(events: List[BattleEvent], battleTime: float) -> List[BattleEvent]:
+        "Drop events overtaken by a later one of the same type which has started."
+        started: Set[EventType] = set()
+        kept = []
+        for event in reversed(events):
+            if event.eventType in started:
+                continue
+            if event.startTime <= battleTime:
+                started.add(event.eventType)
+            kept.append(event)
+        kept.reverse()
+        return kept
+
+    def add(self, event: BattleEvent, battleTime: float):
+        "Add an event sent battleTime seconds into the battle."
+        while self.pendingDeletes and self.pendingDeletes[0].startTime <= battleTime:
+            self.objects.pop(self.objectKey(self.pendingDeletes.popleft()), None)
+        key = self.objectKey(event)
+        if isinstance(event, DeleteEvent):
+            if event.startTime <= battleTime:
+                self.objects.pop(key, None)
+                return
+            self.pendingDeletes.append(event)
+        self.objects[key] = self.current(self.objects.get(key, []) + [event], battleTime)
+
+    def events(self, battleTime: float) -> List[BattleEvent]:
+        "Events which recreate the battle at battleTime, in the order they happen."
+        events = []
+        for (key, objectEvents) in list(self.objects.items()):
+            objectEvents = self.current(objectEvents, battleTime)
+            if any(event.eventType == EventType.DELETE and event.startTime <= battleTime
+                    for event in objectEvents):
+                del self.objects[key]
+                continue
+            self.objects[key] = objectEvents
+            events.extend(objectEvents)
+        events.sort(key = lambda event: event.startTime)
+        return events
+
 BattleUpdate = Union[BattleMetadata, BattleEvent, BattleResults]
+# What clients streaming frames get: metadata, results and frames of events.
+BattleFrameUpdate = Union[BattleMetadata, BattleEventFrame, BattleResults]
 
 class StreamingBattle:
     """StreamingBattle handles streaming battle data out in "real time"
@@ -40,72 +135,86 @@ class StreamingBattle:
     name: str = ""
     attackerName: str = ""
     defenderName: str = ""
-    pastEvents: List[BattleEvent] = []
+    # What's been sent so far, for clients joining part way through.
+    snapshot: BattleSnapshot
     futureEvents: Deque[BattleEvent]
     updateFn: Callable[[BattleUpdate], Awaitable[None]]
+    # Sends metadata, results and each window's events together.
+    frameFn: Optional[Callable[[Union[BattleUpdate, List[BattleEvent]]], Awaitable[None]]]
     sentUpdates : int = 0
+    # When the battle last started, stopped or got an update from another process.
+    lastActive: float
+    scheduler: "BattleScheduler"
+    # Resolved once every event is sent or the battle is stopped.
+    _finished: Optional[asyncio.Future] = None
 
-    def __init__(self, updateFn: Callable[[BattleUpdate], Awaitable[None]]):
+    def __init__(self, updateFn: Callable[[BattleUpdate], Awaitable[None]],
+            scheduler: Optional["BattleScheduler"] = None,
+            frameFn: Optional[Callable[[Union[BattleUpdate, List[BattleEvent]]], Awaitable[None]]] = None):
         self.updateFn = updateFn
+        self.frameFn = frameFn
+        self.scheduler = BattleScheduler() if scheduler is None else scheduler
+        self.futureEvents = deque()
+        self.snapshot = BattleSnapshot()
+        self.lastActive = time.time()
         self.logger = Logger.getDefault()
 
     async def sendUpdate(self, update: BattleUpdate):
         await self.updateFn(update)
         self.sentUpdates += 1
 
-    async def start(self, battle: Battle, resultsCallback: Callable[[BattleResults], None], requestId: int = -1):
+    async def sendFrameUpdate(self, update: Union[BattleUpdate, List[BattleEvent]]):
+        if self.frameFn is not None:
+            await self.frameFn(update)
+
+    async def sendMetadata(self, metadata: BattleMetadata):
+        await self.sendUpdate(metadata)
+        await self.sendFrameUpdate(metadata)
+
+    async def start(self, battle: Battle, resultsCallback: Callable[[BattleResults], Awaitable[None]], requestId: int = -1):
         if not battle.events:
             return # Do nothing if events is empty
         self.logger.info("BattleCoordinator", requestId, f"Starting battle {battle.name} with {len(battle.events)} events")
         self.futureEvents = deque(battle.events)
-        self.pastEvents = []
+        self.snapshot = BattleSnapshot()
+        self.lastActive = time.time()
         self.name = battle.name
         self.attackerName = battle.attackerName
         self.defenderName = battle.defenderName
         self.sentUpdates = 0
 
         # Let the client know a new battle is coming.
-        await self.sendUpdate(BattleMetadata(
+        await self.sendMetadata(BattleMetadata(
             status = BattleStatus.PENDING, name = battle.name,
             attackerName = battle.attackerName, defenderName = battle.defenderName))
 
         # Send all events occurring in the buffer window
-        numInitialEvents = 0
-        for event in self.futureEvents:
-            if event.startTime > self.BUFFER_TIME_SECS:
-                break
+        initialEvents = []
+        while self.futureEvents and self.futureEvents[0].startTime <= self.BUFFER_TIME_SECS:
+            event = self.futureEvents.popleft()
             await self.sendUpdate(event)
-            numInitialEvents += 1
-
-        # Move the initial events from futureEvents to the pastEvents
-        while numInitialEvents:
-            self.pastEvents.append(self.futureEvents.popleft())
-            numInitialEvents -= 1
+            self.snapshot.add(event, 0.0)
+            initialEvents.append(event)
+        if initialEvents:
+            await self.sendFrameUpdate(initialEvents)
 
         # Start running
         self.startTime = time.time()
-        await self.sendUpdate(LiveBattleMetadata(
+        await self.sendMetadata(LiveBattleMetadata(
             status = BattleStatus.LIVE, name = battle.name, time = 0.0,
             attackerName = battle.attackerName, defenderName = battle.defenderName))
 
-        while self.futureEvents:
-            elapsedTime = time.time() - self.startTime
-            event: BattleEvent = self.futureEvents[0]
-            timeToEvent = event.startTime - elapsedTime
-            if timeToEvent < 0:
-                # We've fallen behind which should never happen.
-                self.logger.error("BattleCoordinator", requestId, f"Found negative timeToEvent: {timeToEvent}")
-            if timeToEvent > self.BUFFER_TIME_SECS:
-                await asyncio.sleep(timeToEvent - self.BUFFER_TIME_SECS + 0.0001)
-                continue
-
-            # Send the event
-            await self.sendUpdate(event)
-            self.pastEvents.append(self.futureEvents.popleft())
+        if self.futureEvents:
+            # The scheduler sends the remaining events as they come due.
+            self._finished = asyncio.get_running_loop().create_future()
+            self.scheduler.schedule(self, self.nextDeadline())
+            await self._finished
 
         # Prevent new listeners from getting all the events now that the battle
         # is over.
         self.startTime = -1.0
+        self.snapshot = BattleSnapshot()
+        self.lastActive = time.time()
 
         expectedBattleUpdates = len(battle.events) + 2 # Two extra for pending and live metadata events
         if (self.sentUpdates > expectedBattleUpdates):
@@ -113,67 +222,364 @@ class StreamingBattle:
                     f"Battle had {len(battle.events)} events, but sent {self.sentUpdates} updates.")
         elif (self.sentUpdates == expectedBattleUpdates):
             # This means the battle ran all the way out.
-            resultsCallback(battle.results)
+            await resultsCallback(battle.results)
             await self.updateFn(battle.results)
+            await self.sendFrameUpdate(battle.results)
         else:
             # Stop the battle without sending results.
-            await self.sendUpdate(BattleMetadata(
+            await self.sendMetadata(BattleMetadata(
                 status = BattleStatus.PENDING, name = battle.name,
                 attackerName = battle.attackerName, defenderName = battle.defenderName))
 
+    def nextDeadline(self) -> float:
+        "When the next event must be sent."
+        return self.startTime + self.futureEvents[0].startTime - self.BUFFER_TIME_SECS
+
+    async def sendDueEvents(self, now: float) -> bool:
+        """Send every event within the buffer window of now.
+
+        Returns whether any events are left."""
+        elapsedTime = now - self.startTime
+        if self.futureEvents and self.futureEvents[0].startTime < elapsedTime:
+            # We've fallen behind which should never happen.
+            self.logger.error("BattleCoordinator", -1,
+                f"Found negative timeToEvent: {self.futureEvents[0].startTime - elapsedTime}")
+        dueEvents = []
+        while self.futureEvents and self.futureEvents[0].startTime <= elapsedTime + self.BUFFER_TIME_SECS:
+            event = self.futureEvents.popleft()
+            await self.sendUpdate(event)
+            self.snapshot.add(event, elapsedTime)
+            dueEvents.append(event)
+        if dueEvents:
+            await self.sendFrameUpdate(dueEvents)
+        if self.futureEvents:
+            return True
+        self.__finish()
+        return False
+
+    def __finish(self):
+        if self._finished is not None and not self._finished.done():
+            self._finished.set_result(None)
+
     async def stop(self):
         self.startTime = -1.0
         self.futureEvents = deque()
+        self.snapshot = BattleSnapshot()
+        self.lastActive = time.time()
+        self.__finish()
         # Send an update to halt the battle.
-        await self.updateFn(BattleMetadata(
+        metadata = BattleMetadata(
             status = BattleStatus.PENDING, name = self.name,
-            attackerName = self.attackerName, defenderName = self.defenderName)) 
+            attackerName = self.attackerName, defenderName = self.defenderName)
+        await self.updateFn(metadata)
+        await self.sendFrameUpdate(metadata)
 
-    def join(self) -> List[Union[BattleEvent, BattleMetadata]]:
-        """Send the new client all past events and the current time."""
+    def mirror(self, update: BattleUpdate):
+        "Follow a battle streamed by another process so clients here can join it."
+        self.lastActive = time.time()
+        if isinstance(update, LiveBattleMetadata):
+            self.startTime = time.time() - update.time
+        elif isinstance(update, BattleMetadata):
+            # A battle is about to start or was stopped.
+            self.startTime = -1.0
+            self.snapshot = BattleSnapshot()
+            self.name = update.name
+            self.attackerName = update.attackerName
+            self.defenderName = update.defenderName
+        elif isinstance(update, BattleResults):
+            self.startTime = -1.0
+            self.snapshot = BattleSnapshot()
+        else:
+            # Events sent before the battle goes live are within its first moments.
+            battleTime = 0.0 if self.startTime == -1.0 else time.time() - self.startTime
+            self.snapshot.add(update, battleTime)
+
+    def join(self, reset: bool = False) -> List[Union[BattleEvent, BattleMetadata]]:
+        """Send the new client a snapshot of the battle and the current time.
+
+        With reset, a client which missed updates first forgets the battle."""
+        pending = BattleMetadata(
+            status = BattleStatus.PENDING, name = self.name,
+            attackerName = self.attackerName, defenderName = self.defenderName)
         if self.startTime == -1.0:
-            return [BattleMetadata(
-                status = BattleStatus.PENDING, name = self.name,
-                attackerName = self.attackerName, defenderName = self.defenderName)]
+            return [pending]
         else:
             battleTime = time.time() - self.startTime
-            return self.pastEvents + [LiveBattleMetadata(
+            return ([pending] if reset else []) + self.snapshot.events(battleTime) + [LiveBattleMetadata(
                 status = BattleStatus.LIVE, time = battleTime, name = self.name,
                 attackerName = self.attackerName, defenderName = self.defenderName)]
 
+    def joinFrames(self, reset: bool = False) -> List[BattleFrameUpdate]:
+        "Like join, but with the snapshot in one frame."
+        updates = self.join(reset)
+        metadata = [update for update in updates if isinstance(update, BattleMetadata)]
+        events = [update for update in updates if not isinstance(update, BattleMetadata)]
+        if not events:
+            return metadata
+        return metadata[:-1] + [BattleEventFrame(events), metadata[-1]]
+
+class BattleScheduler:
+    """Sends the events of every live battle from a single timer.
+
+    Battles wait in a timing wheel of NUM_SLOTS slots, each TICK_SECS long,
+    under the tick their next event is due. Every tick sends all the due
+    events of the battles in its slot. Battles due more than a full turn of
+    the wheel away stay in their slot until their turn comes around."""
+    TICK_SECS: float = 0.05
+    NUM_SLOTS: int = 256
+    # Deadline, battle and the battle's _finished future when it was scheduled.
+    slots: List[List[Tuple[float, StreamingBattle, asyncio.Future]]]
+    # All ticks up to this one have been handled.
+    lastTick: int = 0
+    numScheduled: int = 0
+    _task: Optional[asyncio.Task] = None
+
+    def __init__(self):
+        self.slots = [[] for _ in range(self.NUM_SLOTS)]
+        self.logger = Logger.getDefault()
+
+    def schedule(self, battle: StreamingBattle, deadline: float):
+        "Send battle's next events once deadline passes. Must be called from the event loop."
+        if self._task is None or self._task.done():
+            self.lastTick = math.floor(time.time() / self.TICK_SECS)
+            self._task = asyncio.ensure_future(self.__run())
+        tick = max(math.ceil(deadline / self.TICK_SECS), self.lastTick + 1)
+        self.slots[tick % self.NUM_SLOTS].append((deadline, battle, battle._finished))
+        self.numScheduled += 1
+
+    async def __run(self):
+        while self.numScheduled > 0:
+            delay = (self.lastTick + 1) * self.TICK_SECS - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = time.time()
+            currentTick = math.floor(now / self.TICK_SECS)
+            # After a long stall visit each slot once.
+            firstTick = max(self.lastTick + 1, currentTick - self.NUM_SLOTS + 1)
+            for tick in range(firstTick, currentTick + 1):
+                self.lastTick = tick
+                await self.__runTick(tick, now)
+
+    async def __runTick(self, tick: int, now: float):
+        slotIndex = tick % self.NUM_SLOTS
+        slot = self.slots[slotIndex]
+        if not slot:
+            return
+        self.slots[slotIndex] = []
+        for entry in slot:
+            (deadline, battle, finished) = entry
+            if math.ceil(deadline / self.TICK_SECS) > tick:
+                # Not due until a later turn of the wheel.
+                self.slots[slotIndex].append(entry)
+                continue
+            self.numScheduled -= 1
+            if finished is not battle._finished or finished.done():
+                continue # The battle was stopped or restarted.
+            try:
+                if await battle.sendDueEvents(now):
+                    self.schedule(battle, battle.nextDeadline())
+            except Exception as e:
+                if not finished.done():
+                    finished.set_exception(e)
+
 class BattleCoordinator:
-    battles: Dict[str, StreamingBattle] = {}
+    """Streams battles, and follows battles streamed by other processes.
+
+    A process only follows a battle streamed elsewhere while it has
+    subscribers for it. The first client to join gets the battle's state
+    from the process streaming it."""
+    # Requests to stop a battle streamed by another process.
+    STOP_CHANNEL: str = "stopBattle"
+    # Requests for the state of a battle streamed by another process, and the replies.
+    SYNC_CHANNEL: str = "syncBattle"
+    STATE_CHANNEL: str = "battleState"
+    # How long joining a battle waits for its state from another process.
+    SYNC_TIMEOUT_SECS: float = 1.0
+    # Battles which aren't streamed here and have no subscribers here are
+    # forgotten after this long without activity.
+    IDLE_SECS: float = 600.0
+    battles: Dict[str, StreamingBattle]
+    # Battles streamed by this process. The rest mirror other processes.
+    localBattles: Set[str]
+    # Battles with subscribers here, so updates from other processes are mirrored.
+    mirroredBattles: Set[str]
+    # Mirrored battles whose state has been fetched, or needed none.
+    syncedBattles: Set[str]
+    # Requests for a battle's state waiting on a reply.
+    _syncs: Dict[str, asyncio.Future]
     battleQueues: SseQueues
+    # For clients which get each window's events in one frame.
+    battleFrameQueues: Optional[SseQueues]
+    scheduler: BattleScheduler
 
-    def __init__(self, battleQueues: SseQueues):
+    def __init__(self, battleQueues: SseQueues, battleFrameQueues: Optional[SseQueues] = None):
+        self.battles = {}
+        self.battleFrameQueues = battleFrameQueues
+        self.scheduler = BattleScheduler()
+        self.localBattles = set()
+        self.mirroredBattles = set()
+        self.syncedBattles = set()
+        self._syncs = {}
         self.battleQueues = battleQueues
         self.logger = Logger.getDefault()
+        battleQueues.listenRemote(self.__mirrorRemoteUpdate)
+        battleQueues.watchSubscribers(self.__onSubscribersChanged)
+        if battleFrameQueues is not None:
+            battleFrameQueues.watchSubscribers(self.__onSubscribersChanged)
+        self.pubsub = battleQueues.pubsub
+        self.pubsub.listen(self.STOP_CHANNEL, self.__stopForOtherProcess)
+        self.pubsub.listen(self.SYNC_CHANNEL, self.__sendStateToOtherProcess)
+        self.pubsub.listen(self.STATE_CHANNEL, self.__syncFromOtherProcess)
+
+    def __onSubscribersChanged(self, name: str):
+        subscribed = name in self.battleQueues.queuesByParam or (
+            self.battleFrameQueues is not None and name in self.battleFrameQueues.queuesByParam)
+        if subscribed and name not in self.mirroredBattles:
+            self.mirroredBattles.add(name)
+            # Frame subscribers need the mirrored battle too.
+            self.pubsub.subscribe(self.battleQueues.channel, name)
+        elif not subscribed and name in self.mirroredBattles:
+            self.mirroredBattles.discard(name)
+            self.syncedBattles.discard(name)
+            self.pubsub.unsubscribe(self.battleQueues.channel, name)
+            battle = self.battles.get(name)
+            if battle is not None and name not in self.localBattles:
+                # It's no longer followed so whatever was mirrored goes stale.
+                battle.mirror(BattleMetadata(status = BattleStatus.PENDING, name = battle.name,
+                    attackerName = battle.attackerName, defenderName = battle.defenderName))
+
+    async def __mirrorRemoteUpdate(self, name: str, update: BattleUpdate):
+        if name in self.mirroredBattles and name not in self.localBattles:
+            self.getBattle(name).mirror(update)
+
+    async def __stopForOtherProcess(self, name: str, _):
+        if name in self.localBattles:
+            await self.battles[name].stop()
+
+    async def __sendStateToOtherProcess(self, name: str, _):
+        if name in self.localBattles:
+            # Reset so the mirror starts over.
+            self.pubsub.publish(self.STATE_CHANNEL, name, self.battles[name].join(reset = True))
+
+    async def __syncFromOtherProcess(self, name: str, updates: List[BattleUpdate]):
+        if name in self.mirroredBattles and name not in self.localBattles:
+            battle = self.getBattle(name)
+            for update in updates:
+                battle.mirror(update)
+            self.syncedBattles.add(name)
+        self.__finishSync(name)
+
+    def __finishSync(self, name: str):
+        sync = self._syncs.pop(name, None)
+        if sync is not None:
+            self.pubsub.unsubscribe(self.STATE_CHANNEL, name)
+            if not sync.done():
+                sync.set_result(None)
+
+    async def __sync(self, name: str):
+        "Fetch the state of a battle from the process streaming it."
+        if name not in self.pubsub.remoteKeys(self.SYNC_CHANNEL):
+            # No other process is streaming it so there's nothing to catch up on.
+            self.syncedBattles.add(name)
+            return
+        sync = self._syncs.get(name)
+        if sync is None:
+            sync = self._syncs[name] = asyncio.get_running_loop().create_future()
+            self.pubsub.subscribe(self.STATE_CHANNEL, name)
+            self.pubsub.publish(self.SYNC_CHANNEL, name, None)
+        try:
+            await asyncio.wait_for(asyncio.shield(sync), self.SYNC_TIMEOUT_SECS)
+        except asyncio.TimeoutError:
+            if self._syncs.get(name) is sync:
+                self.logger.warn("BattleCoordinator", -1, f"Timed out fetching the state of battle {name}.")
+                self.__finishSync(name)
+
+    async def join(self, name: str, reset: bool = False, frames: bool = False
+            ) -> Union[List[Union[BattleEvent, BattleMetadata]], List[BattleFrameUpdate]]:
+        """Join a battle as a new subscriber, with its events in one frame if frames.
+
+        The first time a battle streamed by another process is joined its state is fetched."""
+        if (name in self.mirroredBattles and name not in self.syncedBattles
+                and name not in self.localBattles):
+            await self.__sync(name)
+        battle = self.getBattle(name)
+        return battle.joinFrames(reset) if frames else battle.join(reset)
+
+    def __makeStreamingBattle(self, name: str) -> StreamingBattle:
+        async def sendFrameUpdate(update: Union[BattleUpdate, List[BattleEvent]]):
+            # Only encode frames someone will read.
+            if name not in self.battleFrameQueues:
+                return
+            if isinstance(update, list):
+                update = BattleEventFrame(update)
+            await self.battleFrameQueues.sendUpdate(name, update)
+        return StreamingBattle(lambda x: self.battleQueues.sendUpdate(name, x), self.scheduler,
+            None if self.battleFrameQueues is None else sendFrameUpdate)
 
     def getBattle(self, name: str):
         if name not in self.battles:
-            self.battles[name] = StreamingBattle(lambda x: self.battleQueues.sendUpdate(name, x))
+            self.battles[name] = self.__makeStreamingBattle(name)
         return self.battles[name]
 
-    def startBattle(self, battleId: str, battle: Battle, resultsCallback: Callable[[BattleResults], None],
-            endCallback: Callable[[], None], handler: str = "BattleCoordinator", requestId = -1):
+    def startBattle(self, battleId: str, battle: Battle, resultsCallback: Callable[[BattleResults], Awaitable[None]],
+            endCallback: Callable[[], Awaitable[None]], handler: str = "BattleCoordinator", requestId = -1):
         """startBattle triggers the start of a live-streamed battle.
 
         Arguments:
         battleId: str -- A unique identifier for this battle.
         battle: Battle -- The battle to stream.
-        resultsCallback: Callable[[BattleResults], None] -- A callback to handle the results of a completed battle.
-        endCallback: Callable[[], None] -- A callback called whenever a battle ends whether it's completed or not.
+        resultsCallback: Callable[[BattleResults], Awaitable[None]] -- A callback to handle the results of a completed battle.
+        endCallback: Callable[[], Awaitable[None]] -- A callback called whenever a battle ends whether it's completed or not.
         """
         if battleId not in self.battles:
             self.logger.info(handler, requestId, f"Coordinator is making a new StreamingBattle for {battleId}")
-            self.battles[battleId] = StreamingBattle(lambda x: self.battleQueues.sendUpdate(battleId, x))
+            self.battles[battleId] = self.__makeStreamingBattle(battleId)
         self.logger.info(handler, requestId, f"Coordinator is starting a StreamingBattle for {battleId}")
         async def startBattleThenCallCallback():
-            await self.battles[battleId].start(battle, resultsCallback = resultsCallback, requestId = requestId)
-            endCallback()
+            self.localBattles.add(battleId)
+            # Let other processes know where to send stop and state requests.
+            self.pubsub.subscribe(self.STOP_CHANNEL, battleId)
+            self.pubsub.subscribe(self.SYNC_CHANNEL, battleId)
+            try:
+                await self.battles[battleId].start(battle, resultsCallback = resultsCallback, requestId = requestId)
+            finally:
+                self.localBattles.discard(battleId)
+                self.pubsub.unsubscribe(self.STOP_CHANNEL, battleId)
+                self.pubsub.unsubscribe(self.SYNC_CHANNEL, battleId)
+            await endCallback()
         loop = asyncio.get_running_loop()
         loop.create_task(startBattleThenCallCallback())
 
+    def evictIdleBattles(self, now: Optional[float] = None) -> int:
+        "Forget battles no one here needs. Returns how many were evicted."
+        if now is None:
+            now = time.time()
+        idle = [name for (name, battle) in self.battles.items()
+            if name not in self.localBattles
+            and now - battle.lastActive > self.IDLE_SECS
+            and name not in self.battleQueues.queuesByParam
+            and (self.battleFrameQueues is None or name not in self.battleFrameQueues.queuesByParam)]
+        for name in idle:
+            del self.battles[name]
+        return len(idle)
+
+    def getStats(self) -> Dict[str, int]:
+        "How many battles are kept and roughly how much memory they use."
+        battles = list(self.battles.values())
+        return {
+            "battles": len(battles),
+            "localBattles": len(self.localBattles),
+            "mirroredBattles": len(self.mirroredBattles),
+            "liveBattles": sum(1 for battle in battles if battle.startTime != -1.0),
+            "futureEvents": sum(len(battle.futureEvents) for battle in battles),
+            # Events are shared with the stored battle, but it's released once the battle ends.
+            "approxBytes": approxBytes([[battle.snapshot, battle.futureEvents] for battle in battles])
+                + sum(sys.getsizeof(battle) for battle in battles),
+        }
+
     async def stopBattle(self, battleId: str):
+        if battleId not in self.localBattles:
+            # The battle may be streamed by another process.
+            self.pubsub.publish(self.STOP_CHANNEL, battleId, None)
         if battleId in self.battles:
             await self.battles[battleId].stop()
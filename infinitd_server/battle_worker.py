@@ -0,0 +1,110 @@
+"""A daemon which calculates battles for servers on other hosts.
+
+Run it with python -m infinitd_server.battle_worker and add its address to a
+server with --battle-worker. See remote_battle_worker for the protocol."""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import signal
+from typing import Dict
+
+import cattr
+
+from infinitd_server.battle_computer_pool import BattleComputerPool, BattlePriority
+from infinitd_server.battleground_state import BattlegroundState
+from infinitd_server.game_config import GameConfig, GameConfigData
+from infinitd_server.logger import Logger
+from infinitd_server.remote_battle_worker import (readFrame, writeFrame, gameConfigHash,
+    COMPUTE, CANCEL, PING, RESULT, ERROR, PONG)
+
+class BattleWorkerServer:
+    "Answers requests from any number of servers using a single BattleComputerPool."
+    gameConfig: GameConfig
+    pool: BattleComputerPool
+
+    def __init__(self, gameConfig: GameConfig, numWorkers: int):
+        self.gameConfig = gameConfig
+        self.pool = BattleComputerPool(gameConfig, numWorkers = numWorkers)
+        self.logger = Logger.getDefault()
+
+    async def handleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Battles being calculated for this connection by request ID.
+        running: Dict[int, asyncio.Future] = {}
+        try:
+            while True:
+                (requestId, kind, payload) = await readFrame(reader)
+                if kind == PING:
+                    writeFrame(writer, requestId, PONG, json.dumps({
+                        "capacity": self.pool.numWorkers,
+                        "configHash": gameConfigHash(self.gameConfig),
+                    }).encode())
+                elif kind == CANCEL:
+                    future = running.pop(requestId, None)
+                    if future is not None:
+                        future.cancel()
+                elif kind == COMPUTE:
+                    request = json.loads(payload)
+                    future = self.pool.computeBattle(
+                        BattlegroundState.from_dict(request["battleground"]), request["wave"],
+                        BattlePriority(request["priority"]))
+                    running[requestId] = future
+                    future.add_done_callback(functools.partial(self.__respond, writer, running, requestId))
+                else:
+                    raise ValueError(f"Unknown frame kind {kind}.")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass # The server disconnected.
+        except Exception as e:
+            self.logger.warn("battle_worker", -1, f"Closing connection after error: {e!r}")
+        finally:
+            for future in running.values():
+                future.cancel()
+            writer.close()
+
+    @staticmethod
+    def __respond(writer: asyncio.StreamWriter, running: Dict[int, asyncio.Future], requestId: int,
+            future: asyncio.Future):
+        if running.pop(requestId, None) is None or writer.is_closing():
+            return # The battle was cancelled or the server is gone.
+        exception = future.exception()
+        if exception is not None:
+            message = getattr(exception, "message", None) or repr(exception)
+            writeFrame(writer, requestId, ERROR, message.encode())
+        else:
+            writeFrame(writer, requestId, RESULT, memoryview(future.result().fb._tab.Bytes))
+
+def main():
+    parser = argparse.ArgumentParser(description="Calculates battles for InfiniTD servers.")
+    parser.add_argument('--game-config', action="store", type=str, default="game_config.json")
+    parser.add_argument('--host', action="store", type=str, default="127.0.0.1")
+    parser.add_argument('-p', '--port', action="store", type=int, default=8795)
+    parser.add_argument('--unix-socket', action="store", type=str, default="",
+        help="Listen on this Unix socket instead of TCP.")
+    parser.add_argument('-w', '--workers', action="store", type=int, default=os.cpu_count())
+    parser.add_argument('--log-db', action="store", type=str, default="data/battle_worker_logs.db")
+    parser.add_argument('-v', '--verbosity', action="store", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.game_config) as gameConfigFile:
+        gameConfigData = cattr.structure(json.loads(gameConfigFile.read()), GameConfigData)
+        gameConfig = GameConfig.fromGameConfigData(gameConfigData)
+    logger = Logger(args.log_db, printVerbosity=args.verbosity)
+    Logger.setDefault(logger)
+    server = BattleWorkerServer(gameConfig, args.workers)
+
+    loop = asyncio.get_event_loop()
+    if args.unix_socket:
+        loop.run_until_complete(asyncio.start_unix_server(server.handleConnection, args.unix_socket))
+        address = f"unix:{args.unix_socket}"
+    else:
+        loop.run_until_complete(asyncio.start_server(server.handleConnection, args.host, args.port))
+        address = f"{args.host}:{args.port}"
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    logger.info("startup", -1, f"Calculating battles on {address} with {args.workers} workers.")
+    loop.run_forever()
+    server.pool.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import sqlite3
+from typing import Dict, Set, Tuple
+
+import attr
+
+@attr.s(auto_attribs=True)
+class ChangeBuffer:
+    """Keys changed by a transaction which haven't been sent to listeners yet.
+
+    Changing the same key more than once only marks it once, so listeners
+    receive the latest state a single time after the transaction commits."""
+    users: Set[str] = attr.Factory(set) # User names
+    battlegrounds: Set[str] = attr.Factory(set) # User names
+    battles: Set[Tuple[str, str]] = attr.Factory(set) # (attacker UID, defender UID)
+    # The latest versions of changed waves and battlegrounds by UID.
+    waveVersions: Dict[str, int] = attr.Factory(dict)
+    battlegroundVersions: Dict[str, int] = attr.Factory(dict)
+
+    def __bool__(self):
+        return bool(self.users or self.battlegrounds or self.battles or
+            self.waveVersions or self.battlegroundVersions)
+
+    def take(self) -> 'ChangeBuffer':
+        "Returns the buffered changes and empties the buffer."
+        taken = ChangeBuffer(self.users, self.battlegrounds, self.battles,
+            self.waveVersions, self.battlegroundVersions)
+        self.users = set()
+        self.battlegrounds = set()
+        self.battles = set()
+        self.waveVersions = {}
+        self.battlegroundVersions = {}
+        return taken
+
+class TrackedConnection(sqlite3.Connection):
+    "A SQLite connection which buffers the changes made through it."
+    changes: ChangeBuffer
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changes = ChangeBuffer()
@@ -0,0 +1,90 @@
+from collections import deque
+from contextlib import contextmanager
+import sqlite3
+import threading
+from typing import Callable, Deque, Iterator, Type
+
+class ConnectionPool:
+    """A pool of pre-configured SQLite connections.
+
+    Connections are set up once when they're created (journal mode, user
+    defined functions, etc.) and then reused rather than reopened for every
+    query."""
+    # Comfortably more than the number of distinct statements Db issues.
+    STATEMENT_CACHE_SIZE: int = 64
+
+    dbPath: str
+    maxIdle: int
+    setupConnection: Callable[[sqlite3.Connection], None]
+    factory: Type[sqlite3.Connection]
+    _idle: Deque[sqlite3.Connection]
+    _lock: threading.Lock
+    numCreated: int = 0
+
+    def __init__(self, dbPath: str, setupConnection: Callable[[sqlite3.Connection], None],
+            maxIdle: int = 8, factory: Type[sqlite3.Connection] = sqlite3.Connection):
+        """
+        Arguments:
+        dbPath: str -- Path of the SQLite database.
+        setupConnection: Callable[[sqlite3.Connection], None] -- Called once on every new connection.
+        maxIdle: int -- How many unused connections to keep open. 0 disables pooling.
+        factory: Type[sqlite3.Connection] -- Class of the connections to create.
+        """
+        self.dbPath = dbPath
+        self.setupConnection = setupConnection
+        self.maxIdle = maxIdle
+        self.factory = factory
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.dbPath, isolation_level=None, check_same_thread=False,
+                cached_statements=self.STATEMENT_CACHE_SIZE, factory=self.factory)
+        # Enable Write-Ahead Logging: https://www.sqlite.org/wal.html
+        conn.execute("PRAGMA journal_mode=WAL;")
+        self.setupConnection(conn)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        "Takes a connection from the pool, making a new one if none are free."
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            # Counted while deciding so concurrent acquires don't lose counts.
+            self.numCreated += 1
+        try:
+            return self._connect()
+        except BaseException:
+            with self._lock:
+                self.numCreated -= 1
+            raise
+
+    def release(self, conn: sqlite3.Connection):
+        "Returns a connection to the pool, rolling back any unfinished transaction."
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.maxIdle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrows a connection for the duration of a with block.
+
+        Like using a sqlite3.Connection as a context manager, any open
+        transaction is committed on success and rolled back on an exception."""
+        conn = self.acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        finally:
+            self.release(conn)
+
+    def close(self):
+        "Closes all idle connections."
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
@@ -22,11 +22,19 @@ cdef extern from "cpp_battle_computer.cpp":
     pass
 
 cdef extern from "cpp_battle_computer.h":
+    cdef cppclass BattleEventFbT:
+        pass
+    void AddMoveEvent(vector[BattleEventFbT]&, signed char objType, int id, unsigned short configId,
+            float startRow, float startCol, float destRow, float destCol, float startTime, float endTime)
+    void AddDeleteEvent(vector[BattleEventFbT]&, signed char objType, int id, float startTime)
+    void AddDamageEvent(vector[BattleEventFbT]&, int id, float startTime, float health)
+    string EncodeBattleEvents(const vector[BattleEventFbT]&)
+
     cdef cppclass CppBattleComputer:
         CppBattleComputer() except +
         CppBattleComputer(string, float) except +
         string ComputeBattle(const vector[vector[int]]&, vector[int] wave,
-                vector[vector[CppCellPos]])
+                vector[vector[CppCellPos]], const signed char* cancelled)
 
 cdef vector[CppCellPos] _pathToCpp(pyPath):
     cdef vector[CppCellPos] cppPath
@@ -34,6 +42,37 @@ cdef vector[CppCellPos] _pathToCpp(pyPath):
         cppPath.push_back(CppCellPos(pyPos.row, pyPos.col))
     return cppPath
 
+cdef signed char _objTypeToFb(objType) except -1:
+    # Keep in-sync with ObjectTypeFb in battle.fbs.
+    if objType is ObjectType.MONSTER:
+        return 0
+    if objType is ObjectType.PROJECTILE:
+        return 1
+    raise ValueError(f"Unknown enum value: {objType}")
+
+def encodeBattleEvents(events) -> bytes:
+    """Encodes a list of BattleEvents as a BattleEventsFb.
+
+    This produces the same events as Battle.encodeEventsFbWithBuilder, but
+    builds the FlatBuffer in C++ rather than one field at a time in Python."""
+    cdef vector[BattleEventFbT] cppEvents
+    cppEvents.reserve(len(events))
+    for event in events:
+        eventType = event.eventType
+        if eventType is EventType.MOVE:
+            startPos = event.startPos
+            destPos = event.destPos
+            AddMoveEvent(cppEvents, _objTypeToFb(event.objType), event.id, event.configId,
+                    startPos.row, startPos.col, destPos.row, destPos.col,
+                    event.startTime, event.endTime)
+        elif eventType is EventType.DELETE:
+            AddDeleteEvent(cppEvents, _objTypeToFb(event.objType), event.id, event.startTime)
+        elif eventType is EventType.DAMAGE:
+            AddDamageEvent(cppEvents, event.id, event.startTime, event.health)
+        else:
+            raise ValueError(f"Unknown event type: {eventType}")
+    return EncodeBattleEvents(cppEvents)
+
 cdef class BattleComputer:
     cdef CppBattleComputer cppBattleComputer
     cdef object gameConfig
@@ -42,7 +81,8 @@ cdef class BattleComputer:
         self.gameConfig = gameConfig
         self.cppBattleComputer = CppBattleComputer(jsonStr.encode("UTF-8"), gameTickSecs)
 
-    def computeBattle(self, battleground, wave: List[ConfigId], paths: List[List[CellPos]]):
+    def computeBattle(self, battleground, wave: List[ConfigId], paths: List[List[CellPos]],
+            size_t cancelFlagAddress = 0):
         if not wave:
             raise ValueError("Cannot compute battle with empty wave.")
 
@@ -63,7 +103,7 @@ cdef class BattleComputer:
 
         # Actually call the C++ code
         cdef string result = self.cppBattleComputer.ComputeBattle(
-                towers, wave, cppPaths)
+                towers, wave, cppPaths, <const signed char*>cancelFlagAddress)
 
         # Convert C++ results into Python
         return result
\ No newline at end of file
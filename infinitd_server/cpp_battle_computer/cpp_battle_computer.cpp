@@ -97,6 +97,53 @@ template<class T> void AddEvent(T &event, vector<BattleEventFbT> &events) {
   events.push_back(battleEvent);
 }
 
+void AddMoveEvent(vector<BattleEventFbT> &events, int8_t objType, int32_t id, uint16_t configId,
+    float startRow, float startCol, float destRow, float destCol, float startTime, float endTime) {
+  MoveEventFbT moveEvent;
+  moveEvent.obj_type = static_cast<ObjectTypeFb>(objType);
+  moveEvent.id = id;
+  moveEvent.config_id = configId;
+  moveEvent.start_pos = FpCellPosFb(startRow, startCol);
+  moveEvent.dest_pos = FpCellPosFb(destRow, destCol);
+  moveEvent.start_time = startTime;
+  moveEvent.end_time = endTime;
+  AddEvent(moveEvent, events);
+}
+
+void AddDeleteEvent(vector<BattleEventFbT> &events, int8_t objType, int32_t id, float startTime) {
+  DeleteEventFbT deleteEvent;
+  deleteEvent.obj_type = static_cast<ObjectTypeFb>(objType);
+  deleteEvent.id = id;
+  deleteEvent.start_time = startTime;
+  AddEvent(deleteEvent, events);
+}
+
+void AddDamageEvent(vector<BattleEventFbT> &events, int32_t id, float startTime, float health) {
+  DamageEventFbT damageEvent;
+  damageEvent.id = id;
+  damageEvent.start_time = startTime;
+  damageEvent.health = health;
+  AddEvent(damageEvent, events);
+}
+
+void BuildBattleEvents(flatbuffers::FlatBufferBuilder &builder, const vector<BattleEventFbT> &events) {
+  vector<flatbuffers::Offset<BattleEventFb>> eventOffsets;
+  eventOffsets.reserve(events.size());
+  for (const BattleEventFbT& event : events) {
+    eventOffsets.push_back(CreateBattleEventFb(builder, &event));
+  }
+  auto eventsFb = builder.CreateVector(eventOffsets);
+  auto battleEventsFb = CreateBattleEventsFb(builder, eventsFb);
+  builder.Finish(battleEventsFb);
+}
+
+string EncodeBattleEvents(const vector<BattleEventFbT> &events) {
+  // Roughly 64 bytes per event is enough to avoid most reallocations.
+  flatbuffers::FlatBufferBuilder builder(1024 + 64 * events.size());
+  BuildBattleEvents(builder, events);
+  return string((const char*)builder.GetBufferPointer(), builder.GetSize());
+}
+
 void MoveEnemies(float gameTime, vector<EnemyState> &enemies, vector<BattleEventFbT> &events,
     set<size_t> &removedEnemyIdx) {
   size_t enemyIdx = -1; // Intentional overflow so the first real value is 0.
@@ -230,7 +277,8 @@ void FireTowers(float gameTime, vector<TowerState> &towers, vector<EnemyState> &
 string CppBattleComputer::ComputeBattle(
     const vector<vector<int>>& towerIds,
     vector<int> wave,
-    vector<vector<CppCellPos>> paths) {
+    vector<vector<CppCellPos>> paths,
+    const volatile int8_t* cancelled) {
   const int numRows = this->gameConfig.playfield.numRows;
   CppCellPos enemyEnter(
     this->gameConfig.playfield.enemyEnter / numRows,
@@ -261,6 +309,9 @@ string CppBattleComputer::ComputeBattle(
     vector<EnemyState> spawnedEnemies;
 
     while (gameTime < kMaxGameTime && (!unspawnedEnemies.empty() || !spawnedEnemies.empty())) {
+      if (cancelled != nullptr && *cancelled) {
+        throw string("Battle calculation cancelled.");
+      }
       // Advance time
       ticks++;
       gameTime = ticks * this->gameTickSecs;
@@ -328,7 +379,6 @@ string CppBattleComputer::ComputeBattle(
 
   // First, serialize the events into a BattleEventsFb.
   flatbuffers::FlatBufferBuilder eventsBuilder(1024);
-  vector<flatbuffers::Offset<BattleEventFb>> eventOffsets;
   // Sort events by start time.
   // Use stable sort so things like damage events arriving at the same time maintain their order.
   // Otherwise two damage events for the same enemy at the exact same time may be ordered so that the
@@ -336,13 +386,7 @@ string CppBattleComputer::ComputeBattle(
   std::stable_sort(events.begin(), events.end(), [](const BattleEventFbT &a, const BattleEventFbT &b) {
     return GetStartTime(a) < GetStartTime(b);
   });
-  // Make offsets from events.
-  for (const BattleEventFbT& event : events) {
-    eventOffsets.push_back(CreateBattleEventFb(eventsBuilder, &event));
-  }
-  auto eventsFb = eventsBuilder.CreateVector(eventOffsets);
-  auto battleEventsFb = CreateBattleEventsFb(eventsBuilder, eventsFb);
-  eventsBuilder.Finish(battleEventsFb);
+  BuildBattleEvents(eventsBuilder, events);
 
   flatbuffers::FlatBufferBuilder builder(1024);
   builder.ForceVectorAlignment(eventsBuilder.GetSize(), sizeof(uint8_t),
@@ -10,6 +10,7 @@ using std::string;
 using std::vector;
 using std::reference_wrapper;
 using InfiniTDFb::BattleCalcResultsFb;
+using InfiniTDFb::BattleEventFbT;
 
 struct TowerState {
   uint16_t id;
@@ -55,6 +56,15 @@ std::ostream& operator<< (std::ostream &out, EnemyState const& enemy) {
     return out;
 }
 
+// Builders for BattleEventsFb outside of a battle calculation (e.g. re-encoding
+// events which have been decoded in Python).
+void AddMoveEvent(vector<BattleEventFbT> &events, int8_t objType, int32_t id, uint16_t configId,
+    float startRow, float startCol, float destRow, float destCol, float startTime, float endTime);
+void AddDeleteEvent(vector<BattleEventFbT> &events, int8_t objType, int32_t id, float startTime);
+void AddDamageEvent(vector<BattleEventFbT> &events, int32_t id, float startTime, float health);
+// Serializes events, in order, into a finished BattleEventsFb.
+string EncodeBattleEvents(const vector<BattleEventFbT> &events);
+
 class CppBattleComputer {
  public:
   GameConfig gameConfig;
@@ -62,8 +72,9 @@ class CppBattleComputer {
 
   CppBattleComputer() {};
   CppBattleComputer(string jsonText, float gameTickSecs_);
+  // The calculation stops early with an error once *cancelled becomes non-zero.
   string ComputeBattle(const vector<vector<int>>& towers, vector<int> wave,
-    vector<vector<CppCellPos>> paths);
+    vector<vector<CppCellPos>> paths, const volatile int8_t* cancelled = nullptr);
  private:
   vector<TowerState> getInitialTowerStates(const vector<vector<int>>& towerIds);
 };
\ No newline at end of file
@@ -1,28 +1,84 @@
 import asyncio
+import concurrent.futures
 from contextlib import contextmanager
+from enum import Enum, unique
+import functools
 import math
 import sqlite3
 import json
-from typing import Optional, List, Callable, Awaitable, Tuple, Iterable
+import threading
+from typing import Any, Dict, Optional, List, Callable, Awaitable, Tuple, Iterable, Iterator, Set, TypeVar
 
-from infinitd_server.battle import Battle, BattleResults
+import attr
+
+from infinitd_server.battle import Battle, BattleResults, BattleCalcResults
 from infinitd_server.battle_computer import BattleCalculationException
-from infinitd_server.battle_computer_pool import BattleComputerPool
+from infinitd_server.battle_computer_pool import BattleComputerPool, BattlePriority, BattleTag, StaleBattleException
 from infinitd_server.battle_coordinator import BattleCoordinator
 from infinitd_server.battleground_state import BattlegroundState, BgTowerState
+from infinitd_server.change_buffer import TrackedConnection
+from infinitd_server.connection_pool import ConnectionPool
+from infinitd_server.leaderboard import Leaderboard
+from infinitd_server import migrations
 from infinitd_server.user import User, UserSummary, FrozenUser, FrozenUserSummary, MutableUser
 from infinitd_server.game_config import GameConfig
+from infinitd_server.pubsub import PubSub, InProcessPubSub
 from infinitd_server.sse import SseQueues
 from infinitd_server.paths import pathExists
 from infinitd_server.logger import Logger
 from infinitd_server.rivals import Rivals
 
+T = TypeVar('T')
+
+@attr.s(auto_attribs=True, frozen=True)
+class RankedUser:
+    "What the leaderboard needs to know about a user besides their accumulated gold."
+    uid: str
+    goldPerMinute: float
+    inBattle: bool
+    emptyWave: bool
+
+@unique
+class BattleJobState(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+@attr.s(auto_attribs=True, frozen=True)
+class BattleJob:
+    "A battle claimed from the battle_jobs table."
+    attackerUid: str
+    defenderUid: str
+    priority: BattlePriority
+    version: int
+
 class Db:
     DEFAULT_DB_PATH = "data/data.db"
+    # Gold is accrued lazily. Each user stores the gold they had at goldSettledTick
+    # and earns their gold per minute for every tick of the gold clock since then.
+    GOLD_TICK = "(SELECT tick FROM goldClock)"
+    ACCRUED_GOLD = (
+            "(CASE WHEN inBattle THEN 0 ELSE "
+            f"(goldPerMinuteSelf + goldPerMinuteOthers) * ({GOLD_TICK} - goldSettledTick) END)")
+    CURRENT_GOLD = f"(gold + {ACCRUED_GOLD})"
+    CURRENT_ACCUMULATED_GOLD = f"(accumulatedGold + {ACCRUED_GOLD})"
+    # Folds accrued gold into the stored values. Any UPDATE which changes inBattle
+    # or gold per minute must include this.
+    SETTLE_GOLD = (
+            f"gold = {CURRENT_GOLD}, accumulatedGold = {CURRENT_ACCUMULATED_GOLD}, "
+            f"goldSettledTick = {GOLD_TICK}")
     SELECT_USER_STATEMENT = (
-            "SELECT name, uid, gold, accumulatedGold, goldPerMinuteSelf, goldPerMinuteOthers, inBattle, wave, admin, battleground FROM users")
+            f"SELECT name, uid, {CURRENT_GOLD}, {CURRENT_ACCUMULATED_GOLD}, goldPerMinuteSelf, "
+            "goldPerMinuteOthers, inBattle, wave, admin, battleground, waveVersion, battlegroundVersion FROM users")
     SELECT_USER_SUMMARY_STATEMENT = (
-            "SELECT name, uid, gold, accumulatedGold, goldPerMinuteSelf, goldPerMinuteOthers, inBattle, wave, admin FROM users")
+            f"SELECT name, uid, {CURRENT_GOLD}, {CURRENT_ACCUMULATED_GOLD}, goldPerMinuteSelf, "
+            "goldPerMinuteOthers, inBattle, wave, admin, waveVersion FROM users")
+    SELECT_RANKED_USER_STATEMENT = (
+            f"SELECT name, uid, {CURRENT_ACCUMULATED_GOLD}, goldPerMinuteSelf + goldPerMinuteOthers, "
+            f"inBattle, wave = '[]', rowid, {GOLD_TICK} FROM users")
+    # Keep IN (...) lists well below SQLite's limit on the number of parameters.
+    MAX_PARAMS_PER_QUERY: int = 500
 
     gameConfig: GameConfig
     userQueues: SseQueues
@@ -33,14 +89,34 @@ class Db:
     battleCoordinator: BattleCoordinator
     debug: bool
     dbPath: str
+    connectionPool: ConnectionPool
+    executor: concurrent.futures.ThreadPoolExecutor
+    eventLoop: Optional[asyncio.AbstractEventLoop] = None
+    _writeLock: Optional[asyncio.Lock] = None
+    # Users ordered by accumulated gold. Guarded by leaderboardLock.
+    leaderboard: Leaderboard[RankedUser]
+    leaderboardLock: threading.RLock
+    # Keeps the leaderboards of other processes sharing the database up to date.
+    LEADERBOARD_CHANNEL: str = "leaderboard"
+    pubsub: PubSub
 
     def __init__(self, gameConfig: GameConfig, userQueues: SseQueues, bgQueues: SseQueues,
             rivalsQueues: SseQueues, battleGpmQueues: SseQueues,
-            battleCoordinator: BattleCoordinator, dbPath=None, debug=False):
+            battleCoordinator: BattleCoordinator, dbPath=None, debug=False,
+            maxIdleConnections: int = 8, numThreads: int = 4, pubsub: Optional[PubSub] = None):
         self.debug = debug
         self.dbPath = self.DEFAULT_DB_PATH if dbPath is None else dbPath
+        self.leaderboard = Leaderboard()
+        self.leaderboardLock = threading.RLock()
         sqlite3.enable_callback_tracebacks(debug)
+        self.connectionPool = ConnectionPool(self.dbPath, self.__addTriggerFunctions,
+                maxIdle = maxIdleConnections, factory = TrackedConnection)
+        # Dedicated threads so queries never block the event loop.
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers = numThreads, thread_name_prefix = "db")
+        self.logger = Logger.getDefault()
         self.__createTables()
+        self.__loadLeaderboard()
         self.gameConfig = gameConfig
         self.userQueues = userQueues
         self.bgQueues = bgQueues
@@ -48,34 +124,26 @@ class Db:
         self.battleGpmQueues = battleGpmQueues
         self.battleComputerPool = BattleComputerPool(gameConfig = gameConfig, debug = debug)
         self.battleCoordinator = battleCoordinator
-        self.logger = Logger.getDefault()
+        self.pubsub = InProcessPubSub() if pubsub is None else pubsub
+        for key in ["users", "goldClock"]:
+            self.pubsub.subscribe(self.LEADERBOARD_CHANNEL, key)
+        self.pubsub.listen(self.LEADERBOARD_CHANNEL, self.__onOtherProcessLeaderboardChange)
 
     def __createTables(self):
         with self.makeConnection() as conn:
+            # Make the schema changes atomically so triggers are never missing.
+            conn.execute("BEGIN IMMEDIATE")
+            numMigrations = migrations.migrate(conn)
+            if numMigrations > 0:
+                self.logger.info("DB", -1, f"Applied {numMigrations} schema migrations.")
+            # These triggers only record which keys changed. Listeners are updated
+            # with the latest values once the transaction commits.
+            for trigger in ["userSummaryUpdate", "userInsert", "userDelete", "battlegroundUpdate",
+                    "battleUpdateInsert", "battleUpdateDelete"]:
+                # Recreate triggers so databases made by older versions pick up any changes.
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger};")
             conn.execute("""
-                CREATE TABLE IF NOT EXISTS users(
-                uid TEXT PRIMARY KEY,
-                name TEXT UNIQUE,
-                gold REAL,
-                accumulatedGold REAL,
-                goldPerMinuteSelf REAL,
-                goldPerMinuteOthers REAL,
-                inBattle BOOLEAN DEFAULT 0 CHECK (inBattle == 0 || inBattle == 1),
-                battleground TEXT,
-                wave TEXT DEFAULT '[]',
-                admin BOOLEAN DEFAULT 0 CHECK (admin == 0 || admin == 1)
-                );""")
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS battles(
-                attackerUid TEXT KEY,
-                defenderUid TEXT KEY,
-                events BLOB,
-                results BLOB,
-                goldPerMinute REAL
-                );""")
-            # Add a trigger to update the user stream when user summary data is changed.
-            conn.execute("""
-                CREATE TRIGGER IF NOT EXISTS userSummaryUpdate
+                CREATE TRIGGER userSummaryUpdate
                 AFTER UPDATE ON users
                 WHEN FALSE
                     OR new.name <> old.name
@@ -86,78 +154,213 @@ class Db:
                     OR new.inBattle <> old.inBattle
                     OR new.wave <> old.wave
                 BEGIN
-                    SELECT 
-                        updateUserListeners( -- Keep in-sync with SELECT_USER_SUMMARY_STATEMENT
-                            new.name,
-                            new.uid,
-                            new.gold,
-                            new.accumulatedGold,
-                            new.goldPerMinuteSelf,
-                            new.goldPerMinuteOthers,
-                            new.inBattle,
-                            new.wave,
-                            new.admin
-                        );
+                    SELECT markUserChanged(new.name);
+                END;""")
+            conn.execute("""
+                CREATE TRIGGER userInsert
+                AFTER INSERT ON users
+                BEGIN
+                    SELECT markUserChanged(new.name);
                 END;""")
-            # Add a trigger to update the battleground stream when user battleground data is changed.
             conn.execute("""
-                CREATE TRIGGER IF NOT EXISTS battlegroundUpdate
+                CREATE TRIGGER userDelete
+                AFTER DELETE ON users
+                BEGIN
+                    SELECT markUserChanged(old.name);
+                END;""")
+            conn.execute("""
+                CREATE TRIGGER battlegroundUpdate
                 AFTER UPDATE ON users
                 WHEN new.battleground <> old.battleground
                 BEGIN
-                    SELECT 
-                        updateBattlegroundListeners(
-                            new.name,
-                            new.battleground
-                        );
+                    SELECT markBattlegroundChanged(new.name);
                 END;""")
-            # Add triggers to update the battle gold per minute stream.
             conn.execute("""
-                CREATE TRIGGER IF NOT EXISTS battleUpdateInsert
+                CREATE TRIGGER battleUpdateInsert
                 AFTER INSERT ON battles
                 BEGIN
-                    SELECT 
-                        updateBattleGpmListeners(
-                            new.attackerUid,
-                            new.defenderUid,
-                            new.goldPerMinute
-                        );
+                    SELECT markBattleChanged(new.attackerUid, new.defenderUid);
                 END;""")
             conn.execute("""
-                CREATE TRIGGER IF NOT EXISTS battleUpdateDelete
+                CREATE TRIGGER battleUpdateDelete
                 AFTER DELETE ON battles
                 BEGIN
-                    SELECT 
-                        updateBattleGpmListeners(
-                            old.attackerUid,
-                            old.defenderUid,
-                            -1.0
-                        );
+                    SELECT markBattleChanged(old.attackerUid, old.defenderUid);
                 END;""")
 
-    
-    def __addTriggerFunctions(self, conn: sqlite3.Connection):
-        def updateUserListeners(name, uid, gold, accumulatedGold, goldPerMinuteSelf,
-                goldPerMinuteOthers, inBattle, wave, admin):
-            row = [name, uid, gold, accumulatedGold, goldPerMinuteSelf, goldPerMinuteOthers, inBattle, wave, admin]
-            self.__updateUserListeners(self.__extractUserSummaryFromRow(row))
-        conn.create_function("updateUserListeners", 9, updateUserListeners)
-
-        def updateBattlegroundListeners(name, battlegroundData):
-            battleground = BattlegroundState.from_json(battlegroundData)
-            self.__updateBattlegroundListeners(name, battleground)
-        conn.create_function("updateBattlegroundListeners", 2, updateBattlegroundListeners)
-
-        def updateBattleGpmListeners(attackerUid, defenderUid, goldPerMinute):
-            self.__updateBattleGpmListeners(attackerUid, defenderUid, goldPerMinute)
-        conn.create_function("updateBattleGpmListeners", 3, updateBattleGpmListeners)
-
-    def makeConnection(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.dbPath, isolation_level=None)
-        # Enable Write-Ahead Logging: https://www.sqlite.org/wal.html
-        conn.execute("PRAGMA journal_mode=WAL;")
-        self.__addTriggerFunctions(conn)
-        return conn
+    @staticmethod
+    def __addTriggerFunctions(conn: TrackedConnection):
+        changes = conn.changes
+        # Look up the sets on every call since ChangeBuffer.take replaces them.
+        conn.create_function("markUserChanged", 1, lambda name: changes.users.add(name))
+        conn.create_function("markBattlegroundChanged", 1, lambda name: changes.battlegrounds.add(name))
+        conn.create_function("markBattleChanged", 2,
+            lambda attackerUid, defenderUid: changes.battles.add((attackerUid, defenderUid)))
+
+    @contextmanager
+    def makeConnection(self) -> Iterator[TrackedConnection]:
+        """Borrow a connection from the pool for the duration of a with block.
+
+        Listeners are updated with any changes once the block commits."""
+        with self.connectionPool.connection() as conn:
+            try:
+                yield conn
+                if conn.in_transaction:
+                    conn.commit()
+            except BaseException:
+                conn.changes.take()
+                raise
+            self.__flushChanges(conn)
+
+    def releaseConnection(self, conn: TrackedConnection):
+        "Return a connection acquired from connectionPool, dropping any uncommitted changes."
+        conn.changes.take()
+        self.connectionPool.release(conn)
+
+    def close(self):
+        self.executor.shutdown()
+        self.connectionPool.close()
+
+    async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        "Run a blocking Db call on one of the DB threads."
+        loop = asyncio.get_running_loop()
+        # Remember the loop so updates triggered on DB threads can be sent from it.
+        self.eventLoop = loop
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def __callOnLoop(self, fn: Callable[[], None]):
+        "Call fn from the event loop, which may be later if we're on a DB thread."
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # We're on a DB thread so hand fn over to the event loop.
+            if self.eventLoop is not None:
+                self.eventLoop.call_soon_threadsafe(fn)
+            return
+        fn()
+
+    def __scheduleUpdates(self, updates: List[Tuple[SseQueues, str, Any]]):
+        "Send a batch of updates asynchronously from either the event loop or a DB thread."
+        if not updates:
+            return
+        def sendUpdates():
+            for (queues, param, newState) in updates:
+                asyncio.ensure_future(queues.sendUpdate(param, newState))
+        self.__callOnLoop(sendUpdates)
+
+    @staticmethod
+    def __placeholders(values: Iterable) -> str:
+        return ", ".join("?" for _ in values)
+
+    def __flushChanges(self, conn: TrackedConnection):
+        """Send the latest state of everything changed by conn to its listeners.
+
+        Only keys with listeners are looked up, and each only once."""
+        changes = conn.changes.take()
+        if not changes:
+            return
+        if changes.users:
+            self.__refreshLeaderboard(conn, list(changes.users))
+            if "users" in self.pubsub.remoteKeys(self.LEADERBOARD_CHANNEL):
+                self.__callOnLoop(functools.partial(self.pubsub.publish,
+                    self.LEADERBOARD_CHANNEL, "users", list(changes.users)))
+        if changes.waveVersions or changes.battlegroundVersions:
+            # Stop calculating battles which can no longer be saved.
+            self.__callOnLoop(functools.partial(self.battleComputerPool.cancelStale,
+                changes.waveVersions, changes.battlegroundVersions))
+        updates = []
+
+        userNames = [name for name in changes.users if name in self.userQueues]
+        if userNames:
+            res = conn.execute(self.SELECT_USER_SUMMARY_STATEMENT +
+                f" WHERE name IN ({self.__placeholders(userNames)});", userNames).fetchall()
+            updates.extend((self.userQueues, row[0], Db.__extractUserSummaryFromRow(row)) for row in res)
+
+        bgNames = [name for name in changes.battlegrounds if name in self.bgQueues]
+        if bgNames:
+            res = conn.execute(
+                f"SELECT name, battleground FROM users WHERE name IN ({self.__placeholders(bgNames)});",
+                bgNames).fetchall()
+            updates.extend((self.bgQueues, name, BattlegroundState.from_json(bg)) for (name, bg) in res)
+
+        if changes.battles and self.battleGpmQueues.keys():
+            uids = list({uid for battle in changes.battles for uid in battle})
+            namesByUid = dict(conn.execute(
+                f"SELECT uid, name FROM users WHERE uid IN ({self.__placeholders(uids)});", uids).fetchall())
+            for (attackerUid, defenderUid) in changes.battles:
+                if attackerUid not in namesByUid or defenderUid not in namesByUid:
+                    continue
+                battleId = f"{namesByUid[defenderUid]}/{namesByUid[attackerUid]}"
+                if battleId not in self.battleGpmQueues:
+                    continue
+                res = conn.execute(
+                    "SELECT goldPerMinute FROM battles WHERE attackerUid = ? AND defenderUid = ?;",
+                    (attackerUid, defenderUid)).fetchone()
+                # A missing battle is sent as -1.
+                updates.append((self.battleGpmQueues, battleId, -1.0 if res is None else res[0]))
+
+        self.__scheduleUpdates(updates)
+
+    @staticmethod
+    def __extractRankedUserFromRow(row) -> Tuple[str, float, RankedUser, int, float, int]:
+        """Returns the arguments for Leaderboard.set. Ties are broken by registration order.
+
+        Scores grow with the gold clock, just like accumulated gold."""
+        user = RankedUser(
+                uid = row[1],
+                goldPerMinute = row[3],
+                inBattle = row[4] == 1,
+                emptyWave = row[5] == 1)
+        rate = 0.0 if user.inBattle else user.goldPerMinute
+        return (row[0], row[2], user, row[6], rate, row[7])
+
+    def __loadLeaderboard(self):
+        with self.makeConnection() as conn:
+            with self.leaderboardLock:
+                tick = conn.execute("SELECT tick FROM goldClock;").fetchone()[0]
+                leaderboard = Leaderboard(now = tick)
+                for row in conn.execute(self.SELECT_RANKED_USER_STATEMENT):
+                    leaderboard.set(*Db.__extractRankedUserFromRow(row))
+                self.leaderboard = leaderboard
+
+    async def __onOtherProcessLeaderboardChange(self, key: str, message: Any):
+        if key == "users":
+            await self.run(self.__refreshLeaderboardByName, message)
+        else:
+            # Another process ticked the gold clock.
+            await self.run(self.__advanceLeaderboard, message)
+
+    def __advanceLeaderboard(self, tick: int):
+        "Apply a tick of the gold clock from another process, reloading if any were missed."
+        with self.leaderboardLock:
+            now = self.leaderboard.now
+            if tick <= now:
+                # Already applied, e.g. by reloading.
+                return
+            if tick == now + 1:
+                self.leaderboard.advance(tick)
+                return
+        self.logger.info("DB", -1, f"Missed gold clock ticks {now + 1} to {tick - 1}, reloading the leaderboard.")
+        self.__loadLeaderboard()
+
+    def __refreshLeaderboardByName(self, names: List[str]):
+        with self.makeConnection() as conn:
+            self.__refreshLeaderboard(conn, names)
+
+    def __refreshLeaderboard(self, conn: sqlite3.Connection, names: List[str]):
+        "Copy the latest state of the named users into the leaderboard."
+        # Hold the lock while reading so a concurrent accumulateGold can't be undone.
+        with self.leaderboardLock:
+            for i in range(0, len(names), self.MAX_PARAMS_PER_QUERY):
+                batch = names[i:i + self.MAX_PARAMS_PER_QUERY]
+                res = conn.execute(self.SELECT_RANKED_USER_STATEMENT +
+                    f" WHERE name IN ({self.__placeholders(batch)});", batch).fetchall()
+                for row in res:
+                    self.leaderboard.set(*Db.__extractRankedUserFromRow(row))
+                for name in set(batch).difference(row[0] for row in res):
+                    # The user was deleted.
+                    if name in self.leaderboard:
+                        self.leaderboard.remove(name)
 
     @staticmethod
     def __extractUserSummaryFromRow(row) -> FrozenUserSummary:
@@ -170,7 +373,8 @@ class Db:
                 goldPerMinuteOthers = row[5],
                 inBattle = row[6] == 1,
                 wave = json.loads(row[7]),
-                admin = row[8] == 1)
+                admin = row[8] == 1,
+                waveVersion = row[9])
 
     @staticmethod
     def __extractUserFromRow(row, targetClass=FrozenUser):
@@ -184,7 +388,9 @@ class Db:
                 inBattle = row[6] == 1,
                 wave = json.loads(row[7]),
                 admin = row[8] == 1,
-                battleground = BattlegroundState.from_json(row[9]))
+                battleground = BattlegroundState.from_json(row[9]),
+                waveVersion = row[10],
+                battlegroundVersion = row[11])
 
     def getUserSummaryByName(self, name: str) -> Optional[FrozenUserSummary]:
         with self.makeConnection() as conn:
@@ -214,6 +420,19 @@ class Db:
             return Db.__extractUserFromRow(res)
         return None
 
+    def getUsersByUids(self, uids: Iterable[str]) -> Dict[str, FrozenUser]:
+        "Look up many users at once. Unknown UIDs are left out."
+        uids = list(uids)
+        users = {}
+        with self.makeConnection() as conn:
+            for i in range(0, len(uids), self.MAX_PARAMS_PER_QUERY):
+                batch = uids[i:i + self.MAX_PARAMS_PER_QUERY]
+                for row in conn.execute(self.SELECT_USER_STATEMENT +
+                        f" WHERE uid IN ({self.__placeholders(batch)});", batch):
+                    user = Db.__extractUserFromRow(row)
+                    users[user.uid] = user
+        return users
+
     def getUnfrozenUserByUid(self, uid: str) -> Optional[User]:
         with self.makeConnection() as conn:
             res = conn.execute(self.SELECT_USER_STATEMENT + " WHERE uid = ?;", (uid, )).fetchone()
@@ -221,11 +440,19 @@ class Db:
             return Db.__extractUserFromRow(res, User)
         return None
 
-    def getUsers(self) -> List[FrozenUserSummary]:
+    def getUsers(self, start: int = 0, count: Optional[int] = None) -> List[FrozenUserSummary]:
+        "Returns users ordered by accumulated gold, optionally only count users starting from rank start."
+        with self.leaderboardLock:
+            names = self.leaderboard.page(start, len(self.leaderboard) if count is None else count)
+        usersByName = {}
         with self.makeConnection() as conn:
-            res = conn.execute(self.SELECT_USER_SUMMARY_STATEMENT + " ORDER BY accumulatedGold DESC;")
-        res = [ Db.__extractUserSummaryFromRow(r) for r in res ]
-        return res
+            for i in range(0, len(names), self.MAX_PARAMS_PER_QUERY):
+                batch = names[i:i + self.MAX_PARAMS_PER_QUERY]
+                res = conn.execute(self.SELECT_USER_SUMMARY_STATEMENT +
+                    f" WHERE name IN ({self.__placeholders(batch)});", batch).fetchall()
+                for row in res:
+                    usersByName[row[0]] = Db.__extractUserSummaryFromRow(row)
+        return [usersByName[name] for name in names if name in usersByName]
 
     def getBattleground(self, name) -> Optional[BattlegroundState]:
         with self.makeConnection() as conn:
@@ -242,10 +469,10 @@ class Db:
                 conn.execute("""
                     INSERT INTO users
                         (uid, name, gold, accumulatedGold, goldPerMinuteSelf,
-                         goldPerMinuteOthers, admin, battleground)
+                         goldPerMinuteOthers, admin, battleground, goldSettledTick)
                     VALUES 
                         (:uid, :name, :gold, :gold,
-                         :goldPerMinuteSelf, 0, :admin, :battleground);""",
+                         :goldPerMinuteSelf, 0, :admin, :battleground, """ + self.GOLD_TICK + ");",
                     {"uid": uid, "name": name, "gold": self.gameConfig.misc.startingGold,
                         "goldPerMinuteSelf": self.gameConfig.misc.minGoldPerMinute,
                         "admin": admin, "battleground": emptyBattleground.to_json(),
@@ -259,82 +486,65 @@ class Db:
             raise err
 
     async def accumulateGold(self):
-        """Updates gold and accumulatedGold for every user based on goldPerMinute."""
-        rivalRadius = self.gameConfig.misc.rivalRadius
-        rivals_inner_query = "(SELECT "
-        for i in range(rivalRadius, 0, -1):
-            rivals_inner_query += f"lag(name, {i}) OVER before as before_ahead_{i}, "
-            rivals_inner_query += f"lag(name, {i}) OVER after as after_ahead_{i}, "
-        rivals_inner_query += "name as name, "
-        for i in range(1, rivalRadius + 1):
-            rivals_inner_query += f"lead(name, {i}) OVER before as before_behind_{i}, "
-            rivals_inner_query += f"lead(name, {i}) OVER after as after_behind_{i}, "
-        rivals_inner_query = rivals_inner_query[:-2]
-        rivals_inner_query += """
-            FROM users
-            WINDOW
-               before AS (ORDER BY accumulatedGold DESC),
-               after AS (ORDER BY accumulatedGold + goldPerMinuteSelf + goldPerMinuteOthers DESC)
-            )"""
-        rivals_query = "SELECT "
-        for i in range(rivalRadius, 0, -1):
-            rivals_query += f"after_ahead_{i}, "
-        rivals_query += "name, "
-        for i in range(1, rivalRadius + 1):
-            rivals_query += f"after_behind_{i}, "
-        rivals_query = rivals_query[:-2]
-        rivals_query += f" FROM {rivals_inner_query} WHERE FALSE"
-        for i in range(1, rivalRadius + 1):
-            rivals_query += f" OR before_ahead_{i} != after_ahead_{i}"
-            rivals_query += f" OR before_behind_{i} != after_behind_{i}"
+        """Advances the gold clock, crediting every user not in a battle with their gold per minute.
+
+        User rows aren't written, only listeners of users whose gold changed are updated."""
+        subscribedNames = list(self.userQueues.keys())
+        rivalsUpdated, usersUpdated, tick = await self.run(self.__accumulateGold, subscribedNames)
+        self.pubsub.publish(self.LEADERBOARD_CHANNEL, "goldClock", tick)
+        self.__scheduleUpdates([(self.userQueues, user.name, user) for user in usersUpdated])
+        await self.__updateRivalsListeners(rivalsUpdated)
 
+    def __accumulateGold(self, subscribedNames: List[str]
+            ) -> Tuple[List[Tuple[str, Rivals]], List[FrozenUserSummary], int]:
+        """Ticks the gold clock.
+
+        Returns the users whose rivals changed, the updated summaries of subscribed users
+        and the new tick."""
         with self.makeConnection() as conn:
-            res = conn.execute(rivals_query)
-            def makeRivals(row):
-                aheadRivals = [x for x in row[:rivalRadius] if x is not None]
-                behindRivals = [x for x in row[-rivalRadius:] if x is not None]
-                return Rivals(aheadRivals, behindRivals)
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE goldClock SET tick = tick + 1;")
+            tick = conn.execute("SELECT tick FROM goldClock;").fetchone()[0]
+            with self.leaderboardLock:
+                conn.commit()
+                rivalsUpdated = self.__accrueLeaderboardGold(tick)
+            # New rivals need battles against each other.
+            self.__enqueueRivalBattles(conn, [name for (name, _) in rivalsUpdated])
 
-            rivalsUpdated = [(row[rivalRadius], makeRivals(row)) for row in res]
+            usersUpdated = []
+            if subscribedNames:
+                res = conn.execute(self.SELECT_USER_SUMMARY_STATEMENT +
+                    " WHERE inBattle = 0 AND goldPerMinuteSelf + goldPerMinuteOthers != 0"
+                    f" AND name IN ({self.__placeholders(subscribedNames)});", subscribedNames).fetchall()
+                usersUpdated = [Db.__extractUserSummaryFromRow(row) for row in res]
 
-            conn.execute("""
-            UPDATE users SET
-                accumulatedGold = accumulatedGold + goldPerMinuteSelf + goldPerMinuteOthers,
-                gold = gold + goldPerMinuteSelf + goldPerMinuteOthers
-            WHERE inBattle == 0;""")
-            conn.commit()
+        return (rivalsUpdated, usersUpdated, tick)
 
-        await self.__updateRivalsListeners(rivalsUpdated)
+    def __accrueLeaderboardGold(self, tick: int) -> List[Tuple[str, Rivals]]:
+        """Advances the leaderboard to the given tick of the gold clock.
 
-    def __updateBattlegroundListeners(self, name: str, battleground: BattlegroundState):
-        if name in self.bgQueues:
-            # Send the update asynchronously
-            asyncio.create_task(self.bgQueues.sendUpdate(name, battleground))
-    
-    def __updateBattleGpmListeners(self, attackerUid: str, defenderUid: str, gpm: float):
-        attacker = self.getUserSummaryByUid(attackerUid)
-        defender = self.getUserSummaryByUid(defenderUid)
-        battleId = f"{defender.name}/{attacker.name}"
-        if battleId in self.battleGpmQueues:
-            # Send the update asynchronously
-            asyncio.create_task(self.battleGpmQueues.sendUpdate(battleId, gpm))
+        Returns the users whose rivals changed. Scores grow lazily, so only users
+        who overtake someone and those within rivalRadius of them are touched."""
+        rivalRadius = self.gameConfig.misc.rivalRadius
+        oldRivals = self.leaderboard.advance(tick, rivalRadius)
+        rivalsUpdated = []
+        for (name, (ahead, behind)) in oldRivals.items():
+            newRivals = Rivals(*self.leaderboard.around(name, rivalRadius))
+            if newRivals != Rivals(ahead, behind):
+                rivalsUpdated.append((name, newRivals))
+        return rivalsUpdated
 
     async def __updateAllListeners(self):
         updateCalls = []
-        for name in self.userQueues.keys():
-            user = self.getUserSummaryByName(name)
+        for name in list(self.userQueues.keys()):
+            user = await self.run(self.getUserSummaryByName, name)
             updateCalls.append(self.userQueues.sendUpdate(name, user))
-        for name in self.bgQueues.keys():
-            battleground = self.getBattleground(name)
+        for name in list(self.bgQueues.keys()):
+            battleground = await self.run(self.getBattleground, name)
             updateCalls.append(self.bgQueues.sendUpdate(name, battleground))
         if updateCalls:
             await asyncio.wait(updateCalls)
 
-    def __updateUserListeners(self, user: FrozenUserSummary):
-        if user.name in self.userQueues:
-            # Send the update asynchronously
-            asyncio.create_task(self.userQueues.sendUpdate(user.name, user))
-
     async def __updateRivalsListeners(self, usersAndRivals: List[Tuple[str, Rivals]]):
         updateCalls = []
         for (name, rivals) in usersAndRivals:
@@ -346,7 +556,7 @@ class Db:
     def setInBattle(self, name: str, inBattle: bool):
         with self.makeConnection() as conn:
             conn.execute(
-                "UPDATE users SET inBattle = :inBattle WHERE name == :name;",
+                f"UPDATE users SET {self.SETTLE_GOLD}, inBattle = :inBattle WHERE name == :name;",
                 {"inBattle": inBattle, "name": name})
             conn.commit()
 
@@ -354,7 +564,8 @@ class Db:
         """Directly sets the Battleground for a given user. For test purposes only."""
         with self.makeConnection() as conn:
             conn.execute(
-                "UPDATE USERS SET battleground = :battleground WHERE name = :name",
+                "UPDATE USERS SET battleground = :battleground, battlegroundVersion = battlegroundVersion + 1 "
+                "WHERE name = :name",
                 {
                     "battleground": battleground.to_json(),
                     "name": name,
@@ -364,9 +575,14 @@ class Db:
     def setUserNotInBattle(self, uid: str, name: str):
         "Marks a user as no longer in a battle."
         with self.makeConnection() as conn:
-            conn.execute("UPDATE users SET inBattle = FALSE where uid = :uid;", { "uid": uid })
+            conn.execute(f"UPDATE users SET {self.SETTLE_GOLD}, inBattle = FALSE where uid = :uid;",
+                { "uid": uid })
 
-    def getBattle(self, attackingUser: FrozenUserSummary, defendingUser: FrozenUserSummary, conn: sqlite3.Connection) -> Optional[Battle]:
+    def getBattle(self, attackingUser: FrozenUserSummary, defendingUser: FrozenUserSummary,
+            conn: Optional[sqlite3.Connection] = None) -> Optional[Battle]:
+        if conn is None:
+            with self.makeConnection() as conn:
+                return self.getBattle(attackingUser, defendingUser, conn)
         res = conn.execute(
             "SELECT events, results FROM battles "
             "WHERE attackerUid = :attackingUid AND defenderUid = :defendingUid;",
@@ -387,20 +603,30 @@ class Db:
             results = results)
         return battle
 
-    async def getOrMakeBattle(self, attacker: UserSummary, defender: User, handler: str, requestId: int) -> Battle:
+    async def getOrMakeBattle(self, attacker: UserSummary, defender: User, handler: str, requestId: int,
+            priority: BattlePriority = BattlePriority.VIEW) -> Battle:
         """Returns a battle between attacker and defender, generating it if necessary"""
 
-        with self.makeConnection() as conn:
-            existingBattle = self.getBattle(attacker, defender, conn)
-            if existingBattle: # Battle exists
-                self.logger.info(handler, requestId, f"Found battle: {existingBattle.name}")
-                return existingBattle
+        existingBattle = await self.run(self.getBattle, attacker, defender)
+        if existingBattle: # Battle exists
+            self.logger.info(handler, requestId, f"Found battle: {existingBattle.name}")
+            return existingBattle
 
         # Calculate a new battle
         self.logger.info(handler, requestId, f"Calculating new battle: {defender.name} vs {attacker.name}")
         if defender.battleground is None: # This should be impossible since we know the user exists.
             raise ValueError(f"Cannot find battleground for {defender.name}")
-        battleCalcResults = await self.battleComputerPool.computeBattle(defender.battleground, attacker.wave)
+        try:
+            battleCalcResults = await self.battleComputerPool.computeBattle(
+                    defender.battleground, attacker.wave, priority,
+                    BattleTag(attacker.uid, attacker.waveVersion, defender.uid, defender.battlegroundVersion))
+        except StaleBattleException:
+            latestUsers = await self.run(self.__getLatestUsers, attacker, defender, handler, requestId)
+            if latestUsers is None:
+                raise ValueError(f"{attacker.name} or {defender.name} no longer exists.")
+            (latestAttacker, latestDefender) = latestUsers
+            return await self.getOrMakeBattle(attacker=latestAttacker, defender=latestDefender,
+                handler=handler, requestId=requestId, priority=priority)
         events = Battle.fbToEvents(battleCalcResults.fb.EventsNestedRoot())
         battleName = f"vs. {attacker.name}"
         battle = Battle(
@@ -409,43 +635,63 @@ class Db:
             attackerName = attacker.name,
             defenderName = defender.name,
             results = battleCalcResults.results)
-        # Check if attacker wave or defender battleground changed since the start.
-        with self.makeConnection() as conn:
-            conn.execute("BEGIN IMMEDIATE")
-            safeToWrite = True
-            latestAttacker = self.getUserSummaryByUid(attacker.uid)
-            if latestAttacker.wave != attacker.wave:
-                safeToWrite = False
-                self.logger.info(handler, requestId, f"Attacker {attacker.name}'s wave has changed. Recalculating.")
-            if safeToWrite:
-                latestDefender = self.getUserByUid(defender.uid)
-                if latestDefender.battleground != defender.battleground:
-                    safeToWrite = False
-                    self.logger.info(handler, requestId, f"Defender {defender.name}'s battleground has changed. Recalculating.")
-            if safeToWrite:
-                # We can safely write the battle.
-                conn.execute(
-                    "INSERT INTO battles (attackerUid, defenderUid, events, results, goldPerMinute) "
-                    "VALUES (:attackingUid, :defendingUid, :events, :results, :goldPerMinute);",
-                    {
-                        "attackingUid": attacker.uid, "defendingUid": defender.uid,
-                        "events": battleCalcResults.fb.EventsAsNumpy().tobytes(),
-                        "results": battleCalcResults.results.encodeFb(),
-                        "goldPerMinute": battleCalcResults.results.goldPerMinute,
-                    }
-                )
-                conn.commit()
-                self.logger.info(handler, requestId, f"Saved battle.")
-                return battle
+        latestUsers = await self.run(self.__saveBattleIfCurrent,
+                attacker, defender, battleCalcResults, handler, requestId)
+        if latestUsers is None:
+            return battle
 
         # If we've gotten here it means either the attacking wave or defending battleground changed.
         # Retry with the latest attacker and defender information.
-        return self.getOrMakeBattle(attacker=latestAttacker, defender=latestDefender,
-            handler=handler, requestId=requestId)
+        latestAttacker, latestDefender = latestUsers
+        return await self.getOrMakeBattle(attacker=latestAttacker, defender=latestDefender,
+            handler=handler, requestId=requestId, priority=priority)
+
+    def __saveBattleIfCurrent(self, attacker: UserSummary, defender: User,
+            battleCalcResults: BattleCalcResults, handler: str,
+            requestId: int) -> Optional[Tuple[FrozenUserSummary, FrozenUser]]:
+        """Saves a newly calculated battle if its inputs haven't changed.
+
+        Returns None if the battle was saved, otherwise the latest attacker and defender."""
+        with self.makeConnection() as conn:
+            # A single statement so the write lock is held just long enough to compare versions.
+            # It replaces any battle saved concurrently with the same inputs.
+            saved = conn.execute("""
+                INSERT OR REPLACE INTO battles (attackerUid, defenderUid, events, results, goldPerMinute)
+                SELECT :attackingUid, :defendingUid, :events, :results, :goldPerMinute
+                WHERE (SELECT waveVersion FROM users WHERE uid = :attackingUid) = :waveVersion
+                    AND (SELECT battlegroundVersion FROM users WHERE uid = :defendingUid) = :battlegroundVersion;""",
+                {
+                    "attackingUid": attacker.uid, "defendingUid": defender.uid,
+                    # Inserted straight from the worker's result buffer.
+                    "events": memoryview(battleCalcResults.fb.EventsAsNumpy()),
+                    "results": battleCalcResults.results.encodeFb(),
+                    "goldPerMinute": battleCalcResults.results.goldPerMinute,
+                    "waveVersion": attacker.waveVersion,
+                    "battlegroundVersion": defender.battlegroundVersion,
+                }
+            ).rowcount == 1
+        if saved:
+            self.logger.info(handler, requestId, f"Saved battle.")
+            return None
+        return self.__getLatestUsers(attacker, defender, handler, requestId)
+
+    def __getLatestUsers(self, attacker: UserSummary, defender: User, handler: str,
+            requestId: int) -> Optional[Tuple[FrozenUserSummary, FrozenUser]]:
+        "Returns the latest attacker and defender after their battle became stale, or None if either was deleted."
+        latestAttacker = self.getUserSummaryByUid(attacker.uid)
+        latestDefender = self.getUserByUid(defender.uid)
+        if latestAttacker is None or latestDefender is None:
+            self.logger.info(handler, requestId, f"{attacker.name} or {defender.name} no longer exists.")
+            return None
+        if latestAttacker.waveVersion != attacker.waveVersion:
+            self.logger.info(handler, requestId, f"Attacker {attacker.name}'s wave has changed. Recalculating.")
+        else:
+            self.logger.info(handler, requestId, f"Defender {defender.name}'s battleground has changed. Recalculating.")
+        return (latestAttacker, latestDefender)
 
     def clearInBattle(self):
         with self.makeConnection() as conn:
-            conn.execute("UPDATE users SET inBattle = FALSE;")
+            conn.execute(f"UPDATE users SET {self.SETTLE_GOLD}, inBattle = FALSE WHERE inBattle;")
             conn.commit()
 
     def updateUser(self, user: MutableUser):
@@ -459,8 +705,10 @@ class Db:
             user.conn.execute("""
                 UPDATE users SET
                     name = :name, gold = :gold, accumulatedGold = :accumulatedGold,
+                    goldSettledTick = """ + self.GOLD_TICK + """,
                     goldPerMinuteSelf = :goldPerMinuteSelf, goldPerMinuteOthers = :goldPerMinuteOthers, inBattle = :inBattle,
-                    wave = :wave, battleground = :battleground
+                    wave = :wave, waveVersion = waveVersion + :waveModified,
+                    battleground = :battleground, battlegroundVersion = battlegroundVersion + 1
                 WHERE uid = :uid""", {
                     "uid": user.uid,
                     "name": user.name,
@@ -471,6 +719,7 @@ class Db:
                     "goldPerMinuteOthers": 0.0,
                     "inBattle": user.inBattle,
                     "wave": json.dumps(user.wave),
+                    "waveModified": int(user.waveModified),
                     "battleground": user.battleground.to_json(),
                 })
 
@@ -480,8 +729,9 @@ class Db:
             user.conn.execute("""
                 UPDATE users SET
                     name = :name, gold = :gold, accumulatedGold = :accumulatedGold,
+                    goldSettledTick = """ + self.GOLD_TICK + """,
                     goldPerMinuteSelf = :goldPerMinuteSelf, goldPerMinuteOthers = :goldPerMinuteOthers, inBattle = :inBattle,
-                    wave = :wave
+                    wave = :wave, waveVersion = waveVersion + :waveModified
                 WHERE uid = :uid""", {
                     "uid": user.uid,
                     "name": user.name,
@@ -492,22 +742,57 @@ class Db:
                     "goldPerMinuteOthers": 0 if user.waveModified else user.goldPerMinuteOthers,
                     "inBattle": user.inBattle,
                     "wave": json.dumps(user.wave),
+                    "waveModified": int(user.waveModified),
                 })
         if user.waveModified:
             # Clear any battles where this user was attacking now that they have a different wave.
             user.conn.execute("DELETE from battles WHERE attackerUid = :uid", { "uid": user.uid })
+            user.conn.changes.waveVersions[user.uid] = user.waveVersion + 1
+        if user.battlegroundModified:
+            user.conn.changes.battlegroundVersions[user.uid] = user.battlegroundVersion + 1
+        if user.waveModified or user.battlegroundModified:
+            # Recalculate the battles which were just cleared.
+            self.__enqueueRivalBattles(user.conn, [user.name],
+                attacking = user.waveModified, defending = user.battlegroundModified)
 
         # There's no need to commit here as the calling function will do that.
 
     def enterTransaction(self, conn: Optional[sqlite3.Connection] = None) -> sqlite3.Connection:
         if conn is None:
-            conn = self.makeConnection()
+            conn = self.connectionPool.acquire()
         conn.execute("BEGIN IMMEDIATE")
         return conn
 
-    def leaveTransaction(self, conn):
+    def leaveTransaction(self, conn: TrackedConnection):
         assert conn.in_transaction is True
         conn.commit()
+        self.__flushChanges(conn)
+
+    async def enterUserTransaction(self, user: MutableUser):
+        """Begin a transaction for user from the event loop.
+
+        Transactions started this way are serialized by a lock so DB threads
+        never block waiting on each other's write locks."""
+        if self._writeLock is None:
+            self._writeLock = asyncio.Lock()
+        await self._writeLock.acquire()
+        try:
+            await self.run(self.enterTransaction, user.conn)
+        except BaseException:
+            self._writeLock.release()
+            raise
+
+    async def leaveUserTransaction(self, user: MutableUser):
+        "Write any changes to user and end a transaction started with enterUserTransaction."
+        try:
+            await self.run(self.__commitUser, user)
+        finally:
+            self._writeLock.release()
+
+    def __commitUser(self, user: MutableUser):
+        if user.summaryModified or user.battlegroundModified:
+            self.updateUser(user)
+        self.leaveTransaction(user.conn)
 
     def getMutableUserContext(self, uid: str) -> Optional['MutableUserContext']:
         user = self.getUnfrozenUserByUid(uid)
@@ -517,27 +802,30 @@ class Db:
 
     def resetBattles(self):
         with self.makeConnection() as conn:
-            conn.execute("DROP TABLE battles")
-
-        self.__createTables()
+            # Keep the table since migrations have set up its keys and indexes.
+            conn.execute("DELETE FROM battles;")
+            conn.execute("DELETE FROM battle_jobs;")
     
     async def resetGameData(self):
+        await self.run(self.__resetGameData)
+        await self.__updateAllListeners()
+
+    def __resetGameData(self):
         emptyBattleground = BattlegroundState.empty(self.gameConfig)
         with self.makeConnection() as conn:
             conn.execute("""
                 UPDATE users
                 SET 
                     battleground = :emptyBattleground, gold = :initialGold, accumulatedGold = :initialGold,
+                    goldSettledTick = """ + self.GOLD_TICK + """,
                     goldPerMinuteSelf = :goldPerMinuteSelf, goldPerMinuteOthers = 0, wave = '[]',
-                    inBattle = 0""",
+                    inBattle = 0, waveVersion = waveVersion + 1, battlegroundVersion = battlegroundVersion + 1""",
                 {
                     "emptyBattleground": emptyBattleground.to_json(),
                     "initialGold": self.gameConfig.misc.startingGold,
                     "goldPerMinuteSelf": self.gameConfig.misc.minGoldPerMinute,
                 })
             self.resetBattles()
-
-        await self.__updateAllListeners()
     
     def deleteAccount(self, uid: str):
         with self.makeConnection() as conn:
@@ -547,64 +835,127 @@ class Db:
             conn.execute(
                 "DELETE FROM battles WHERE attackerUid = :uid OR defenderUid = :uid",
                 { "uid": uid })
+            conn.execute(
+                "DELETE FROM battle_jobs WHERE attackerUid = :uid OR defenderUid = :uid",
+                { "uid": uid })
     
     def getUserRivals(self, username: str) -> Rivals:
-        rivalRadius = self.gameConfig.misc.rivalRadius
-        query = "SELECT * FROM (SELECT "
-        for i in range(rivalRadius, 0, -1):
-            query += f"lag(name, {i}) OVER win as ahead_{i}, "
-        query += "name as name, "
-        for i in range(1, rivalRadius + 1):
-            query += f"lead(name, {i}) OVER win as behind_{i}, "
-        query = query[:-2]
-        query += " FROM users WINDOW win AS (ORDER BY accumulatedGold DESC)) WHERE name = :name ;"
-        with self.makeConnection() as conn:
-            res = conn.execute("SELECT * FROM users ORDER BY accumulatedGold DESC;")
-            res = conn.execute(query, { "name": username }).fetchone()
-        aheadRivals = [x for x in res[:rivalRadius] if x is not None]
-        behindRivals = [x for x in res[-rivalRadius:] if x is not None]
+        with self.leaderboardLock:
+            if username not in self.leaderboard:
+                raise ValueError(f"Unknown user: {username}")
+            (aheadRivals, behindRivals) = self.leaderboard.around(username, self.gameConfig.misc.rivalRadius)
         return Rivals(aheadRivals, behindRivals)
     
     def printUsers(self):
         "Print the users table for debugging."
-        with self.makeConnection() as conn:
-            res = conn.execute(self.SELECT_USER_SUMMARY_STATEMENT + " ORDER BY accumulatedGold DESC;")
-        for row in res:
-            print(self.__extractUserSummaryFromRow(row))
+        for user in self.getUsers():
+            print(user)
+
+    def __rivalPairs(self, rankedUsers: List[RankedUser]) -> Iterator[Tuple[RankedUser, RankedUser]]:
+        "Yields every attacker and defender within rivalRadius ranks of each other."
+        rivalRadius = self.gameConfig.misc.rivalRadius
+        for (rank, attacker) in enumerate(rankedUsers):
+            if attacker.emptyWave:
+                continue
+            for defender in rankedUsers[max(rank - rivalRadius, 0):rank + rivalRadius + 1]:
+                yield (attacker, defender)
 
     def findMissingBattles(self) -> List[Tuple[str, str]]:
         "Calculate all missing battles between rivals."
+        with self.leaderboardLock:
+            # Users in a battle don't count towards anyone's rivals here.
+            rankedUsers = [user for (_, user) in self.leaderboard.items() if not user.inBattle]
+        # Only attackers with a wave have rivals to look up battles for.
+        attackerUids = [user.uid for user in rankedUsers if not user.emptyWave]
+        existingBattles: Set[Tuple[str, str]] = set()
         with self.makeConnection() as conn:
-            res = conn.execute("""
-                WITH users_and_ranks AS (
-                    SELECT
-                        uid,
-                        row_number() OVER (ORDER BY accumulatedGold DESC) as rank,
-                        wave = "[]" as empty_wave
-                    FROM
-                        users
-                    WHERE
-                        inBattle = FALSE
-                )
-                SELECT
-                    attackerUid, defenderUid
-                FROM
-                    (SELECT
-                        u1.uid as attackerUid, 
-                        u2.uid as defenderUid
-                    FROM
-                        users_and_ranks as u1, users_and_ranks as u2
-                    WHERE
-                        abs(u1.rank - u2.rank) <= :rivalRadius
-                        AND u1.empty_wave = FALSE
-                    ) LEFT JOIN
-                    battles USING (attackerUid, defenderUid)
-                WHERE
-                    events IS NULL
-            ;""", { "rivalRadius": self.gameConfig.misc.rivalRadius })
-        missingBattleUids = [(row[0], row[1]) for row in res]
+            for i in range(0, len(attackerUids), self.MAX_PARAMS_PER_QUERY):
+                batch = attackerUids[i:i + self.MAX_PARAMS_PER_QUERY]
+                # This only reads the primary key index, never the battles themselves.
+                existingBattles.update(conn.execute(
+                    "SELECT attackerUid, defenderUid FROM battles "
+                    f"WHERE attackerUid IN ({self.__placeholders(batch)});", batch))
+        missingBattleUids = []
+        for (attacker, defender) in self.__rivalPairs(rankedUsers):
+            if (attacker.uid, defender.uid) not in existingBattles:
+                missingBattleUids.append((attacker.uid, defender.uid))
         return missingBattleUids
-    
+
+    def enqueueBattleJobs(self, battles: Iterable[Tuple[str, str]],
+            priority: BattlePriority = BattlePriority.BACKGROUND, conn: Optional[sqlite3.Connection] = None):
+        """Queue (attacker UID, defender UID) battles to be calculated.
+
+        Battles which already exist or have no wave to attack with are skipped.
+        Queueing a battle again keeps the more urgent priority."""
+        if conn is None:
+            with self.makeConnection() as conn:
+                return self.enqueueBattleJobs(battles, priority, conn)
+        # The SELECT needs a WHERE clause to be parsed as an upsert.
+        conn.executemany("""
+            INSERT INTO battle_jobs (attackerUid, defenderUid, state, priority)
+            SELECT :attackerUid, :defenderUid, 'queued', :priority
+            WHERE (SELECT wave FROM users WHERE uid = :attackerUid) <> '[]'
+                AND EXISTS (SELECT * FROM users WHERE uid = :defenderUid)
+                AND NOT EXISTS (SELECT * FROM battles
+                    WHERE attackerUid = :attackerUid AND defenderUid = :defenderUid)
+            ON CONFLICT (attackerUid, defenderUid) DO UPDATE SET
+                priority = CASE WHEN state = 'queued' THEN MIN(priority, excluded.priority)
+                    ELSE excluded.priority END,
+                state = 'queued', version = version + 1;""",
+            [{"attackerUid": attackerUid, "defenderUid": defenderUid, "priority": priority.value}
+                for (attackerUid, defenderUid) in battles])
+
+    def __enqueueRivalBattles(self, conn: sqlite3.Connection, names: Iterable[str],
+            attacking: bool = True, defending: bool = True):
+        "Queue battles between the named users and their rivals."
+        rivalRadius = self.gameConfig.misc.rivalRadius
+        battles: Set[Tuple[str, str]] = set()
+        with self.leaderboardLock:
+            for name in names:
+                user = self.leaderboard.get(name)
+                if user is None:
+                    continue
+                (ahead, behind) = self.leaderboard.around(name, rivalRadius)
+                for rivalName in ahead + behind + [name]:
+                    rival = self.leaderboard.get(rivalName)
+                    if attacking:
+                        battles.add((user.uid, rival.uid))
+                    if defending:
+                        battles.add((rival.uid, user.uid))
+        if battles:
+            self.enqueueBattleJobs(battles, conn = conn)
+
+    def claimBattleJobs(self, count: int) -> List[BattleJob]:
+        "Mark up to count of the most urgent queued jobs as running and return them."
+        with self.makeConnection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            jobs = [BattleJob(row[0], row[1], BattlePriority(row[2]), row[3]) for row in conn.execute(
+                "SELECT attackerUid, defenderUid, priority, version FROM battle_jobs "
+                "WHERE state = 'queued' ORDER BY priority, rowid LIMIT ?;", (count, ))]
+            conn.executemany(
+                "UPDATE battle_jobs SET state = 'running' WHERE attackerUid = ? AND defenderUid = ?;",
+                [(job.attackerUid, job.defenderUid) for job in jobs])
+        return jobs
+
+    def finishBattleJob(self, job: BattleJob, state: BattleJobState):
+        "Record the outcome of a claimed job unless it has been queued again since."
+        with self.makeConnection() as conn:
+            conn.execute(
+                "UPDATE battle_jobs SET state = :state WHERE attackerUid = :attackerUid "
+                "AND defenderUid = :defenderUid AND state = 'running' AND version = :version;",
+                {"state": state.value, "attackerUid": job.attackerUid, "defenderUid": job.defenderUid,
+                    "version": job.version})
+
+    def requeueRunningBattleJobs(self) -> int:
+        "Queue jobs which were running when the server last stopped. Returns how many there were."
+        with self.makeConnection() as conn:
+            return conn.execute("UPDATE battle_jobs SET state = 'queued' WHERE state = 'running';").rowcount
+
+    def getBattleJobCounts(self) -> Dict[str, int]:
+        with self.makeConnection() as conn:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM battle_jobs GROUP BY state;"))
+        return {state.value: counts.get(state.value, 0) for state in BattleJobState}
+
     def addTestBattle(self, attackingUid, defendingUid, goldPerMinute = 0.0):
         testBattleResults = BattleResults(
             monstersDefeated={},
@@ -619,7 +970,7 @@ class Db:
             results=testBattleResults)
         with self.makeConnection() as conn:
             conn.execute(
-                "INSERT INTO battles (attackerUid, defenderUid, events, results, goldPerMinute) "
+                "INSERT OR REPLACE INTO battles (attackerUid, defenderUid, events, results, goldPerMinute) "
                 "VALUES (:attackingUid, :defendingUid, :events, :results, :goldPerMinute);",
                 {
                     "attackingUid": attackingUid, "defendingUid": defendingUid,
@@ -630,60 +981,76 @@ class Db:
             )
 
     def updateGoldPerMinuteOthers(self):
-        "Update goldPerMinuteOthers for all users."
+        """Update goldPerMinuteOthers for all users.
+
+        Only users whose rate changed are written, since writing settles their gold."""
+        with self.leaderboardLock:
+            rankedUsers = [user for (_, user) in self.leaderboard.items()]
         with self.makeConnection() as conn:
-            conn.execute("""
-                WITH new_values AS (
-                    WITH users_and_ranks AS (
-                        SELECT
-                            uid,
-                            row_number() OVER (ORDER BY accumulatedGold DESC) as rank,
-                            wave = "[]" as empty_wave
-                        FROM
-                            users
-                    )
-                    SELECT
-                        defenderUid,
-                        SUM(goldPerMinute) * :rivalMultiplier as newGoldPerMinuteOthers
-                    FROM
-                        (SELECT
-                            u1.uid as attackerUid, 
-                            u2.uid as defenderUid
-                        FROM
-                            users_and_ranks as u1, users_and_ranks as u2
-                        WHERE TRUE
-                            AND u1.uid != u2.uid
-                            AND abs(u1.rank - u2.rank) <= :rivalRadius
-                            AND u1.empty_wave = FALSE
-                        ) LEFT JOIN
-                        battles USING (attackerUid, defenderUid)
-                    WHERE
-                        goldPerMinute > 0
-                    GROUP BY defenderUid
-                )
-                UPDATE users
-                SET goldPerMinuteOthers = new_values.newGoldPerMinuteOthers
-                FROM new_values
-                WHERE new_values.defenderUid = users.uid
-            ;""", {
-                "rivalRadius": self.gameConfig.misc.rivalRadius,
-                "rivalMultiplier": self.gameConfig.misc.rivalMultiplier,
-            })
+            conn.execute("BEGIN IMMEDIATE")
+            battleGpms = {(row[0], row[1]): row[2] for row in conn.execute(
+                "SELECT attackerUid, defenderUid, goldPerMinute FROM battles WHERE goldPerMinute > 0;")}
+            totalGpms: Dict[str, float] = {}
+            for (attacker, defender) in self.__rivalPairs(rankedUsers):
+                gpm = battleGpms.get((attacker.uid, defender.uid))
+                if gpm is not None and attacker.uid != defender.uid:
+                    totalGpms[defender.uid] = totalGpms.get(defender.uid, 0.0) + gpm
+            conn.executemany(
+                f"UPDATE users SET goldPerMinuteOthers = :goldPerMinuteOthers, {self.SETTLE_GOLD} "
+                "WHERE uid = :uid AND goldPerMinuteOthers != :goldPerMinuteOthers;",
+                [{"uid": uid, "goldPerMinuteOthers": totalGpm * self.gameConfig.misc.rivalMultiplier}
+                    for (uid, totalGpm) in totalGpms.items()])
 
 
 class MutableUserContext:
+    """Modifies a user within a transaction.
+
+    A connection is only taken from the pool once the context is entered."""
     db: Db
     mutableUser: MutableUser
 
     def __init__(self, user: User, db: Db):
         self.db = db
-        self.mutableUser = MutableUser(user, self.db.makeConnection())
+        self.mutableUser = MutableUser(user, None)
+
+    def __acquireConnection(self) -> sqlite3.Connection:
+        conn = self.db.connectionPool.acquire()
+        object.__setattr__(self.mutableUser, 'conn', conn)
+        return conn
+
+    def __releaseConnection(self):
+        # Hand the connection back to the pool.
+        self.db.releaseConnection(self.mutableUser.conn)
+        object.__setattr__(self.mutableUser, 'conn', None)
 
     def __enter__(self):
-        self.db.enterTransaction(self.mutableUser.conn)
+        conn = self.__acquireConnection()
+        try:
+            self.db.enterTransaction(conn)
+        except BaseException:
+            self.__releaseConnection()
+            raise
         return self.mutableUser
 
     def __exit__(self, type, value, traceback):
-        if self.mutableUser.summaryModified or self.mutableUser.battlegroundModified:
-            self.db.updateUser(user = self.mutableUser)
-        self.db.leaveTransaction(self.mutableUser.conn)
+        try:
+            if self.mutableUser.summaryModified or self.mutableUser.battlegroundModified:
+                self.db.updateUser(user = self.mutableUser)
+            self.db.leaveTransaction(self.mutableUser.conn)
+        finally:
+            self.__releaseConnection()
+
+    async def __aenter__(self):
+        self.__acquireConnection()
+        try:
+            await self.db.enterUserTransaction(self.mutableUser)
+        except BaseException:
+            self.__releaseConnection()
+            raise
+        return self.mutableUser
+
+    async def __aexit__(self, type, value, traceback):
+        try:
+            await self.db.leaveUserTransaction(self.mutableUser)
+        finally:
+            self.__releaseConnection()
@@ -1,20 +1,24 @@
 import asyncio
 import copy
-from typing import List, Optional, Awaitable, Callable, Dict
+from typing import Any, List, Optional, Awaitable, Callable, Dict, Set
 import math
+import time
 
 import firebase_admin.auth
 
 from infinitd_server.battle import Battle, BattleResults
 from infinitd_server.battle_computer import BattleCalculationException
+from infinitd_server.battle_computer_pool import BattlePriority
 from infinitd_server.battleground_state import BattlegroundState, BgTowerState
 from infinitd_server.battle_coordinator import BattleCoordinator
-from infinitd_server.db import Db, MutableUserContext
+from infinitd_server.db import BattleJob, BattleJobState, Db, MutableUserContext
 from infinitd_server.game_config import GameConfig, ConfigId
 from infinitd_server.logger import Logger
-from infinitd_server.sse import SseQueues
+from infinitd_server.pubsub import PubSub
+from infinitd_server.sse import SseQueues, QueuePolicy
 from infinitd_server.user import User, FrozenUser, FrozenUserSummary, MutableUser
 from infinitd_server.paths import pathExists
+from infinitd_server.remote_battle_worker import Address
 from infinitd_server.rivals import Rivals
 
 class UserInBattleException(Exception):
@@ -38,6 +42,16 @@ class UserMatchingError(Exception):
         return f"Expected username {self.expectedName}, got username {self.actualName}."
 
 GOLD_EPSILON = 0.09 # Handle floating point errors by being slightly lenient on the client
+# How each stream catches up subscribers which fall behind. Battles resync
+# from a snapshot; every other update is the whole state.
+QUEUE_POLICIES = {
+    "battle": QueuePolicy.RESYNC,
+    "battleFrames": QueuePolicy.RESYNC,
+    "battleground": QueuePolicy.LATEST,
+    "user": QueuePolicy.LATEST,
+    "rivals": QueuePolicy.LATEST,
+    "battleGpm": QueuePolicy.LATEST,
+}
 
 class Game:
 
@@ -45,17 +59,26 @@ class Game:
     queues: Dict[str, SseQueues]
     _battleCoordinator: BattleCoordinator
     _db: Db
-
-    def __init__(self, gameConfig: GameConfig, debug: bool = False, dbPath = None):
+    # How many battle jobs are calculated at once, and for how long
+    # processBattleJobs keeps claiming new ones.
+    maxConcurrentBattleJobs: int = 32
+    battleJobsBudgetSecs: float = 45.0
+    _processingBattleJobs: bool = False
+    # Battle jobs still being calculated, possibly from an earlier call.
+    _battleJobTasks: Set[asyncio.Future]
+
+    def __init__(self, gameConfig: GameConfig, debug: bool = False, dbPath = None,
+            pubsub: Optional[PubSub] = None):
         self.gameConfig = gameConfig
         self.logger = Logger.getDefault()
+        self._battleJobTasks = set()
 
         # Make queues for streams
         self.queues = {}
-        for datatype in ["battle", "battleground", "user", "rivals", "battleGpm"]:
-            self.queues[datatype] = SseQueues()
+        for (datatype, policy) in QUEUE_POLICIES.items():
+            self.queues[datatype] = SseQueues(datatype, pubsub, policy)
 
-        self.battleCoordinator = BattleCoordinator(self.queues["battle"])
+        self.battleCoordinator = BattleCoordinator(self.queues["battle"], self.queues["battleFrames"])
         self._db = Db(
                 gameConfig = self.gameConfig,
                 userQueues = self.queues["user"],
@@ -64,41 +87,46 @@ class Game:
                 battleGpmQueues = self.queues["battleGpm"],
                 battleCoordinator = self.battleCoordinator,
                 debug=debug,
-                dbPath = dbPath)
+                dbPath = dbPath,
+                pubsub = pubsub)
+
+    async def getUserSummaries(self, start: int = 0, count: Optional[int] = None) -> List[FrozenUserSummary]:
+        return await self._db.run(self._db.getUsers, start, count)
 
-    def getUserSummaries(self) -> List[FrozenUserSummary]:
-        return self._db.getUsers()
+    async def getUserSummaryByName(self, name: str) -> Optional[FrozenUserSummary]:
+        return await self._db.run(self._db.getUserSummaryByName, name)
 
-    def getUserSummaryByName(self, name: str) -> Optional[FrozenUserSummary]:
-        return self._db.getUserSummaryByName(name)
+    async def getUserSummaryByUid(self, uid: str) -> Optional[FrozenUserSummary]:
+        return await self._db.run(self._db.getUserSummaryByUid, uid)
 
-    def getUserSummaryByUid(self, uid: str) -> Optional[FrozenUserSummary]:
-        return self._db.getUserSummaryByUid(uid)
+    async def getUserByName(self, name: str) -> Optional[User]:
+        return await self._db.run(self._db.getUserByName, name)
 
-    def getUserByName(self, name: str) -> Optional[User]:
-        return self._db.getUserByName(name)
+    async def getUserByUid(self, uid: str) -> Optional[User]:
+        return await self._db.run(self._db.getUserByUid, uid)
 
-    def getUserByUid(self, uid: str) -> Optional[User]:
-        return self._db.getUserByUid(uid)
+    async def getMutableUserContext(self, uid: str, expectedName: str) -> MutableUserContext:
+        """Returns a context for modifying a user.
 
-    def getMutableUserContext(self, uid: str, expectedName: str) -> MutableUserContext:
-        mutableUserContext = self._db.getMutableUserContext(uid)
-        if mutableUserContext is None:
+        It must be used with async with so the transaction is managed off the
+        event loop."""
+        user = await self._db.run(self._db.getUnfrozenUserByUid, uid)
+        if user is None:
             raise ValueError(f"User with UID = {uid} not found.")
         # Compare against expected name
-        if mutableUserContext.mutableUser.name != expectedName:
-            raise UserMatchingError(actualName = mutableUserContext.mutableUser.name, expectedName = expectedName)
+        if user.name != expectedName:
+            raise UserMatchingError(actualName = user.name, expectedName = expectedName)
         # Build mutable user context
-        return mutableUserContext
+        return await self._db.run(MutableUserContext, user, self._db)
 
-    def register(self, uid: str, name: str, admin: bool = False) -> bool:
+    async def register(self, uid: str, name: str, admin: bool = False) -> bool:
         # Require name to be between 2-15 characters
         if len(name) < 2 or len(name) > 15:
             raise ValueError(f"Name must have between 2-15 character. {name} contains {len(name)}.")
-        self._db.register(uid=uid, name=name, admin=admin)
+        await self._db.run(self._db.register, uid=uid, name=name, admin=admin)
 
-    def getBattleground(self, name: str) -> BattlegroundState:
-        return self._db.getBattleground(name)
+    async def getBattleground(self, name: str) -> BattlegroundState:
+        return await self._db.run(self._db.getBattleground, name)
 
     def buildTowers(self, user: MutableUser, rows: int, cols: int, towerIds: int):
         if user.inBattle:
@@ -192,8 +220,11 @@ class Game:
 
         user.wave = []
 
-    def joinBattle(self, name: str):
-        return self.battleCoordinator.getBattle(name).join()
+    async def joinBattle(self, name: str, reset: bool = False):
+        return await self.battleCoordinator.join(name, reset)
+
+    async def joinBattleFrames(self, name: str, reset: bool = False):
+        return await self.battleCoordinator.join(name, reset, frames = True)
 
     async def startBattle(self, defender: MutableUser, attacker: FrozenUserSummary,
             handler: str, requestId: int):
@@ -204,30 +235,32 @@ class Game:
         # Manually update the user and end the transaction while the battle is
         # calculated. Since the user is marked as in battle none of their data
         # can change even outside of the transaction.
-        self._db.updateUser(defender)
-        self._db.leaveTransaction(defender.conn)
+        await self._db.leaveUserTransaction(defender)
 
         try:
             battle = await self._db.getOrMakeBattle(
-                attacker = attacker, defender = defender.user, handler=handler, requestId=requestId)
-        except BattleCalculationException as e:
-            self._db.enterTransaction(defender.conn)
+                attacker = attacker, defender = defender.user, handler=handler, requestId=requestId,
+                priority = BattlePriority.INTERACTIVE)
+        except BaseException:
+            # Even if cancelled, the user context expects to be in a
+            # transaction when it exits.
+            await self._db.enterUserTransaction(defender)
             # Prevent a user from getting stuck in a battle
             defender.inBattle = False
-            raise e
+            raise
 
         # We need this because the user context is expecting to be in a
         # transaction at the end.
-        self._db.enterTransaction(defender.conn)
+        await self._db.enterUserTransaction(defender)
 
-        def setUserNotInBattleCallback():
-            self._db.setUserNotInBattle(uid=defender.uid, name=defender.name)
+        async def setUserNotInBattleCallback():
+            await self._db.run(self._db.setUserNotInBattle, uid=defender.uid, name=defender.name)
 
-        def updateWithBattleResults(results: BattleResults):
-            userContext = self._db.getMutableUserContext(defender.uid)
+        async def updateWithBattleResults(results: BattleResults):
+            userContext = await self._db.run(self._db.getMutableUserContext, defender.uid)
             if userContext is None:
                 raise ValueError(f"UID {defender.uid} doesn't correspond to a user.")
-            with userContext as futureUser:
+            async with userContext as futureUser:
                 # Ensure user is in a battle when this is called.
                 if not futureUser.inBattle:
                     raise ValueError(f"User {defender.name} isn't in a battle.")
@@ -247,20 +280,41 @@ class Game:
                 endCallback = setUserNotInBattleCallback,
                 handler = handler, requestId = requestId)
 
-    def getBattle(self, attacker: FrozenUserSummary, defender: FrozenUserSummary) -> Optional[Battle]:
+    def getBattleComputerStats(self) -> Dict[str, Any]:
+        "Queue depths and wait times of battles waiting to be calculated."
+        return self._db.battleComputerPool.getStats()
+
+    def getStreamStats(self) -> Dict[str, Any]:
+        "Subscriptions and live battles kept for streams in this process."
+        return {
+            "queues": {datatype: queues.getStats() for (datatype, queues) in self.queues.items()},
+            "battles": self.battleCoordinator.getStats(),
+        }
+
+    def evictIdleBattles(self) -> int:
+        return self.battleCoordinator.evictIdleBattles()
+
+    def addBattleWorker(self, address: Address):
+        "Also calculate battles on the battle worker daemon at address."
+        self._db.battleComputerPool.addRemoteWorker(address)
+
+    async def getBattleJobCounts(self) -> Dict[str, int]:
+        "How many battle jobs are in each state."
+        return await self._db.run(self._db.getBattleJobCounts)
+
+    async def getBattle(self, attacker: FrozenUserSummary, defender: FrozenUserSummary) -> Optional[Battle]:
         """Attempts to get a battle if it exists."""
-        with self._db.makeConnection() as conn:
-            return self._db.getBattle(attacker, defender, conn)
+        return await self._db.run(self._db.getBattle, attacker, defender)
 
     async def getOrMakeRecordedBattle(self, attackerName: str, defenderName: str, handler: str, requestId: int) -> Battle:
-        attacker = self._db.getUserSummaryByName(attackerName)
+        attacker = await self._db.run(self._db.getUserSummaryByName, attackerName)
         if attacker is None:
             raise ValueError(f"Unknown attacker: {attackerName}")
-        defender = self._db.getUserByName(defenderName)
+        defender = await self._db.run(self._db.getUserByName, defenderName)
         if defender is None:
             raise ValueError(f"Unknown defender: {defenderName}")
         battle = await self._db.getOrMakeBattle(attacker = attacker, defender = defender,
-                handler = handler, requestId = requestId)
+                handler = handler, requestId = requestId, priority = BattlePriority.VIEW)
         return battle
 
     async def stopBattle(self, user: MutableUser):
@@ -285,33 +339,93 @@ class Game:
         self._db.resetBattles()
 
     async def resetGameData(self, uid: str):
-        user = self._db.getUserSummaryByUid(uid)
+        user = await self._db.run(self._db.getUserSummaryByUid, uid)
         if not user.admin:
             raise UserNotAdminException()
         await self._db.resetGameData()
     
-    def deleteAccount(self, uid: str):
-        self._db.deleteAccount(uid)
+    async def deleteAccount(self, uid: str):
+        await self._db.run(self._db.deleteAccount, uid)
         firebase_admin.auth.delete_user(uid)
     
-    def getUserRivals(self, username: str) -> Rivals:
-        return self._db.getUserRivals(username)
+    async def getUserRivals(self, username: str) -> Rivals:
+        return await self._db.run(self._db.getUserRivals, username)
     
     async def calculateMissingBattles(self, requestId = -1):
-        self.logger.info("calculate_missing_battles", requestId, "Finding missing battles.")
-        missingBattles = self._db.findMissingBattles()
-        awaitables = []
-        for (attackerUid, defenderUid) in missingBattles:
-            attacker = self._db.getUserSummaryByUid(attackerUid)
-            defender = self._db.getUserByUid(defenderUid)
-            awaitables.append(self._db.getOrMakeBattle(
-                attacker, defender,
-                requestId = requestId,
-                handler = "calculate_missing_battles"))
-        self.logger.info("calculate_missing_battles", requestId, "Calculating missing battles.")
-        if awaitables:
-            await asyncio.wait(awaitables)
-        self._db.updateGoldPerMinuteOthers()
+        """Queue any battles between rivals which are missing and calculate them.
+
+        Changes to waves, battlegrounds and rivals already queue their battles,
+        so this only catches up on anything which slipped through."""
+        handler = "calculate_missing_battles"
+        self.logger.info(handler, requestId, "Finding missing battles.")
+        missingBattles = await self._db.run(self._db.findMissingBattles)
+        self.logger.info(handler, requestId, f"Queueing {len(missingBattles)} missing battles.")
+        await self._db.run(self._db.enqueueBattleJobs, missingBattles)
+        await self.processBattleJobs(requestId)
+
+        await self._db.run(self._db.updateGoldPerMinuteOthers)
         # We intentionally don't update goldPerMinute self so players are
         # required to watch their battles themselves.
-        self.logger.info("calculate_missing_battles", requestId, "Done.")
\ No newline at end of file
+        self.logger.info(handler, requestId, "Done.")
+
+    def resumeBattleJobs(self):
+        "Queue battle jobs which were interrupted when the server last stopped."
+        numResumed = self._db.requeueRunningBattleJobs()
+        if numResumed > 0:
+            self.logger.info("battle_jobs", -1, f"Resuming {numResumed} interrupted battle jobs.")
+
+    async def processBattleJobs(self, requestId = -1):
+        """Calculate queued battle jobs, most urgent first.
+
+        Stops claiming jobs once there are none left or battleJobsBudgetSecs
+        has passed. Jobs which weren't claimed wait for the next call, and
+        jobs still running are left to finish in the background."""
+        if self._processingBattleJobs:
+            return # The running call will pick up any new jobs.
+        self._processingBattleJobs = True
+        try:
+            await self.__processBattleJobs(requestId)
+        finally:
+            self._processingBattleJobs = False
+
+    async def __processBattleJobs(self, requestId: int):
+        handler = "battle_jobs"
+        deadline = time.monotonic() + self.battleJobsBudgetSecs
+        # Jobs left running by an earlier call count against the limit.
+        running = self._battleJobTasks
+        numClaimed = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if len(running) < self.maxConcurrentBattleJobs:
+                jobs = await self._db.run(self._db.claimBattleJobs, self.maxConcurrentBattleJobs - len(running))
+                if jobs:
+                    numClaimed += len(jobs)
+                    # Look up the users for every claimed job at once.
+                    users = await self._db.run(self._db.getUsersByUids,
+                        {uid for job in jobs for uid in (job.attackerUid, job.defenderUid)})
+                    for job in jobs:
+                        task = asyncio.ensure_future(self.__runBattleJob(job, users, handler, requestId))
+                        running.add(task)
+                        task.add_done_callback(running.discard)
+                    continue
+            if not running:
+                break
+            await asyncio.wait(running, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+        if numClaimed > 0:
+            self.logger.info(handler, requestId, f"Claimed {numClaimed} battle jobs.")
+        if running:
+            self.logger.info(handler, requestId, f"Leaving {len(running)} battle jobs running past the time budget.")
+
+    async def __runBattleJob(self, job: BattleJob, users: Dict[str, FrozenUser], handler: str, requestId: int):
+        try:
+            if job.attackerUid not in users or job.defenderUid not in users:
+                raise ValueError(f"{job.attackerUid} or {job.defenderUid} no longer exists.")
+            await self._db.getOrMakeBattle(users[job.attackerUid], users[job.defenderUid],
+                handler = handler, requestId = requestId, priority = job.priority)
+        except Exception as e:
+            self.logger.warn(handler, requestId, f"Error calculating battle job: {e}")
+            await self._db.run(self._db.finishBattleJob, job, BattleJobState.FAILED)
+            return
+        await self._db.run(self._db.finishBattleJob, job, BattleJobState.DONE)
@@ -78,10 +78,10 @@ class BaseHandler(tornado.web.RequestHandler):
             self.reply401()
         return self.uid
 
-    def getMutableUser(self, expectedName: str) -> MutableUserContext:
+    async def getMutableUser(self, expectedName: str) -> MutableUserContext:
         uid = self.verifyAuthentication()
         try:
-            return self.game.getMutableUserContext(uid = uid, expectedName = expectedName)
+            return await self.game.getMutableUserContext(uid = uid, expectedName = expectedName)
         except UserMatchingError as e:
             self.logWarn(str(e))
             self.set_status(403) # Forbidden
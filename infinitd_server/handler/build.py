@@ -9,7 +9,7 @@ from infinitd_server.handler.base import BaseHandler
 class BuildHandler(BaseHandler):
     game: Game # See https://github.com/google/pytype/issues/652
 
-    def post(self, name: str):
+    async def post(self, name: str):
         try:
             data = tornado.escape.json_decode(self.request.body)
         except json.decoder.JSONDecodeError:
@@ -42,7 +42,8 @@ class BuildHandler(BaseHandler):
             self.set_status(400) # Bad request
             return
 
-        with self.getMutableUser(expectedName=name) as user:
+        userContext = await self.getMutableUser(expectedName=name)
+        async with userContext as user:
             try:
                 self.game.buildTowers(user = user, rows = rows, cols = cols, towerIds = towerIds)
             except UserInBattleException as e:
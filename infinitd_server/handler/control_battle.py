@@ -9,9 +9,10 @@ class ControlBattleHandler(BaseHandler):
     async def post(self, defenderName: str, attackerName: str):
         self.logInfo(f"Got POST request for controlBattle/{defenderName}/{attackerName}")
 
-        with self.getMutableUser(expectedName=defenderName) as defender:
+        defenderContext = await self.getMutableUser(expectedName=defenderName)
+        async with defenderContext as defender:
             # Attempt to start a battle
-            attacker = self.game.getUserSummaryByName(attackerName)
+            attacker = await self.game.getUserSummaryByName(attackerName)
             try:
                 await self.game.startBattle(defender = defender, attacker = attacker,
                         handler = self.__class__.__name__, requestId = self.requestId)
@@ -32,7 +33,8 @@ class ControlBattleHandler(BaseHandler):
         self.logInfo(f"Got DELETE request for controlBattle/{attackerName}/{defenderName}")
         # Note: We ignore the attackerName parameter here.
 
-        with self.getMutableUser(expectedName=defenderName) as defender:
+        defenderContext = await self.getMutableUser(expectedName=defenderName)
+        async with defenderContext as defender:
             # Attempt to stop the battle
             try:
                 await self.game.stopBattle(defender)
@@ -0,0 +1,10 @@
+from infinitd_server.game import Game
+from infinitd_server.handler.base import BaseHandler
+
+class DebugBattleQueuesHandler(BaseHandler):
+    game: Game # See https://github.com/google/pytype/issues/652
+
+    async def get(self):
+        stats = self.game.getBattleComputerStats()
+        stats["jobs"] = await self.game.getBattleJobCounts()
+        self.write(stats)
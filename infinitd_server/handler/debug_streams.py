@@ -0,0 +1,11 @@
+from infinitd_server.game import Game
+from infinitd_server.handler.base import BaseHandler
+from infinitd_server.handler.stream import StreamHandler
+
+class DebugStreamsHandler(BaseHandler):
+    game: Game # See https://github.com/google/pytype/issues/652
+
+    def get(self):
+        stats = self.game.getStreamStats()
+        stats["numSlowDisconnects"] = StreamHandler.numSlowDisconnects
+        self.write(stats)
@@ -8,12 +8,12 @@ class DeleteAccountHandler(BaseHandler):
 
     async def delete(self, name: str):
         uid = self.verifyAuthentication()
-        user = self.game.getUserSummaryByUid(uid)
+        user = await self.game.getUserSummaryByUid(uid)
         if name != user.name:
             self.logWarn(f"Got request to delete {name} from incorrect UID {uid}.")
             self.set_status(403) # Forbidden
             raise tornado.web.Finish()
 
-        self.game.deleteAccount(uid)
+        await self.game.deleteAccount(uid)
         self.logInfo("Game reset successfully.")
         self.set_status(204) # No Content
\ No newline at end of file
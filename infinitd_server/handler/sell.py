@@ -8,7 +8,7 @@ from infinitd_server.handler.base import BaseHandler
 class SellHandler(BaseHandler):
     game: Game # See https://github.com/google/pytype/issues/652
 
-    def post(self, name: str):
+    async def post(self, name: str):
         try:
             data = tornado.escape.json_decode(self.request.body)
         except json.decoder.JSONDecodeError:
@@ -35,7 +35,8 @@ class SellHandler(BaseHandler):
             self.set_status(400) # Bad request
             return
 
-        with self.getMutableUser(expectedName=name) as user:
+        userContext = await self.getMutableUser(expectedName=name)
+        async with userContext as user:
             try:
                 self.game.sellTowers(user=user, rows=rows, cols=cols)
             except (ValueError, UserInBattleException)  as e:
@@ -44,7 +45,7 @@ class SellHandler(BaseHandler):
                 self.write(str(e))
                 return
 
-    def delete(self, name: str, rowStr: str, colStr: str):
+    async def delete(self, name: str, rowStr: str, colStr: str):
         try:
             row = int(rowStr)
             col = int(colStr)
@@ -54,7 +55,8 @@ class SellHandler(BaseHandler):
             return
         self.logInfo(f"Got request for sell/{name}/{row}/{col}")
 
-        with self.getMutableUser(expectedName=name) as user:
+        userContext = await self.getMutableUser(expectedName=name)
+        async with userContext as user:
             # Check that the row and column are within the playfield
             if row < 0 or row >= self.game.gameConfig.playfield.numRows:
                 self.logWarn(f"Got invalid sell request for row {row} of {self.game.gameConfig.playfield.numRows}.")
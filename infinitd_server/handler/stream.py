@@ -1,27 +1,47 @@
 import asyncio
-from typing import Optional, ClassVar, Awaitable, Callable, List, Dict
-import json
+from typing import Optional, ClassVar, Awaitable, Callable, List, Dict, Union
 
-from dataclasses_json import DataClassJsonMixin
-from tornado.websocket import WebSocketHandler
-import cattr
-from asyncio_multisubscriber_queue import MultisubscriberQueue
+from tornado.websocket import WebSocketHandler, WebSocketClosedError
 
 from infinitd_server.game import Game
 from infinitd_server.logger import Logger
 from infinitd_server.handler.base import BaseHandler
+from infinitd_server.sse import QueueOverflow
+from infinitd_server.stream_encoding import (BINARY_SUBPROTOCOL, CHANNEL_ID, encodeText, encodeBinary,
+    channelMessage)
 
 class StreamHandler(BaseHandler, WebSocketHandler):
     game: Game
     readTasks: Dict[str, asyncio.Task]
+    # Channel IDs of binary subscriptions are never reused within a connection.
+    MAX_CHANNEL_ID: int = 0xFFFF
+    nextChannelId: int
+    # Once this much is waiting to be sent subscriptions stop reading their
+    # queues until it's sent, so slow clients fall behind in the queues.
+    HIGH_WATER_BYTES: int = 64 * 1024
+    # Clients are disconnected once this much is waiting to be sent.
+    MAX_BUFFERED_BYTES: int = 1024 * 1024
+    bufferedBytes: int
+    numSlowDisconnects: ClassVar[int] = 0
 
     # Allow cross-origin requests.
     def check_origin(self, origin):
         return True
 
+    def select_subprotocol(self, subprotocols: List[str]) -> Optional[str]:
+        if BINARY_SUBPROTOCOL in subprotocols:
+            return BINARY_SUBPROTOCOL
+        return None
+
+    @property
+    def binary(self) -> bool:
+        return self.selected_subprotocol == BINARY_SUBPROTOCOL
+
     def prepare(self):
         super().prepare()
         self.readTasks = {}
+        self.nextChannelId = 0
+        self.bufferedBytes = 0
 
     def on_message(self, msg):
         # Parse message to see if it's a request to subscribe/unsubscribe to some data
@@ -47,24 +67,52 @@ class StreamHandler(BaseHandler, WebSocketHandler):
         if dataId is None:
             raise ValueError(f"Could not split subscribe ID: {id}")
 
+        binary = self.binary
+        if binary and datatype == "battle":
+            # Binary clients always get battle events in frames.
+            datatype = "battleFrames"
         try:
             queueCollection = self.game.queues[datatype]
         except KeyError:
             self.logWarn(f"Attempting to subscribe to unknown datatype: {datatype}")
             return
-
-        # Get the initial state for this new subscription.
-        initialData = self.getInitialState(datatype, dataId)
-        if initialData is not None:
-            self.sendData(id, initialData)
+        header = None
+        if binary:
+            if self.nextChannelId > self.MAX_CHANNEL_ID:
+                self.logWarn(f"Out of channel IDs for subscription: {id}")
+                return
+            channelId = self.nextChannelId
+            header = CHANNEL_ID.pack(channelId)
+            self.nextChannelId += 1
 
         # Start a queue and a task to ready from that queue.
-        qContext = queueCollection.queue_context(dataId)
+        qContext = queueCollection.queue_context(dataId, sharedEncoding = True)
         async def readFromQ():
             with qContext as q:
-                while True:
-                    newData = await q.get()
-                    self.sendData(id, newData)
+                try:
+                    if binary:
+                        # Tell the client which channel ID carries this subscription.
+                        await self.send(channelMessage(channelId, id), binary = True)
+                    # Get the initial state for this new subscription. This happens
+                    # after subscribing so no updates are missed while it's loaded.
+                    await self.sendData(id, header, await self.getInitialState(datatype, dataId))
+                    while True:
+                        update = await q.get()
+                        if update is QueueOverflow.DISCONNECT:
+                            self.logWarn(f"Disconnecting after falling too far behind on {id}.")
+                            self.close(1013, "Too far behind")
+                            return
+                        if update is QueueOverflow.RESYNC:
+                            self.logInfo(f"Resyncing {id} after falling too far behind.")
+                            await self.sendData(id, header, await self.getInitialState(datatype, dataId, reset = True))
+                            continue
+                        # Other subscribers reuse the encoding.
+                        if binary:
+                            await self.send(header + update.encodeBinary(encodeBinary), binary = True)
+                        else:
+                            await self.send(update.encode(id, encodeText))
+                except WebSocketClosedError:
+                    pass
         self.readTasks[id] = asyncio.create_task(readFromQ())
 
     def unsubscribe(self, id: str):
@@ -77,35 +125,53 @@ class StreamHandler(BaseHandler, WebSocketHandler):
     def open(self):
         pass
 
-    def getInitialState(self, datatype: str, dataId: str):
+    async def getInitialState(self, datatype: str, dataId: str, reset: bool = False):
+        "With reset the client missed updates and needs the whole state again."
         if datatype == "user":
-            return self.game.getUserSummaryByName(dataId)
+            return await self.game.getUserSummaryByName(dataId)
         if datatype == "battleground":
-            return self.game.getBattleground(dataId)
+            return await self.game.getBattleground(dataId)
         if datatype == "battle":
-            return self.game.joinBattle(dataId)
+            return await self.game.joinBattle(dataId, reset)
+        if datatype == "battleFrames":
+            # Like battle, but with each window's events in one message.
+            return await self.game.joinBattleFrames(dataId, reset)
         if datatype == "rivals":
-            return self.game.getUserRivals(dataId)
+            return await self.game.getUserRivals(dataId)
         if datatype == "battleGpm":
             defenderName, attackerName = dataId.split('/', maxsplit=1)
-            defender = self.game.getUserSummaryByName(defenderName)
-            attacker = self.game.getUserSummaryByName(attackerName)
-            maybeBattle = self.game.getBattle(attacker = attacker, defender = defender)
+            defender = await self.game.getUserSummaryByName(defenderName)
+            attacker = await self.game.getUserSummaryByName(attackerName)
+            maybeBattle = await self.game.getBattle(attacker = attacker, defender = defender)
             if maybeBattle:
                 return maybeBattle.results.goldPerMinute
             return -1.0
         raise ValueError(f"Cannot get initial state for datatype: {datatype}")
     
-    def sendData(self, id: str, data):
-        if isinstance(data, list):
-            for x in data:
-                self.sendDataElement(id, x)
-        else:
-            self.sendDataElement(id, data)
+    async def sendData(self, id: str, header: Optional[bytes], data):
+        "Send data to a subscription. Binary subscriptions start each message with header."
+        if data is None:
+            return
+        for x in (data if isinstance(data, list) else [data]):
+            if header is None:
+                await self.send(f"{id}:{encodeText(x)}")
+            else:
+                await self.send(header + encodeBinary(x), binary = True)
 
-    def sendDataElement(self, id: str, data):
-        if isinstance(data, DataClassJsonMixin):
-            self.write_message(f"{id}:{data.to_json()}")
-        else:
-            encoded = json.dumps(cattr.unstructure(data))
-            self.write_message(f"{id}:{encoded}")
\ No newline at end of file
+    async def send(self, message: Union[str, bytes], binary: bool = False):
+        "Write message, waiting for it to be sent if the client has fallen behind."
+        size = len(message)
+        sent = self.write_message(message, binary = binary)
+        self.bufferedBytes += size
+        def onSent(future):
+            self.bufferedBytes -= size
+            if not future.cancelled():
+                future.exception() # Closed connections are handled by the writer.
+        sent.add_done_callback(onSent)
+        if self.bufferedBytes > self.MAX_BUFFERED_BYTES:
+            self.logWarn(f"Disconnecting with {self.bufferedBytes} bytes waiting to be sent.")
+            StreamHandler.numSlowDisconnects += 1
+            self.close(1013, "Too far behind")
+            raise WebSocketClosedError()
+        if self.bufferedBytes > self.HIGH_WATER_BYTES:
+            await sent
@@ -1,4 +1,4 @@
-import attr
+import cattr
 
 from infinitd_server.game import Game
 from infinitd_server.handler.base import BaseHandler
@@ -6,10 +6,10 @@ from infinitd_server.handler.base import BaseHandler
 class ThisUserHandler(BaseHandler):
     game: Game # See https://github.com/google/pytype/issues/652
 
-    def get(self):
+    async def get(self):
         uid = self.verifyAuthentication()
-        user = self.game.getUserSummaryByUid(uid)
+        user = await self.game.getUserSummaryByUid(uid)
         if user:
-            self.write(attr.asdict(user))
+            self.write(cattr.unstructure(user))
         else:
             self.set_status(404)
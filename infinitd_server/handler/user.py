@@ -1,4 +1,4 @@
-import attr
+import cattr
 
 from infinitd_server.game import Game
 from infinitd_server.handler.base import BaseHandler
@@ -6,9 +6,9 @@ from infinitd_server.handler.base import BaseHandler
 class UserHandler(BaseHandler):
     game: Game # See https://github.com/google/pytype/issues/652
 
-    def get(self, username):
-        user = self.game.getUserSummaryByName(username)
+    async def get(self, username):
+        user = await self.game.getUserSummaryByName(username)
         if user:
-            self.write(attr.asdict(user))
+            self.write(cattr.unstructure(user))
         else:
             self.set_status(404)
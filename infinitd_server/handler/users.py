@@ -1,4 +1,4 @@
-import attr
+import cattr
 
 from infinitd_server.game import Game
 from infinitd_server.handler.base import BaseHandler
@@ -6,7 +6,14 @@ from infinitd_server.handler.base import BaseHandler
 class UsersHandler(BaseHandler):
     game: Game # See https://github.com/google/pytype/issues/652
 
-    def get(self):
-        users = [attr.asdict(user) for user in self.game.getUserSummaries()]
+    async def get(self):
+        # Page through the leaderboard with start and count. By default every user is returned.
+        start = int(self.get_argument("start", "0"))
+        countArg = self.get_argument("count", None)
+        count = None if countArg is None else int(countArg)
+        if start < 0 or (count is not None and count < 0):
+            self.set_status(400)
+            return
+        users = [cattr.unstructure(user) for user in await self.game.getUserSummaries(start, count)]
         data = {'users': users}
         self.write(data)
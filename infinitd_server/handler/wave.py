@@ -10,7 +10,7 @@ from infinitd_server.handler.base import BaseHandler
 class WaveHandler(BaseHandler):
     game: Game # See https://github.com/google/pytype/issues/652
 
-    def post(self, name: str):
+    async def post(self, name: str):
         try:
             data = tornado.escape.json_decode(self.request.body)
         except json.decoder.JSONDecodeError:
@@ -25,7 +25,8 @@ class WaveHandler(BaseHandler):
             self.set_status(400)
             return
 
-        with self.getMutableUser(expectedName=name) as user:
+        userContext = await self.getMutableUser(expectedName=name)
+        async with userContext as user:
             try:
                 self.game.setWave(user, monsters=monsters)
             except ValueError as e:
@@ -41,10 +42,11 @@ class WaveHandler(BaseHandler):
 
         self.set_status(201) # OK
 
-    def delete(self, name: str):
+    async def delete(self, name: str):
         self.logInfo(f"Got DELETE request for wave/{name}")
 
-        with self.getMutableUser(expectedName=name) as user:
+        userContext = await self.getMutableUser(expectedName=name)
+        async with userContext as user:
             try:
                 self.game.clearWave(user)
             except (ValueError, UserInBattleException)  as e:
@@ -0,0 +1,323 @@
+import heapq
+import math
+import random
+from typing import Dict, Generic, Iterator, List, Optional, Tuple, TypeVar
+
+V = TypeVar('V')
+
+# Sorts after every real key.
+_END_KEY = (math.inf,)
+
+class _Node:
+    __slots__ = ["base", "rate", "tieBreaker", "name", "value", "next", "width", "prev"]
+
+    def __init__(self, base: float, rate: float, tieBreaker, name, value, levels: int):
+        # The score at time t is base + rate * t.
+        self.base = base
+        self.rate = rate
+        self.tieBreaker = tieBreaker
+        self.name = name
+        self.value = value
+        self.next: List[Optional[_Node]] = [None] * levels
+        # How many positions each link skips over.
+        self.width: List[int] = [1] * levels
+        self.prev: Optional[_Node] = None
+
+    def score(self, now: float) -> float:
+        return self.base + self.rate * now
+
+    def key(self, now: float):
+        return (-self.score(now), self.tieBreaker, self.name)
+
+class _EndNode(_Node):
+    __slots__ = []
+
+    def key(self, now: float):
+        return _END_KEY
+
+class Leaderboard(Generic[V]):
+    """Names ordered by descending score.
+
+    Ties are broken by an optional tie breaker (lowest first) and then by name.
+
+    This is an indexable skip list so inserting, removing and finding
+    the rank of a name, or the name at a rank, all take O(log n) time.
+    Each name can carry an arbitrary value along with its score.
+
+    Scores can also grow at a per-name rate as the clock advances. Adjacent
+    names which will overtake each other are kept in a heap by when that
+    happens, so advancing the clock only touches names which change rank.
+
+    Leaderboard isn't thread safe."""
+    MAX_LEVELS: int = 32
+    # Float error allowed when deciding whether two names have crossed, relative to the time.
+    CROSSING_SLACK: float = 1e-9
+
+    _head: _Node
+    _end: _Node
+    _nodes: Dict[str, _Node]
+    _random: random.Random
+    _now: float
+    # (time, upper name, lower name) for adjacent names where the lower one is catching up.
+    # Entries can be stale, so they're checked when popped.
+    _crossings: List[Tuple[float, str, str]]
+
+    def __init__(self, seed: int = 0, now: float = 0.0):
+        self._end = _EndNode(0.0, 0.0, None, None, None, 0)
+        self._head = _Node(0.0, 0.0, None, None, None, self.MAX_LEVELS)
+        self._head.next = [self._end] * self.MAX_LEVELS
+        self._end.prev = self._head
+        self._nodes = {}
+        self._random = random.Random(seed)
+        self._now = now
+        self._crossings = []
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._nodes
+
+    def __iter__(self) -> Iterator[str]:
+        "Iterate over names from highest to lowest score."
+        for (name, _) in self.items():
+            yield name
+
+    @property
+    def now(self) -> float:
+        return self._now
+
+    def items(self, start: int = 0) -> Iterator[Tuple[str, V]]:
+        "Iterate over names and their values from the given rank onwards."
+        if start >= len(self):
+            return
+        node = self._nodeAt(max(start, 0))
+        while node is not self._end:
+            yield (node.name, node.value)
+            node = node.next[0]
+
+    def score(self, name: str) -> float:
+        return self._nodes[name].score(self._now)
+
+    def tieBreaker(self, name: str) -> int:
+        return self._nodes[name].tieBreaker
+
+    def get(self, name: str) -> Optional[V]:
+        node = self._nodes.get(name)
+        return None if node is None else node.value
+
+    def set(self, name: str, score: float, value: Optional[V] = None, tieBreaker: int = 0,
+            rate: float = 0.0, scoreTime: Optional[float] = None):
+        """Add name or update its score and value.
+
+        The score grows by rate per unit of time. It's the score at scoreTime, which defaults to now."""
+        base = score - rate * (self._now if scoreTime is None else scoreTime)
+        node = self._nodes.get(name)
+        if node is not None:
+            if self._fits(node, (-(base + rate * self._now), tieBreaker, name)):
+                # The rank doesn't change so there's no need to move the node.
+                node.base = base
+                node.rate = rate
+                node.tieBreaker = tieBreaker
+                node.value = value
+                self._watch(node.prev, node)
+                self._watch(node, node.next[0])
+                return
+            self.remove(name)
+        self._insert(base, rate, tieBreaker, name, value)
+
+    def moves(self, name: str, score: float, tieBreaker: int = 0) -> bool:
+        "Whether setting name's score would change its rank."
+        return not self._fits(self._nodes[name], (-score, tieBreaker, name))
+
+    def insertionRank(self, name: str, score: float, tieBreaker: int = 0) -> int:
+        "Returns the rank name would be added at. It must not be in the leaderboard."
+        return self._findChain((-score, tieBreaker, name))[1]
+
+    def remove(self, name: str):
+        node = self._nodes.pop(name)
+        chain = self._findChain(node.key(self._now))[0]
+        for level in range(len(node.next)):
+            prev = chain[level]
+            prev.width[level] += node.width[level] - 1
+            prev.next[level] = node.next[level]
+        for level in range(len(node.next), self.MAX_LEVELS):
+            chain[level].width[level] -= 1
+        node.next[0].prev = node.prev
+        self._watch(node.prev, node.next[0])
+
+    def rank(self, name: str) -> int:
+        "Returns the 0-based rank of name."
+        return self._findChain(self._nodes[name].key(self._now))[1]
+
+    def page(self, start: int, count: int) -> List[str]:
+        "Returns up to count names starting from the given rank."
+        names = []
+        for (name, _) in self.items(start):
+            if len(names) >= count:
+                break
+            names.append(name)
+        return names
+
+    def around(self, name: str, radius: int) -> Tuple[List[str], List[str]]:
+        "Returns the names up to radius ranks ahead of and behind name."
+        return self._around(self._nodes[name], radius)
+
+    def advance(self, now: float, radius: int = 0) -> Dict[str, Tuple[List[str], List[str]]]:
+        """Moves the clock forward to now.
+
+        Returns what was around every name within radius ranks of a rank change,
+        as it was before the first change near it."""
+        before: Dict[str, Tuple[List[str], List[str]]] = {}
+        notYet = []
+        due = now + self.CROSSING_SLACK * max(abs(now), 1.0)
+        while self._crossings and self._crossings[0][0] <= due:
+            crossing = heapq.heappop(self._crossings)
+            upper = self._nodes.get(crossing[1])
+            lower = self._nodes.get(crossing[2])
+            if upper is None or lower is None or upper.next[0] is not lower:
+                continue
+            if not lower.key(now) < upper.key(now):
+                if lower.rate > upper.rate and self._crossingTime(upper, lower) <= due:
+                    # Tied or within float error; check again next time.
+                    notYet.append(crossing)
+                # Otherwise their scores changed since and there's a newer crossing if any.
+                continue
+            for node in self._window(upper, lower, radius):
+                if node.name not in before:
+                    before[node.name] = self._around(node, radius)
+            self._swap(upper, lower)
+            self._watch(upper.prev, upper)
+            self._watch(lower, lower.next[0])
+        for crossing in notYet:
+            heapq.heappush(self._crossings, crossing)
+        self._now = now
+        return before
+
+    def _watch(self, upper: _Node, lower: _Node):
+        "Remember when lower will overtake upper, if it ever will."
+        if upper is self._head or lower is self._end or lower.rate <= upper.rate:
+            return
+        heapq.heappush(self._crossings, (self._crossingTime(upper, lower), upper.name, lower.name))
+        if len(self._crossings) > 2 * len(self._nodes) + 64:
+            self._rewatch()
+
+    def _rewatch(self):
+        "Drop stale crossings."
+        self._crossings = []
+        node = self._head.next[0]
+        while node is not self._end:
+            lower = node.next[0]
+            if lower is not self._end and lower.rate > node.rate:
+                self._crossings.append((self._crossingTime(node, lower), node.name, lower.name))
+            node = lower
+        heapq.heapify(self._crossings)
+
+    @staticmethod
+    def _crossingTime(upper: _Node, lower: _Node) -> float:
+        "When lower's score reaches upper's. lower must have the higher rate."
+        return (upper.base - lower.base) / (lower.rate - upper.rate)
+
+    def _swap(self, upper: _Node, lower: _Node):
+        "Swap adjacent names by exchanging what their nodes hold."
+        for attr in ["base", "rate", "tieBreaker", "name", "value"]:
+            upperValue = getattr(upper, attr)
+            setattr(upper, attr, getattr(lower, attr))
+            setattr(lower, attr, upperValue)
+        self._nodes[upper.name] = upper
+        self._nodes[lower.name] = lower
+
+    def _window(self, upper: _Node, lower: _Node, radius: int) -> List[_Node]:
+        "Returns upper and lower plus the nodes within radius of them."
+        nodes = [upper, lower]
+        node = upper.prev
+        for _ in range(radius):
+            if node is self._head:
+                break
+            nodes.append(node)
+            node = node.prev
+        node = lower.next[0]
+        for _ in range(radius):
+            if node is self._end:
+                break
+            nodes.append(node)
+            node = node.next[0]
+        return nodes
+
+    def _around(self, node: _Node, radius: int) -> Tuple[List[str], List[str]]:
+        ahead = []
+        prev = node.prev
+        while len(ahead) < radius and prev is not self._head:
+            ahead.append(prev.name)
+            prev = prev.prev
+        ahead.reverse()
+        behind = []
+        next = node.next[0]
+        while len(behind) < radius and next is not self._end:
+            behind.append(next.name)
+            next = next.next[0]
+        return (ahead, behind)
+
+    def _findChain(self, key) -> Tuple[List[_Node], int]:
+        """Finds the last node before key on every level.
+
+        Also returns the position key has (or would have)."""
+        chain = [self._head] * self.MAX_LEVELS
+        node = self._head
+        position = 0
+        now = self._now
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key(now) < key:
+                position += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        return (chain, position)
+
+    def _fits(self, node: _Node, key) -> bool:
+        "Whether node can be given key without changing its rank."
+        prev = node.prev
+        return ((prev is self._head or prev.key(self._now) < key)
+            and key < node.next[0].key(self._now))
+
+    def _nodeAt(self, rank: int) -> _Node:
+        node = self._head
+        remaining = rank + 1
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.width[level] <= remaining and node.next[level] is not self._end:
+                remaining -= node.width[level]
+                node = node.next[level]
+            if remaining == 0:
+                break
+        return node
+
+    def _insert(self, base: float, rate: float, tieBreaker, name: str, value):
+        key = (-(base + rate * self._now), tieBreaker, name)
+        chain = [self._head] * self.MAX_LEVELS
+        stepsAtLevel = [0] * self.MAX_LEVELS
+        node = self._head
+        now = self._now
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key(now) < key:
+                stepsAtLevel[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        levels = 1
+        while levels < self.MAX_LEVELS and self._random.random() < 0.5:
+            levels += 1
+        newNode = _Node(base, rate, tieBreaker, name, value, levels)
+        steps = 0
+        for level in range(levels):
+            prev = chain[level]
+            newNode.next[level] = prev.next[level]
+            prev.next[level] = newNode
+            newNode.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += stepsAtLevel[level]
+        for level in range(levels, self.MAX_LEVELS):
+            chain[level].width[level] += 1
+        newNode.prev = chain[0]
+        newNode.next[0].prev = newNode
+        self._nodes[name] = newNode
+        self._watch(newNode.prev, newNode)
+        self._watch(newNode, newNode.next[0])
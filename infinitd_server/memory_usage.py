@@ -0,0 +1,33 @@
+"""Rough memory accounting for debug endpoints."""
+from collections import deque
+from enum import Enum
+import sys
+import types
+from typing import Any, Optional, Set
+
+# Shared by everything which refers to them, so never counted.
+_SKIPPED_TYPES = (type, Enum, types.FunctionType, types.MethodType, types.BuiltinFunctionType,
+    types.ModuleType)
+
+def approxBytes(obj: Any, seen: Optional[Set[int]] = None) -> int:
+    """The size of obj and everything it contains.
+
+    Objects reachable more than once are counted once."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, _SKIPPED_TYPES):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, bytearray)):
+        return size
+    if isinstance(obj, dict):
+        return size + sum(approxBytes(key, seen) + approxBytes(value, seen) for (key, value) in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset, deque)):
+        return size + sum(approxBytes(item, seen) for item in obj)
+    if hasattr(obj, "__dict__"):
+        size += approxBytes(vars(obj), seen)
+    slots = getattr(type(obj), "__slots__", ())
+    for slot in ((slots,) if isinstance(slots, str) else slots):
+        size += approxBytes(getattr(obj, slot, None), seen)
+    return size
@@ -0,0 +1,105 @@
+"""Versioned changes to the database schema.
+
+A database's version is stored in PRAGMA user_version and is the number of
+migrations which have been applied to it. Migrations must never be edited or
+reordered once released, only appended to."""
+import sqlite3
+from typing import Callable, List
+
+def _createTables(conn: sqlite3.Connection):
+    "The schema from before migrations were tracked, so it must work on existing databases."
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users(
+        uid TEXT PRIMARY KEY,
+        name TEXT UNIQUE,
+        gold REAL,
+        accumulatedGold REAL,
+        goldPerMinuteSelf REAL,
+        goldPerMinuteOthers REAL,
+        inBattle BOOLEAN DEFAULT 0 CHECK (inBattle == 0 || inBattle == 1),
+        battleground TEXT,
+        wave TEXT DEFAULT '[]',
+        admin BOOLEAN DEFAULT 0 CHECK (admin == 0 || admin == 1),
+        goldSettledTick INTEGER DEFAULT 0
+        );""")
+    userColumns = [row[1] for row in conn.execute("PRAGMA table_info(users);")]
+    if "goldSettledTick" not in userColumns: # Databases from before lazy gold accrual.
+        conn.execute("ALTER TABLE users ADD COLUMN goldSettledTick INTEGER DEFAULT 0;")
+    # A single row counting how many times gold has been accumulated.
+    conn.execute("CREATE TABLE IF NOT EXISTS goldClock(tick INTEGER NOT NULL);")
+    conn.execute("INSERT INTO goldClock (tick) SELECT 0 WHERE NOT EXISTS (SELECT * FROM goldClock);")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS battles(
+        attackerUid TEXT KEY,
+        defenderUid TEXT KEY,
+        events BLOB,
+        results BLOB,
+        goldPerMinute REAL
+        );""")
+
+def _addBattlesPrimaryKey(conn: sqlite3.Connection):
+    "Make (attackerUid, defenderUid) the primary key of battles and index battles by defender."
+    conn.execute("""
+        CREATE TABLE newBattles(
+        attackerUid TEXT NOT NULL,
+        defenderUid TEXT NOT NULL,
+        events BLOB,
+        results BLOB,
+        goldPerMinute REAL,
+        PRIMARY KEY (attackerUid, defenderUid)
+        );""")
+    # Duplicate battles could be saved before, in which case keep the latest.
+    conn.execute("""
+        INSERT OR REPLACE INTO newBattles (attackerUid, defenderUid, events, results, goldPerMinute)
+        SELECT attackerUid, defenderUid, events, results, goldPerMinute FROM battles
+        WHERE attackerUid IS NOT NULL AND defenderUid IS NOT NULL
+        ORDER BY rowid;""")
+    # This also drops the battles triggers and indexes.
+    conn.execute("DROP TABLE battles;")
+    conn.execute("ALTER TABLE newBattles RENAME TO battles;")
+    conn.execute("CREATE INDEX battlesByDefender ON battles(defenderUid);")
+
+def _addInputVersions(conn: sqlite3.Connection):
+    "Count changes to each user's wave and battleground so stale battles can be detected cheaply."
+    conn.execute("ALTER TABLE users ADD COLUMN waveVersion INTEGER NOT NULL DEFAULT 0;")
+    conn.execute("ALTER TABLE users ADD COLUMN battlegroundVersion INTEGER NOT NULL DEFAULT 0;")
+
+def _addBattleJobs(conn: sqlite3.Connection):
+    """Battles waiting to be calculated, so they aren't lost on restart.
+
+    version counts how many times a job was queued so finishing an older run
+    doesn't mark a requeued job as done."""
+    conn.execute("""
+        CREATE TABLE battle_jobs(
+        attackerUid TEXT NOT NULL,
+        defenderUid TEXT NOT NULL,
+        state TEXT NOT NULL CHECK (state IN ('queued', 'running', 'done', 'failed')),
+        priority INTEGER NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (attackerUid, defenderUid)
+        );""")
+    conn.execute("CREATE INDEX battleJobsByState ON battle_jobs(state, priority);")
+
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _createTables,
+    _addBattlesPrimaryKey,
+    _addInputVersions,
+    _addBattleJobs,
+]
+
+def schemaVersion(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Applies any migrations the database is missing and returns how many were applied.
+
+    This must be called inside a transaction so a failed migration is rolled back."""
+    version = schemaVersion(conn)
+    if version > len(MIGRATIONS):
+        raise ValueError(
+            f"Database schema version {version} is newer than the latest known version {len(MIGRATIONS)}.")
+    for migration in MIGRATIONS[version:]:
+        migration(conn)
+    # PRAGMA doesn't accept parameters.
+    conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)};")
+    return len(MIGRATIONS) - version
@@ -0,0 +1,236 @@
+"""Delivering stream updates to listeners in other server processes.
+
+Every process delivers its own updates to its own listeners. A PubSub only
+forwards updates to the other processes which have listeners for them.
+Messages are pickled, so only connect processes which trust each other.
+
+Frames to and from the broker (see pubsub_broker) are framed with
+FRAME_HEADER: the total length, the length of the channel and key, and what
+kind of frame it is. The message follows the channel and key."""
+import abc
+import asyncio
+import collections
+import pickle
+import struct
+from typing import AbstractSet, Any, Awaitable, Callable, DefaultDict, Dict, KeysView, List, Optional, Tuple
+
+from infinitd_server.logger import Logger
+
+# Listens to every key in a channel.
+ALL_KEYS = "*"
+
+FRAME_HEADER = struct.Struct("!IHHB")
+# From a process to the broker
+SUBSCRIBE = 1
+UNSUBSCRIBE = 2
+# Both ways
+PUBLISH = 3
+# From the broker to a process: another process started or stopped listening.
+SUBSCRIBED = 4
+UNSUBSCRIBED = 5
+
+Listener = Callable[[str, Any], Awaitable[None]]
+
+async def readFrame(reader: asyncio.StreamReader) -> Tuple[int, str, str, bytes]:
+    "Returns the kind, channel, key and message of the next frame."
+    (length, channelLength, keyLength, kind) = FRAME_HEADER.unpack(
+        await reader.readexactly(FRAME_HEADER.size))
+    data = await reader.readexactly(length)
+    channel = data[:channelLength].decode()
+    key = data[channelLength:channelLength + keyLength].decode()
+    return (kind, channel, key, data[channelLength + keyLength:])
+
+def encodeFrame(kind: int, channel: str, key: str, message: bytes = b"") -> bytes:
+    channelBytes = channel.encode()
+    keyBytes = key.encode()
+    return b"".join([FRAME_HEADER.pack(len(channelBytes) + len(keyBytes) + len(message),
+        len(channelBytes), len(keyBytes), kind), channelBytes, keyBytes, message])
+
+class PubSub(abc.ABC):
+    "Forwards updates to listeners in other processes."
+
+    @abc.abstractmethod
+    def subscribe(self, channel: str, key: str):
+        """This process has listeners for key, or every key with ALL_KEYS.
+
+        Subscriptions are counted, so key is listened to until it's unsubscribed as often."""
+        pass
+
+    @abc.abstractmethod
+    def unsubscribe(self, channel: str, key: str):
+        pass
+
+    @abc.abstractmethod
+    def listen(self, channel: str, listener: Listener):
+        "Call listener with every update to channel published by another process."
+        pass
+
+    @abc.abstractmethod
+    def publish(self, channel: str, key: str, message: Any):
+        "Send message to the other processes listening to key. Must be called from the event loop."
+        pass
+
+    @abc.abstractmethod
+    def remoteKeys(self, channel: str) -> AbstractSet[str]:
+        "Keys other processes are listening to."
+        pass
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+class InProcessPubSub(PubSub):
+    "For a single server process. Every listener is local so there's nothing to forward."
+
+    def subscribe(self, channel: str, key: str):
+        pass
+
+    def unsubscribe(self, channel: str, key: str):
+        pass
+
+    def listen(self, channel: str, listener: Listener):
+        pass
+
+    def publish(self, channel: str, key: str, message: Any):
+        pass
+
+    def remoteKeys(self, channel: str) -> AbstractSet[str]:
+        return frozenset()
+
+class UnixSocketPubSub(PubSub):
+    """Forwards updates through a broker listening on a Unix socket.
+
+    Reconnects every retrySecs if the broker goes away. Updates published
+    while disconnected are dropped."""
+    path: str
+    retrySecs: float
+    connected: bool = False
+    # How many times this process subscribed to each key, resent on reconnecting.
+    _subscriptions: collections.Counter
+    # How many other processes listen to each key, by channel.
+    _remoteKeys: DefaultDict[str, collections.Counter]
+    # How many other processes listen to every key, by channel.
+    _remoteWatchers: collections.Counter
+    _listeners: DefaultDict[str, List[Listener]]
+    # Updates waiting for each channel's listeners. Each channel has its own task
+    # delivering them so a slow listener only holds up its own channel.
+    _deliveries: Dict[str, asyncio.Queue]
+    _deliveryTasks: List[asyncio.Task]
+    _writer: Optional[asyncio.StreamWriter] = None
+    _task: Optional[asyncio.Task] = None
+
+    def __init__(self, path: str, retrySecs: float = 1.0):
+        self.path = path
+        self.retrySecs = retrySecs
+        self.logger = Logger.getDefault()
+        self._subscriptions = collections.Counter()
+        self._remoteKeys = collections.defaultdict(collections.Counter)
+        self._remoteWatchers = collections.Counter()
+        self._listeners = collections.defaultdict(list)
+        self._deliveries = {}
+        self._deliveryTasks = []
+
+    def start(self):
+        "Must be called from the event loop."
+        self._task = asyncio.ensure_future(self.__run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        for task in self._deliveryTasks:
+            task.cancel()
+        self._deliveryTasks = []
+        self._deliveries = {}
+        self.__disconnect()
+
+    def subscribe(self, channel: str, key: str):
+        self._subscriptions[(channel, key)] += 1
+        if self._subscriptions[(channel, key)] == 1:
+            self.__send(encodeFrame(SUBSCRIBE, channel, key))
+
+    def unsubscribe(self, channel: str, key: str):
+        if (channel, key) not in self._subscriptions:
+            return
+        self._subscriptions[(channel, key)] -= 1
+        if self._subscriptions[(channel, key)] <= 0:
+            del self._subscriptions[(channel, key)]
+            self.__send(encodeFrame(UNSUBSCRIBE, channel, key))
+
+    def listen(self, channel: str, listener: Listener):
+        self._listeners[channel].append(listener)
+
+    def publish(self, channel: str, key: str, message: Any):
+        # Don't bother pickling messages no one else wants.
+        if key not in self._remoteKeys[channel] and self._remoteWatchers[channel] <= 0:
+            return
+        self.__send(encodeFrame(PUBLISH, channel, key, pickle.dumps(message, pickle.HIGHEST_PROTOCOL)))
+
+    def remoteKeys(self, channel: str) -> KeysView[str]:
+        return self._remoteKeys[channel].keys()
+
+    def __send(self, frame: bytes):
+        if self._writer is not None:
+            self._writer.write(frame)
+
+    async def __run(self):
+        while True:
+            try:
+                (reader, self._writer) = await asyncio.open_unix_connection(self.path)
+                self.connected = True
+                self.logger.info("pubsub", -1, f"Connected to pub/sub broker {self.path}.")
+                for (channel, key) in self._subscriptions:
+                    self.__send(encodeFrame(SUBSCRIBE, channel, key))
+                await self.__readFrames(reader)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                if self.connected:
+                    self.logger.warn("pubsub", -1, f"Lost connection to pub/sub broker {self.path}: {e!r}")
+            self.__disconnect()
+            await asyncio.sleep(self.retrySecs)
+
+    async def __readFrames(self, reader: asyncio.StreamReader):
+        while True:
+            (kind, channel, key, message) = await readFrame(reader)
+            if kind == PUBLISH:
+                if channel in self._listeners:
+                    self.__deliver(channel, key, pickle.loads(message))
+            elif kind == SUBSCRIBED:
+                if key == ALL_KEYS:
+                    self._remoteWatchers[channel] += 1
+                else:
+                    self._remoteKeys[channel][key] += 1
+            elif kind == UNSUBSCRIBED:
+                if key == ALL_KEYS:
+                    self._remoteWatchers[channel] -= 1
+                else:
+                    remoteKeys = self._remoteKeys[channel]
+                    remoteKeys[key] -= 1
+                    if remoteKeys[key] <= 0:
+                        del remoteKeys[key]
+
+    def __deliver(self, channel: str, key: str, update: Any):
+        queue = self._deliveries.get(channel)
+        if queue is None:
+            queue = self._deliveries[channel] = asyncio.Queue()
+            self._deliveryTasks.append(asyncio.ensure_future(self.__deliverUpdates(channel, queue)))
+        queue.put_nowait((key, update))
+
+    async def __deliverUpdates(self, channel: str, queue: asyncio.Queue):
+        "Hands updates to the channel's listeners in the order they were published."
+        while True:
+            (key, update) = await queue.get()
+            for listener in self._listeners[channel]:
+                try:
+                    await listener(key, update)
+                except Exception as e:
+                    self.logger.error("pubsub", -1, f"Listener for {channel} failed: {e!r}")
+
+    def __disconnect(self):
+        self.connected = False
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+        # The broker resends everyone's subscriptions when we reconnect.
+        self._remoteKeys.clear()
+        self._remoteWatchers.clear()
@@ -0,0 +1,150 @@
+"""Forwards stream updates between server processes on one host.
+
+Run it with python -m infinitd_server.pubsub_broker and start each server
+with --pubsub pointing at the same socket. See pubsub for the protocol."""
+import argparse
+import asyncio
+import os
+import signal
+from typing import Dict, Set, Tuple
+
+from infinitd_server.logger import Logger
+from infinitd_server.pubsub import (readFrame, encodeFrame, ALL_KEYS,
+    SUBSCRIBE, UNSUBSCRIBE, PUBLISH, SUBSCRIBED, UNSUBSCRIBED)
+
+class PubSubBroker:
+    "Forwards each published update to the other processes subscribed to it."
+    # Frames wait in the broker once this much is buffered in a process's socket.
+    HIGH_WATER_BYTES: int = 64 * 1024
+    # Processes are disconnected once this much is waiting to be sent to them.
+    # They reconnect and resubscribe, having missed the updates in between.
+    MAX_BUFFERED_BYTES: int = 4 * 1024 * 1024
+    # Subscribed processes by channel and key.
+    subscribers: Dict[Tuple[str, str], Set[asyncio.StreamWriter]]
+    # Each process's subscriptions.
+    subscriptions: Dict[asyncio.StreamWriter, Set[Tuple[str, str]]]
+    # Frames waiting to be sent to each process, and how many bytes they add up to.
+    outboxes: Dict[asyncio.StreamWriter, asyncio.Queue]
+    queuedBytes: Dict[asyncio.StreamWriter, int]
+    numSlowDisconnects: int = 0
+
+    def __init__(self):
+        self.subscribers = {}
+        self.subscriptions = {}
+        self.outboxes = {}
+        self.queuedBytes = {}
+        self.logger = Logger.getDefault()
+
+    async def handleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.transport.set_write_buffer_limits(high = self.HIGH_WATER_BYTES)
+        self.subscriptions[writer] = set()
+        self.outboxes[writer] = asyncio.Queue()
+        self.queuedBytes[writer] = 0
+        sender = asyncio.ensure_future(self.__sendFrames(writer))
+        # Tell the new process what everyone else listens to.
+        for (other, subscriptions) in self.subscriptions.items():
+            if other is not writer:
+                for (channel, key) in subscriptions:
+                    self.__send(writer, encodeFrame(SUBSCRIBED, channel, key))
+        try:
+            while True:
+                (kind, channel, key, message) = await readFrame(reader)
+                if kind == PUBLISH:
+                    frame = encodeFrame(PUBLISH, channel, key, message)
+                    subscribers = (self.subscribers.get((channel, key), set()) |
+                        self.subscribers.get((channel, ALL_KEYS), set()))
+                    for subscriber in subscribers:
+                        if subscriber is not writer:
+                            self.__send(subscriber, frame)
+                elif kind == SUBSCRIBE:
+                    self.__subscribe(writer, channel, key)
+                elif kind == UNSUBSCRIBE:
+                    self.__unsubscribe(writer, channel, key)
+                else:
+                    raise ValueError(f"Unknown frame kind {kind}.")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass # The process exited or was too slow.
+        except Exception as e:
+            self.logger.warn("pubsub_broker", -1, f"Closing connection after error: {e!r}")
+        finally:
+            sender.cancel()
+            for (channel, key) in list(self.subscriptions[writer]):
+                self.__unsubscribe(writer, channel, key)
+            del self.subscriptions[writer]
+            del self.outboxes[writer]
+            del self.queuedBytes[writer]
+            writer.close()
+
+    async def __sendFrames(self, writer: asyncio.StreamWriter):
+        "Write frames to a process as fast as it reads them."
+        outbox = self.outboxes[writer]
+        try:
+            while True:
+                frame = await outbox.get()
+                self.queuedBytes[writer] -= len(frame)
+                writer.write(frame)
+                # Waits while more than HIGH_WATER_BYTES are buffered.
+                await writer.drain()
+        except ConnectionError:
+            pass # handleConnection cleans up.
+
+    def __send(self, writer: asyncio.StreamWriter, frame: bytes):
+        "Queue a frame for a process, disconnecting it if it has fallen too far behind."
+        if writer.is_closing():
+            return
+        buffered = self.queuedBytes[writer] + writer.transport.get_write_buffer_size()
+        if buffered + len(frame) > self.MAX_BUFFERED_BYTES:
+            self.logger.warn("pubsub_broker", -1,
+                f"Disconnecting a process with {buffered} bytes waiting to be sent.")
+            self.numSlowDisconnects += 1
+            # Closing would wait for the buffer to be sent.
+            writer.transport.abort()
+            return
+        self.queuedBytes[writer] += len(frame)
+        self.outboxes[writer].put_nowait(frame)
+
+    def __notifyOthers(self, writer: asyncio.StreamWriter, frame: bytes):
+        for other in self.subscriptions:
+            if other is not writer:
+                self.__send(other, frame)
+
+    def __subscribe(self, writer: asyncio.StreamWriter, channel: str, key: str):
+        if (channel, key) in self.subscriptions[writer]:
+            return
+        self.subscriptions[writer].add((channel, key))
+        self.subscribers.setdefault((channel, key), set()).add(writer)
+        self.__notifyOthers(writer, encodeFrame(SUBSCRIBED, channel, key))
+
+    def __unsubscribe(self, writer: asyncio.StreamWriter, channel: str, key: str):
+        if (channel, key) not in self.subscriptions[writer]:
+            return
+        self.subscriptions[writer].remove((channel, key))
+        subscribers = self.subscribers[(channel, key)]
+        subscribers.discard(writer)
+        if not subscribers:
+            del self.subscribers[(channel, key)]
+        self.__notifyOthers(writer, encodeFrame(UNSUBSCRIBED, channel, key))
+
+def main():
+    parser = argparse.ArgumentParser(description="Forwards stream updates between InfiniTD servers.")
+    parser.add_argument('--unix-socket', action="store", type=str, default="data/pubsub.sock")
+    parser.add_argument('--log-db', action="store", type=str, default="data/pubsub_logs.db")
+    parser.add_argument('-v', '--verbosity', action="store", type=int, default=0)
+    args = parser.parse_args()
+
+    logger = Logger(args.log_db, printVerbosity=args.verbosity)
+    Logger.setDefault(logger)
+    if os.path.exists(args.unix_socket):
+        # Left behind by a previous broker.
+        os.remove(args.unix_socket)
+    broker = PubSubBroker()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.start_unix_server(broker.handleConnection, args.unix_socket))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    logger.info("startup", -1, f"Forwarding updates on {args.unix_socket}.")
+    loop.run_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Calculating battles on a battle worker daemon, possibly on another host.
+
+Requests and responses are framed with FRAME_HEADER: the payload length, the
+ID of the request it belongs to and what kind of frame it is."""
+import asyncio
+import hashlib
+import json
+import struct
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import cattr
+
+from infinitd_server.battle import BattleResults, BattleCalcResults
+from infinitd_server.battle_computer import BattleCalculationException, EVENT_PRECISION
+from infinitd_server.battleground_state import BattlegroundState
+from infinitd_server.game_config import GameConfig, ConfigId
+from infinitd_server.logger import Logger
+import InfiniTDFb.BattleCalcResultsFb as BattleCalcResultsFb
+
+FRAME_HEADER = struct.Struct("!IQB")
+# Requests
+COMPUTE = 1 # JSON with the battleground, wave and priority.
+CANCEL = 2
+PING = 3
+# Responses
+RESULT = 4 # The BattleCalcResultsFb.
+ERROR = 5 # A UTF-8 error message.
+PONG = 6 # JSON with the worker's capacity and game config hash.
+
+# Either (host, port) or the path of a Unix socket.
+Address = Union[Tuple[str, int], str]
+
+def parseAddress(address: str) -> Address:
+    "Parses host:port or unix:path."
+    if address.startswith("unix:"):
+        return address[len("unix:"):]
+    (host, port) = address.rsplit(":", 1)
+    return (host, int(port))
+
+def gameConfigHash(gameConfig: GameConfig) -> str:
+    "Identifies a game config so servers don't use workers with a different one."
+    configJson = json.dumps(cattr.unstructure(gameConfig.gameConfigData), sort_keys=True)
+    return hashlib.sha256(configJson.encode()).hexdigest()
+
+async def openConnection(address: Address) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address)
+
+async def readFrame(reader: asyncio.StreamReader) -> Tuple[int, int, bytes]:
+    "Returns the request ID, kind and payload of the next frame."
+    (length, requestId, kind) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    return (requestId, kind, await reader.readexactly(length))
+
+def writeFrame(writer: asyncio.StreamWriter, requestId: int, kind: int, payload: bytes = b""):
+    writer.write(FRAME_HEADER.pack(len(payload), requestId, kind))
+    writer.write(payload)
+
+class BattleWorkerUnavailable(Exception):
+    "The connection to a battle worker was lost before it responded."
+    pass
+
+class RemoteBattleWorker:
+    """A connection to one battle worker daemon.
+
+    The worker is pinged every healthCheckSecs. It's only used while healthy,
+    and reconnected to on the next check after a failure."""
+    address: Address
+    gameConfig: GameConfig
+    healthCheckSecs: float
+    # How many battles the worker calculates at once. Known after the first ping.
+    capacity: int = 0
+    numRunning: int = 0
+    healthy: bool = False
+    # Called once the worker becomes healthy.
+    onHealthy: Optional[Callable[[], None]]
+    _reader: Optional[asyncio.StreamReader] = None
+    _writer: Optional[asyncio.StreamWriter] = None
+    _pending: Dict[int, asyncio.Future]
+    _nextRequestId: int = 0
+    _tasks: List[asyncio.Task]
+
+    def __init__(self, address: Address, gameConfig: GameConfig, healthCheckSecs: float = 5.0,
+            onHealthy: Optional[Callable[[], None]] = None):
+        self.address = address
+        self.gameConfig = gameConfig
+        self.healthCheckSecs = healthCheckSecs
+        self.onHealthy = onHealthy
+        self.logger = Logger.getDefault()
+        self._pending = {}
+        self._tasks = []
+
+    def start(self):
+        "Must be called from the event loop."
+        self._tasks.append(asyncio.ensure_future(self.__checkHealth()))
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self.__disconnect(BattleWorkerUnavailable(f"Closed connection to {self.address}."))
+
+    def __request(self, kind: int, payload: bytes = b"") -> Tuple[int, asyncio.Future]:
+        if self._writer is None:
+            raise BattleWorkerUnavailable(f"Not connected to {self.address}.")
+        self._nextRequestId += 1
+        future = asyncio.get_event_loop().create_future()
+        self._pending[self._nextRequestId] = future
+        writeFrame(self._writer, self._nextRequestId, kind, payload)
+        return (self._nextRequestId, future)
+
+    def computeBattle(self, battleground: BattlegroundState, wave: List[ConfigId],
+            priority: int) -> Awaitable[BattleCalcResults]:
+        """Start calculating a battle on the worker. Must be called from the event loop.
+
+        Fails with BattleWorkerUnavailable if the connection is lost first.
+        Cancelling the returned future cancels the battle on the worker too."""
+        (requestId, future) = self.__request(COMPUTE, json.dumps({
+            "battleground": battleground.to_dict(), "wave": wave, "priority": priority}).encode())
+        # Counted right away so the worker isn't handed more battles than it can take.
+        self.numRunning += 1
+        return asyncio.ensure_future(self.__awaitBattle(requestId, future, battleground, wave))
+
+    async def __awaitBattle(self, requestId: int, future: asyncio.Future,
+            battleground: BattlegroundState, wave: List[ConfigId]) -> BattleCalcResults:
+        try:
+            (kind, payload) = await future
+        except asyncio.CancelledError:
+            if self._writer is not None and self._pending.pop(requestId, None) is not None:
+                writeFrame(self._writer, requestId, CANCEL)
+            raise
+        finally:
+            self.numRunning -= 1
+        if kind == ERROR:
+            raise BattleCalculationException(battleground, wave, payload.decode())
+        battleCalcFb = BattleCalcResultsFb.BattleCalcResultsFb.GetRootAsBattleCalcResultsFb(payload, 0)
+        return BattleCalcResults(
+            fb = battleCalcFb,
+            results = BattleResults.fromMonstersDefeatedFb(
+                battleCalcFb.MonstersDefeated(), self.gameConfig,
+                round(battleCalcFb.TimeSecs(), EVENT_PRECISION)))
+
+    async def __ping(self):
+        (_, future) = self.__request(PING)
+        (_, payload) = await asyncio.wait_for(future, self.healthCheckSecs)
+        pong = json.loads(payload)
+        if pong["configHash"] != gameConfigHash(self.gameConfig):
+            raise ValueError(f"Battle worker {self.address} has a different game config.")
+        self.capacity = pong["capacity"]
+
+    async def __checkHealth(self):
+        while True:
+            try:
+                if self._writer is None:
+                    (self._reader, self._writer) = await openConnection(self.address)
+                    self._tasks = [task for task in self._tasks if not task.done()]
+                    self._tasks.append(asyncio.ensure_future(self.__readResponses(self._reader)))
+                await self.__ping()
+                if not self.healthy:
+                    self.logger.info("battle_worker", -1, f"Battle worker {self.address} is healthy.")
+                    self.healthy = True
+                    if self.onHealthy is not None:
+                        self.onHealthy()
+            except Exception as e:
+                if self.healthy:
+                    self.logger.warn("battle_worker", -1, f"Battle worker {self.address} failed: {e!r}")
+                self.__disconnect(BattleWorkerUnavailable(f"Battle worker {self.address} failed: {e!r}"))
+            await asyncio.sleep(self.healthCheckSecs)
+
+    async def __readResponses(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                (requestId, kind, payload) = await readFrame(reader)
+                future = self._pending.pop(requestId, None)
+                if future is not None and not future.done():
+                    future.set_result((kind, payload))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            if reader is self._reader:
+                self.logger.warn("battle_worker", -1, f"Lost connection to battle worker {self.address}.")
+                self.__disconnect(BattleWorkerUnavailable(f"Lost connection to {self.address}: {e!r}"))
+
+    def __disconnect(self, error: Exception):
+        self.healthy = False
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+        (pending, self._pending) = (self._pending, {})
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
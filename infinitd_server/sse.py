@@ -1,27 +1,228 @@
 import abc
-from typing import Dict
+import asyncio
+from collections import deque
+from enum import Enum, unique, auto
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
 
-from asyncio_multisubscriber_queue import MultisubscriberQueue
+from infinitd_server.memory_usage import approxBytes
+from infinitd_server.pubsub import PubSub, InProcessPubSub
+
+class SseUpdate:
+    """An update sent to every subscriber of a param.
+
+    It's encoded the first time a subscriber sends it and every other
+    subscriber sends the same bytes."""
+    __slots__ = ("value", "_encoded", "_binary")
+    value: Any
+    # The prefix and encoded message.
+    _encoded: Optional[Tuple[str, bytes]]
+    _binary: Optional[bytes]
+
+    def __init__(self, value):
+        self.value = value
+        self._encoded = None
+        self._binary = None
+
+    def encode(self, prefix: str, encodeFn: Callable[[Any], str]) -> bytes:
+        "Returns prefix:encodeFn(value) as UTF-8."
+        if self._encoded is None or self._encoded[0] != prefix:
+            self._encoded = (prefix, f"{prefix}:{encodeFn(self.value)}".encode())
+        return self._encoded[1]
+
+    def encodeBinary(self, encodeFn: Callable[[Any], bytes]) -> bytes:
+        "Returns encodeFn(value), which subscribers prefix with their own header."
+        if self._binary is None:
+            self._binary = encodeFn(self.value)
+        return self._binary
+
+@unique
+class QueuePolicy(Enum):
+    "What happens once a subscriber falls MAX_QUEUED updates behind."
+    # Only the newest update is ever queued. For streams where each update
+    # is the whole state.
+    LATEST = auto()
+    # Queued updates are dropped and the subscriber gets the whole state again.
+    RESYNC = auto()
+    # Queued updates are dropped and the subscriber is disconnected.
+    DISCONNECT = auto()
+
+@unique
+class QueueOverflow(Enum):
+    "Delivered in place of the updates a subscriber was too far behind to get."
+    RESYNC = auto()
+    DISCONNECT = auto()
+
+class SubscriberQueue:
+    """The updates waiting for one subscriber.
+
+    It holds at most maxQueued updates. Updates which arrive after it
+    overflows are dropped until the subscriber reads the QueueOverflow."""
+    updates: Deque[Any]
+    overflow: Optional[QueueOverflow] = None
+    _waiter: Optional[asyncio.Future] = None
+
+    def __init__(self, queues: "SseQueues"):
+        self.queues = queues
+        self.updates = deque()
+
+    def put_nowait(self, update):
+        queues = self.queues
+        if self.overflow is not None:
+            queues.numDropped += 1
+            return
+        if queues.policy == QueuePolicy.LATEST:
+            if self.updates:
+                self.updates.clear()
+                queues.numCoalesced += 1
+        elif len(self.updates) >= queues.maxQueued:
+            queues.numDropped += len(self.updates) + 1
+            self.updates.clear()
+            if queues.policy == QueuePolicy.RESYNC:
+                self.overflow = QueueOverflow.RESYNC
+                queues.numResyncs += 1
+            else:
+                self.overflow = QueueOverflow.DISCONNECT
+                queues.numDisconnects += 1
+            update = self.overflow
+        self.updates.append(update)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def get(self):
+        while not self.updates:
+            self._waiter = asyncio.get_running_loop().create_future()
+            await self._waiter
+        return self.get_nowait()
+
+    def get_nowait(self):
+        if not self.updates:
+            raise asyncio.QueueEmpty()
+        update = self.updates.popleft()
+        if update is QueueOverflow.RESYNC:
+            self.overflow = None
+        return update
+
+    def qsize(self) -> int:
+        return len(self.updates)
+
+    def empty(self) -> bool:
+        return not self.updates
+
+class _QueueContext:
+    "Subscribes a new queue while in use."
+    def __init__(self, queues: "SseQueues", param: str, sharedEncoding: bool):
+        self.queues = queues
+        self.param = param
+        self.sharedEncoding = sharedEncoding
+        self.subscriber = None
+
+    def __enter__(self) -> SubscriberQueue:
+        self.subscriber = (SubscriberQueue(self.queues), self.sharedEncoding)
+        self.queues._addSubscriber(self.param, self.subscriber)
+        return self.subscriber[0]
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.queues._removeSubscriber(self.param, self.subscriber)
 
 class SseQueues:
-    "A queue for implementing Server-Sent Events."
-    queuesByParam: Dict[str, MultisubscriberQueue]
+    """A queue for implementing Server-Sent Events.
 
-    def __init__(self):
+    Updates are also forwarded through pubsub to listeners in other processes.
+    A param is only kept while it has subscribers. Subscribers which fall
+    behind are handled according to policy."""
+    MAX_QUEUED: int = 256
+    # Each subscriber's queue and whether it gets SseUpdates instead of values.
+    queuesByParam: Dict[str, List[Tuple[SubscriberQueue, bool]]]
+    channel: str
+    pubsub: PubSub
+    policy: QueuePolicy
+    maxQueued: int
+    # Called with a param when it gets its first subscriber here or loses its last.
+    subscriberWatchers: List[Callable[[str], None]]
+    # Updates replaced by a newer one with QueuePolicy.LATEST.
+    numCoalesced: int = 0
+    # Updates dropped because a subscriber overflowed.
+    numDropped: int = 0
+    numResyncs: int = 0
+    numDisconnects: int = 0
+
+    def __init__(self, channel: str = "", pubsub: Optional[PubSub] = None,
+            policy: QueuePolicy = QueuePolicy.DISCONNECT, maxQueued: int = MAX_QUEUED):
         self.queuesByParam = {}
+        self.channel = channel
+        self.pubsub = InProcessPubSub() if pubsub is None else pubsub
+        self.policy = policy
+        self.maxQueued = maxQueued
+        self.subscriberWatchers = []
+        self.pubsub.listen(channel, self.__deliver)
+
+    def queue_context(self, param: str, sharedEncoding: bool = False):
+        """A context with a queue of every update to param.
+
+        With sharedEncoding the queue gets SseUpdates so every subscriber
+        can send the same encoding."""
+        return _QueueContext(self, param, sharedEncoding)
 
-    def queue_context(self, param: str):
+    def _addSubscriber(self, param: str, subscriber: Tuple[SubscriberQueue, bool]):
         if param not in self.queuesByParam:
-            self.queuesByParam[param] = MultisubscriberQueue()
-        return self.queuesByParam[param].queue_context()
+            self.queuesByParam[param] = []
+            self.pubsub.subscribe(self.channel, param)
+            for watcher in self.subscriberWatchers:
+                watcher(param)
+        self.queuesByParam[param].append(subscriber)
+
+    def _removeSubscriber(self, param: str, subscriber: Tuple[SubscriberQueue, bool]):
+        subscribers = self.queuesByParam[param]
+        subscribers.remove(subscriber)
+        if not subscribers:
+            del self.queuesByParam[param]
+            self.pubsub.unsubscribe(self.channel, param)
+            for watcher in self.subscriberWatchers:
+                watcher(param)
 
     async def sendUpdate(self, param: str, newState):
-        if param not in self.queuesByParam:
+        self.pubsub.publish(self.channel, param, newState)
+        await self.__deliver(param, newState)
+
+    async def __deliver(self, param: str, newState):
+        subscribers = self.queuesByParam.get(param)
+        if not subscribers:
             return
-        await self.queuesByParam[param].put(newState)
+        update = SseUpdate(newState)
+        for (queue, sharedEncoding) in subscribers:
+            queue.put_nowait(update if sharedEncoding else newState)
+
+    def listenRemote(self, callback: Callable[[str, Any], Awaitable[None]]):
+        "Call callback with every update another process sends to a param subscribed to here."
+        self.pubsub.listen(self.channel, callback)
+
+    def watchSubscribers(self, callback: Callable[[str], None]):
+        "Call callback with a param when it gets its first subscriber here or loses its last."
+        self.subscriberWatchers.append(callback)
+
+    def getStats(self) -> Dict[str, Any]:
+        "Subscriptions in this process and the updates waiting in their queues."
+        queues = [queue for subscribers in self.queuesByParam.values() for (queue, _) in subscribers]
+        return {
+            "policy": self.policy.name.lower(),
+            "params": len(self.queuesByParam),
+            "subscribers": len(queues),
+            "queuedUpdates": sum(queue.qsize() for queue in queues),
+            "maxQueueDepth": max((queue.qsize() for queue in queues), default = 0),
+            "numCoalesced": self.numCoalesced,
+            "numDropped": self.numDropped,
+            "numResyncs": self.numResyncs,
+            "numDisconnects": self.numDisconnects,
+            # Updates shared by several queues are only counted once.
+            "approxBytes": approxBytes([queue.updates for queue in queues]),
+        }
 
     def __contains__(self, item):
-        return item in self.queuesByParam
-    
+        return item in self.queuesByParam or item in self.pubsub.remoteKeys(self.channel)
+
     def keys(self):
-        return self.queuesByParam.keys()
\ No newline at end of file
+        "Params with listeners in any process."
+        remoteKeys = self.pubsub.remoteKeys(self.channel)
+        if not remoteKeys:
+            return self.queuesByParam.keys()
+        return self.queuesByParam.keys() | remoteKeys
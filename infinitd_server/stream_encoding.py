@@ -0,0 +1,44 @@
+"""How /stream encodes updates.
+
+By default each message is text: the subscription ID, a colon and the
+update as JSON. Clients which negotiate the BINARY_SUBPROTOCOL get binary
+messages instead. Each one starts with the numeric CHANNEL_ID of the
+subscription and the KIND of message it is.
+
+A CHANNEL message, which comes before any updates on that channel, holds the
+subscription ID as UTF-8. Battle events come in EVENTS messages as a
+BattleEventsFb FlatBuffer, grouped like battleFrames. Every other update is
+a MSGPACK message."""
+import json
+import struct
+
+import cattr
+from dataclasses_json import DataClassJsonMixin
+import msgpack
+
+from infinitd_server.battle_coordinator import BattleEventFrame
+
+BINARY_SUBPROTOCOL = "infinitd.binary.v1"
+CHANNEL_ID = struct.Struct("!H")
+KIND = struct.Struct("!B")
+CHANNEL = 0
+MSGPACK = 1
+EVENTS = 2
+
+def encodeText(data) -> str:
+    if isinstance(data, BattleEventFrame):
+        return data.toJson()
+    if isinstance(data, DataClassJsonMixin):
+        return data.to_json()
+    return json.dumps(cattr.unstructure(data))
+
+def encodeBinary(data) -> bytes:
+    "The kind and body of a binary message. The channel ID is prepended per client."
+    if isinstance(data, BattleEventFrame):
+        return KIND.pack(EVENTS) + data.toFb()
+    if isinstance(data, DataClassJsonMixin):
+        return KIND.pack(MSGPACK) + msgpack.packb(data.to_dict(encode_json=True))
+    return KIND.pack(MSGPACK) + msgpack.packb(cattr.unstructure(data))
+
+def channelMessage(channelId: int, subscriptionId: str) -> bytes:
+    return CHANNEL_ID.pack(channelId) + KIND.pack(CHANNEL) + subscriptionId.encode()
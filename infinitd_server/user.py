@@ -1,9 +1,10 @@
 from dataclasses import dataclass, asdict
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from copy import deepcopy
 import sqlite3
 
 import attr
+import cattr
 
 from infinitd_server.battleground_state import BattlegroundState, BgTowersState
 from infinitd_server.game_config import ConfigId
@@ -19,6 +20,8 @@ class UserSummary:
     wave: List[ConfigId]
     inBattle: bool = False
     admin: bool = False
+    # Incremented every time wave changes.
+    waveVersion: int = attr.ib(default = 0, metadata = {"internal": True})
 
 @attr.s(auto_attribs=True, frozen=True)
 class FrozenUserSummary(UserSummary):
@@ -27,11 +30,21 @@ class FrozenUserSummary(UserSummary):
 @attr.s(auto_attribs=True, eq=True)
 class User(UserSummary):
     battleground: BattlegroundState = BattlegroundState(towers=BgTowersState(towers=[]))
+    # Incremented every time battleground changes.
+    battlegroundVersion: int = attr.ib(default = 0, metadata = {"internal": True})
 
 @attr.s(auto_attribs=True, frozen=True)
 class FrozenUser(User):
     pass
 
+def unstructureUser(user: UserSummary) -> Dict[str, Any]:
+    "user as sent to clients, without the versions only the server uses."
+    return {field.name: cattr.unstructure(getattr(user, field.name))
+        for field in attr.fields(type(user)) if not field.metadata.get("internal")}
+
+for userClass in [UserSummary, FrozenUserSummary, User, FrozenUser]:
+    cattr.register_unstructure_hook(userClass, unstructureUser)
+
 class MutableUser:
     _originalUser: User
     _user: User
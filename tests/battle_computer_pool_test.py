@@ -0,0 +1,154 @@
+import asyncio
+import unittest
+
+from aiounittest import AsyncTestCase
+
+from infinitd_server.battle_computer import BattleComputer
+from infinitd_server.battle_computer_pool import BattleComputerPool, BattlePriority, BattleTag, StaleBattleException
+from infinitd_server.battleground_state import BattlegroundState, BgTowerState
+
+import test_data
+
+class TestBattleComputerPool(AsyncTestCase):
+    def setUp(self):
+        self.pool = BattleComputerPool(test_data.gameConfig)
+        self.battleground = BattlegroundState.empty(test_data.gameConfig)
+        self.battleground.towers.towers[0][1] = BgTowerState(0)
+
+    def tearDown(self):
+        self.pool.executor.shutdown()
+
+    async def test_concurrentBattlesShared(self):
+        results = await asyncio.gather(
+            self.pool.computeBattle(self.battleground, [0, 1]),
+            self.pool.computeBattle(self.battleground, [0, 1]),
+            self.pool.computeBattle(self.battleground, [1]))
+
+        self.assertEqual(self.pool.numDeduplicated, 1)
+        self.assertEqual(results[0].results, results[1].results)
+        self.assertNotEqual(results[0].results, results[2].results)
+        self.assertEqual(self.pool.inFlight, {})
+
+    async def test_cancelledRequestDoesntCancelOthers(self):
+        first = asyncio.ensure_future(self.pool.computeBattle(self.battleground, [0]))
+        second = asyncio.ensure_future(self.pool.computeBattle(self.battleground, [0]))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        results = await second
+
+        self.assertEqual(len(results.results.monstersDefeated), 1)
+
+    async def test_interactiveBattlesJumpQueue(self):
+        pool = BattleComputerPool(test_data.gameConfig, numWorkers = 1)
+        try:
+            background = [pool.computeBattle(self.battleground, wave, BattlePriority.BACKGROUND)
+                for wave in [[0], [1], [0, 1]]]
+            interactive = pool.computeBattle(self.battleground, [1, 0], BattlePriority.INTERACTIVE)
+            stats = pool.getStats()["priorities"]
+            self.assertEqual(stats["background"]["running"], 1)
+            self.assertEqual(stats["background"]["queued"], 2)
+            self.assertEqual(stats["interactive"]["queued"], 1)
+
+            await interactive
+
+            # Only the background battle which was already running went first.
+            stats = pool.getStats()["priorities"]
+            self.assertEqual(stats["interactive"]["numStarted"], 1)
+            self.assertEqual(stats["background"]["numStarted"], 2)
+            await asyncio.gather(*background)
+        finally:
+            pool.executor.shutdown()
+
+    async def test_backgroundBattlesCapped(self):
+        pool = BattleComputerPool(test_data.gameConfig, numWorkers = 2)
+        try:
+            background = [pool.computeBattle(self.battleground, wave, BattlePriority.BACKGROUND)
+                for wave in [[0], [1]]]
+            view = pool.computeBattle(self.battleground, [0, 1], BattlePriority.VIEW)
+            # A queued background battle is promoted when it's also needed sooner.
+            promoted = pool.computeBattle(self.battleground, [1], BattlePriority.VIEW)
+
+            stats = pool.getStats()["priorities"]
+            self.assertEqual(stats["background"]["running"], 1)
+            self.assertEqual(stats["view"]["running"], 1)
+            self.assertEqual(stats["view"]["queued"], 1)
+            await asyncio.gather(view, promoted, *background)
+            self.assertEqual(pool.getStats()["priorities"]["view"]["numStarted"], 2)
+        finally:
+            pool.executor.shutdown()
+
+    async def test_staleBattlesCancelled(self):
+        pool = BattleComputerPool(test_data.gameConfig, numWorkers = 1)
+        try:
+            # A long battle to keep the only worker busy.
+            running = pool.computeBattle(self.battleground, [0] * 500, BattlePriority.BACKGROUND,
+                BattleTag("bob_uid", 0, "sue_uid", 0))
+            queued = pool.computeBattle(self.battleground, [1], BattlePriority.BACKGROUND,
+                BattleTag("bob_uid", 0, "joe_uid", 3))
+            untagged = pool.computeBattle(self.battleground, [0, 1])
+
+            # Bob changed their wave.
+            pool.cancelStale({"bob_uid": 1}, {})
+
+            with self.assertRaises(StaleBattleException):
+                await running
+            with self.assertRaises(StaleBattleException):
+                await queued
+            await untagged
+            stats = pool.getStats()["priorities"]["background"]
+            self.assertEqual(stats["numCancelled"], 2)
+            self.assertEqual(stats["numStarted"], 1)
+            self.assertEqual(pool.inFlight, {})
+            self.assertEqual(pool.jobsByUid, {})
+        finally:
+            pool.executor.shutdown()
+
+    async def test_newerRequestsKept(self):
+        pool = BattleComputerPool(test_data.gameConfig, numWorkers = 1)
+        try:
+            stale = pool.computeBattle(self.battleground, [0], tag = BattleTag("bob_uid", 0, "sue_uid", 0))
+            # The same battle was also requested for a newer version of sue's battleground.
+            current = pool.computeBattle(self.battleground, [0], tag = BattleTag("bob_uid", 0, "sue_uid", 1))
+
+            pool.cancelStale({}, {"sue_uid": 1})
+
+            with self.assertRaises(StaleBattleException):
+                await stale
+            results = await current
+            self.assertEqual(len(results.results.monstersDefeated), 1)
+        finally:
+            pool.executor.shutdown()
+
+    async def test_resultsSharedWithoutCopying(self):
+        pool = BattleComputerPool(test_data.gameConfig, numWorkers = 1)
+        try:
+            expected = BattleComputer(test_data.gameConfig).computeBattle(self.battleground, [0, 1])
+
+            results = await pool.computeBattle(self.battleground, [0, 1])
+
+            self.assertEqual(pool.numSharedResults, 1)
+            self.assertEqual(results.results, expected.results)
+            self.assertEqual(results.fb.EventsAsNumpy().tobytes(), expected.fb.EventsAsNumpy().tobytes())
+            # The block is in use until the results are dropped.
+            self.assertEqual(len(pool.resultArena.freeBlocks), 1)
+            del results
+            # Let the future's done callbacks run so they drop it too.
+            await asyncio.sleep(0)
+            self.assertEqual(len(pool.resultArena.freeBlocks), 2)
+        finally:
+            pool.executor.shutdown()
+
+    async def test_largeResultsPiped(self):
+        pool = BattleComputerPool(test_data.gameConfig, numWorkers = 1, resultBlockSize = 16)
+        try:
+            results = await pool.computeBattle(self.battleground, [0, 1])
+
+            self.assertEqual(pool.numPipedResults, 1)
+            self.assertEqual(len(results.results.monstersDefeated), 2)
+            self.assertEqual(len(pool.resultArena.freeBlocks), 2)
+        finally:
+            pool.executor.shutdown()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,7 @@ from typing import List, Tuple, Dict, Optional
 from enum import Enum, unique, auto
 from pathlib import Path
 import json
+import ctypes
 
 import attr
 import cattr
@@ -14,7 +15,7 @@ import hypothesis.strategies as st
 from infinitd_server.game_config import GameConfig, GameConfigData, CellPos, Row, Col, Url, MonsterConfig, ConfigId, TowerConfig
 from infinitd_server.battleground_state import BattlegroundState, BgTowerState, TowerId
 from infinitd_server.battle import Battle, BattleEvent, MoveEvent, DeleteEvent, DamageEvent, ObjectType, EventType, FpCellPos, FpRow, FpCol, BattleResults
-from infinitd_server.battle_computer import BattleComputer, MonsterState, TowerState
+from infinitd_server.battle_computer import BattleComputer, BattleCalculationException, MonsterState, TowerState
 from infinitd_server.game_config import ConfigId, CellPos, Row, Col
 from infinitd_server.paths import pathExists
 import InfiniTDFb.BattleEventsFb as BattleEventsFb
@@ -125,6 +126,10 @@ class TestRandomBattlesRealConfig(unittest.TestCase):
         tripleEncodedEventsBytes = remadeBattle.encodeEventsFb()
         # This should stay the same.
         self.assertEqual(reencodedEventsBytes, tripleEncodedEventsBytes)
+        # The native encoder should agree with the pure-Python builder.
+        self.assertEqual(
+            Battle.decodeEventsFb(battle.encodeEventsFbWithBuilder()),
+            Battle.decodeEventsFb(reencodedEventsBytes))
 
         # Map every projectile fired to the tower it fired from.
         projFiredFrom: Dict[FpCellPos, List[MoveEvent]] = defaultdict(list)
@@ -338,6 +343,19 @@ class TestTowerFiringLongColumn(unittest.TestCase):
         # Ensure every shot fired corresponds to damage dealt.
         self.assertEqual(len(towerEvents), len(damageEvents), msg="Shots fired don't match damage events.")
 
+class TestCancelBattle(unittest.TestCase):
+    def test_cancelledBattleStops(self):
+        battleComputer = BattleComputer(gameConfig = test_data.gameConfig)
+        battleground = BattlegroundState.empty(test_data.gameConfig)
+        cancelled = ctypes.c_byte(0)
+
+        results = battleComputer.computeBattle(battleground, [0], ctypes.addressof(cancelled))
+        self.assertEqual(len(results.results.monstersDefeated), 1)
+
+        cancelled.value = 1
+        with self.assertRaises(BattleCalculationException):
+            battleComputer.computeBattle(battleground, [0], ctypes.addressof(cancelled))
+
 class TestBattleEventEncodingAndDecoding(unittest.TestCase):
     def setUp(self):
         self.maxDiff = None
@@ -422,3 +440,57 @@ class TestBattleEventEncodingAndDecoding(unittest.TestCase):
         decodedResultsFb = BattleResults.decodeFb(encodedResultsFb)
 
         self.assertEqual(battle.results, decodedResultsFb)
+
+    def test_allEventTypesMatchBuilder(self):
+        battle = Battle(
+            name = "testAllEventTypes",
+            attackerName = "test attacker",
+            defenderName = "test defender",
+            events = [
+                MoveEvent(
+                    objType = ObjectType.PROJECTILE,
+                    id = 2,
+                    configId = ConfigId(1),
+                    startPos = FpCellPos(FpRow(1.25), FpCol(0.5)),
+                    destPos = FpCellPos(FpRow(0), FpCol(2)),
+                    startTime = 0.5,
+                    endTime = 1.0,
+                ),
+                DamageEvent(
+                    id = 1,
+                    startTime = 1.0,
+                    health = 2.5,
+                ),
+                DeleteEvent(
+                    objType = ObjectType.PROJECTILE,
+                    id = 2,
+                    startTime = 1.0,
+                ),
+            ],
+            results = BattleResults(
+                monstersDefeated = {ConfigId(0): (0, 1)},
+                bonuses = [],
+                reward = 0.0,
+                timeSecs = 1.0)
+        )
+
+        decodedEventsFb = Battle.decodeEventsFb(battle.encodeEventsFb())
+        decodedEventsBuilder = Battle.decodeEventsFb(battle.encodeEventsFbWithBuilder())
+
+        self.assertEqual(battle.events, decodedEventsFb)
+        self.assertEqual(decodedEventsBuilder, decodedEventsFb)
+
+    def test_noEvents(self):
+        battle = Battle(
+            name = "testNoEvents",
+            attackerName = "test attacker",
+            defenderName = "test defender",
+            events = [],
+            results = BattleResults(
+                monstersDefeated = {},
+                bonuses = [],
+                reward = 0.0,
+                timeSecs = 0.0)
+        )
+
+        self.assertEqual(Battle.decodeEventsFb(battle.encodeEventsFb()), [])
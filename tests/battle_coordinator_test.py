@@ -0,0 +1,183 @@
+import asyncio
+import json
+import time
+import unittest
+
+from aiounittest import AsyncTestCase
+import attr
+import cattr
+
+from infinitd_server.battle import (Battle, BattleResults, MoveEvent, DeleteEvent, DamageEvent, ObjectType,
+    FpCellPos, FpRow, FpCol)
+from infinitd_server.battle_coordinator import (BattleCoordinator, BattleScheduler, StreamingBattle,
+    BattleEventFrame, BattleSnapshot, BattleMetadata, LiveBattleMetadata, BattleStatus)
+from infinitd_server.game_config import ConfigId
+from infinitd_server.logger import Logger, MockLogger
+from infinitd_server.sse import SseQueues
+
+def makeMove(id: int, startTime: float, objType: ObjectType = ObjectType.MONSTER) -> MoveEvent:
+    return MoveEvent(
+        objType = objType,
+        id = id,
+        configId = ConfigId(0),
+        startPos = FpCellPos(FpRow(1), FpCol(0)),
+        destPos = FpCellPos(FpRow(0), FpCol(0)),
+        startTime = startTime,
+        endTime = startTime + 1.0)
+
+def makeBattle(name: str, eventTimes) -> Battle:
+    return Battle(name = name, attackerName = "attacker", defenderName = "defender",
+        events = [makeMove(i, startTime) for (i, startTime) in enumerate(eventTimes)],
+        results = BattleResults(monstersDefeated = {}, bonuses = [], reward = 0.0, timeSecs = 1.0))
+
+class TestBattleScheduler(AsyncTestCase):
+    def setUp(self):
+        Logger.setDefault(MockLogger())
+        self.scheduler = BattleScheduler()
+
+    def makeStreamingBattle(self, sentTimes):
+        "Records how far into the battle each event was sent."
+        battle = StreamingBattle(None, self.scheduler)
+        async def updateFn(update):
+            if isinstance(update, MoveEvent):
+                sentTimes.append((update.id, time.time() - battle.startTime, update.startTime))
+        battle.updateFn = updateFn
+        return battle
+
+    async def test_eventsSentOnTime(self):
+        sentTimes = ([], [])
+        battles = [self.makeStreamingBattle(times) for times in sentTimes]
+        results = []
+        async def onResults(battleResults):
+            results.append(battleResults)
+
+        await asyncio.gather(
+            battles[0].start(makeBattle("a", [0.0, 0.2, 0.25, 0.6]), onResults),
+            battles[1].start(makeBattle("b", [0.1, 0.4]), onResults))
+
+        self.assertEqual([[id for (id, _, _) in times] for times in sentTimes], [[0, 1, 2, 3], [0, 1]])
+        for times in sentTimes:
+            for (_, sentTime, eventTime) in times[1:]:
+                # Up to the buffer early, but never late.
+                self.assertLessEqual(sentTime, eventTime)
+                self.assertGreaterEqual(sentTime, eventTime - StreamingBattle.BUFFER_TIME_SECS - 0.01)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(self.scheduler.numScheduled, 0)
+
+    async def test_stopBattle(self):
+        sentTimes = []
+        battle = self.makeStreamingBattle(sentTimes)
+        async def onResults(battleResults):
+            self.fail("A stopped battle has no results.")
+
+        running = asyncio.ensure_future(battle.start(makeBattle("a", [0.0, 0.3, 10.0]), onResults))
+        await asyncio.sleep(0.4)
+        await battle.stop()
+        await asyncio.wait_for(running, 1)
+
+        self.assertEqual([id for (id, _, _) in sentTimes], [0, 1])
+        self.assertEqual(battle.join(), [BattleMetadata(status = BattleStatus.PENDING, name = "a",
+            attackerName = "attacker", defenderName = "defender")])
+
+class TestBattleSnapshot(unittest.TestCase):
+    def test_keepsCurrentState(self):
+        snapshot = BattleSnapshot()
+        events = [
+            makeMove(0, 0.0),
+            makeMove(1, 0.2, ObjectType.PROJECTILE),
+            DamageEvent(id = 0, startTime = 0.5, health = 8.0),
+            DeleteEvent(objType = ObjectType.PROJECTILE, id = 1, startTime = 0.7),
+            makeMove(0, 1.0),
+            DamageEvent(id = 0, startTime = 1.5, health = 6.0),
+            makeMove(2, 1.8),
+            makeMove(0, 2.0),
+        ]
+        for event in events:
+            # Each event is sent a little early.
+            snapshot.add(event, event.startTime - 0.05)
+
+        # The last move has been sent but hasn't started.
+        self.assertEqual(snapshot.events(1.96), [makeMove(0, 1.0), events[5], makeMove(2, 1.8), makeMove(0, 2.0)])
+        self.assertEqual(snapshot.events(2.0), [events[5], makeMove(2, 1.8), makeMove(0, 2.0)])
+
+    def test_pendingDelete(self):
+        snapshot = BattleSnapshot()
+        delete = DeleteEvent(objType = ObjectType.MONSTER, id = 0, startTime = 1.0)
+        snapshot.add(makeMove(0, 0.0), 0.0)
+        snapshot.add(delete, 0.95)
+
+        self.assertEqual(snapshot.events(0.95), [makeMove(0, 0.0), delete])
+        snapshot.add(makeMove(1, 1.1), 1.05)
+        self.assertEqual(snapshot.objects.keys(), {(ObjectType.MONSTER, 1)})
+
+class TestBattleCoordinator(AsyncTestCase):
+    def setUp(self):
+        Logger.setDefault(MockLogger())
+
+    async def test_joinLongBattle(self):
+        battleQueues = SseQueues()
+        coordinator = BattleCoordinator(battleQueues)
+        # One monster making many short moves.
+        battle = attr.evolve(makeBattle("a", []), events = [makeMove(0, i * 0.01) for i in range(100)])
+        async def onResults(battleResults):
+            pass
+        async def onEnd():
+            pass
+
+        coordinator.startBattle("bob", battle, resultsCallback = onResults, endCallback = onEnd)
+        await asyncio.sleep(0.3)
+        joined = coordinator.getBattle("bob").join()
+        rejoined = coordinator.getBattle("bob").joinFrames(reset = True)
+        await coordinator.stopBattle("bob")
+
+        self.assertLess(len(joined), 15)
+        self.assertIsInstance(joined[-1], LiveBattleMetadata)
+        # The move being made now is the earliest one sent.
+        self.assertLessEqual(joined[0].startTime, joined[-1].time)
+        self.assertGreater(joined[1].startTime, joined[-1].time)
+        # Clients which missed updates are told to forget the battle first.
+        self.assertEqual([type(update) for update in rejoined], [BattleMetadata, BattleEventFrame, LiveBattleMetadata])
+
+    async def test_evictIdleBattles(self):
+        battleQueues = SseQueues()
+        coordinator = BattleCoordinator(battleQueues)
+        coordinator.getBattle("bob")
+        coordinator.getBattle("sue")
+        later = time.time() + BattleCoordinator.IDLE_SECS + 1
+
+        with battleQueues.queue_context("sue"):
+            self.assertEqual(coordinator.evictIdleBattles(time.time()), 0)
+            self.assertEqual(coordinator.evictIdleBattles(later), 1)
+        self.assertEqual(set(coordinator.battles.keys()), {"sue"})
+        self.assertEqual(coordinator.getStats()["battles"], 1)
+        self.assertEqual(coordinator.evictIdleBattles(later), 1)
+        self.assertEqual(coordinator.battles, {})
+
+    async def test_framedEvents(self):
+        battleQueues = SseQueues()
+        frameQueues = SseQueues()
+        coordinator = BattleCoordinator(battleQueues, frameQueues)
+        battle = makeBattle("a", [0.0, 0.01, 0.2, 0.21, 0.22, 0.4])
+        ended = asyncio.Event()
+        async def onResults(battleResults):
+            pass
+        async def onEnd():
+            ended.set()
+
+        with battleQueues.queue_context("bob") as eventQueue, frameQueues.queue_context("bob") as frameQueue:
+            coordinator.startBattle("bob", battle, resultsCallback = onResults, endCallback = onEnd)
+            await asyncio.wait_for(ended.wait(), 2)
+            updates = [eventQueue.get_nowait() for _ in range(eventQueue.qsize())]
+            frameUpdates = [frameQueue.get_nowait() for _ in range(frameQueue.qsize())]
+
+        # Old clients still get each event on its own.
+        self.assertEqual([update for update in updates if isinstance(update, MoveEvent)], battle.events)
+        frames = [update for update in frameUpdates if isinstance(update, BattleEventFrame)]
+        self.assertLess(len(frames), len(battle.events))
+        framedEvents = [event for frame in frames for event in json.loads(frame.toJson())["events"]]
+        self.assertEqual(framedEvents, cattr.unstructure(battle.events))
+        self.assertEqual([type(update) for update in frameUpdates if not isinstance(update, BattleEventFrame)],
+            [BattleMetadata, LiveBattleMetadata, BattleResults])
+
+if __name__ == "__main__":
+    unittest.main()
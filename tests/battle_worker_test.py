@@ -0,0 +1,112 @@
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from aiounittest import AsyncTestCase
+import cattr
+
+from infinitd_server.battle_computer import BattleComputer
+from infinitd_server.battle_computer_pool import BattleComputerPool, BattlePriority
+from infinitd_server.battleground_state import BattlegroundState, BgTowerState
+from infinitd_server.game_config import GameConfig, GameConfigData
+from infinitd_server.logger import Logger, MockLogger
+
+import test_data
+
+class TestBattleWorker(AsyncTestCase):
+    def setUp(self):
+        Logger.setDefault(MockLogger())
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.gameConfigPath = os.path.join(self.tmpDir.name, "game_config.json")
+        with open(self.gameConfigPath, "w") as gameConfigFile:
+            gameConfigFile.write(json.dumps(cattr.unstructure(test_data.gameConfigData)))
+        # Load the config the same way as the workers so they agree on it.
+        with open(self.gameConfigPath) as gameConfigFile:
+            self.gameConfig = GameConfig.fromGameConfigData(
+                cattr.structure(json.loads(gameConfigFile.read()), GameConfigData))
+        self.workerProcesses = []
+        self.pool = BattleComputerPool(self.gameConfig, numWorkers = 1)
+        self.battleground = BattlegroundState.empty(self.gameConfig)
+        self.battleground.towers.towers[0][1] = BgTowerState(0)
+
+    def tearDown(self):
+        self.pool.executor.shutdown()
+        for process in self.workerProcesses:
+            process.kill()
+            process.wait()
+        self.tmpDir.cleanup()
+
+    def startWorker(self) -> str:
+        "Start a battle worker daemon and return its address."
+        socketPath = os.path.join(self.tmpDir.name, f"worker{len(self.workerProcesses)}.sock")
+        self.workerProcesses.append(subprocess.Popen([sys.executable, "-m", "infinitd_server.battle_worker",
+            "--game-config", self.gameConfigPath, "--unix-socket", socketPath, "--workers", "1",
+            "--log-db", os.path.join(self.tmpDir.name, "logs.db")]))
+        return socketPath
+
+    async def waitUntilHealthy(self, workers):
+        for _ in range(200):
+            if all(worker.healthy for worker in workers):
+                return
+            await asyncio.sleep(0.1)
+        self.fail("Battle workers never became healthy.")
+
+    async def test_battlesSpreadAcrossWorkers(self):
+        workers = [self.pool.addRemoteWorker(self.startWorker(), healthCheckSecs = 0.1) for _ in range(2)]
+        await self.waitUntilHealthy(workers)
+        waves = [[0], [1], [0, 1], [1, 0], [0, 0], [1, 1]]
+
+        battles = [self.pool.computeBattle(self.battleground, wave) for wave in waves]
+        self.assertEqual([worker.numRunning for worker in workers], [1, 1])
+        results = await asyncio.gather(*battles)
+
+        battleComputer = BattleComputer(self.gameConfig)
+        for (wave, result) in zip(waves, results):
+            expected = battleComputer.computeBattle(self.battleground, wave)
+            self.assertEqual(result.results, expected.results)
+            self.assertEqual(result.fb.EventsAsNumpy().tobytes(), expected.fb.EventsAsNumpy().tobytes())
+        self.assertGreaterEqual(self.pool.numRemoteResults, 2)
+        for worker in workers:
+            worker.close()
+
+    async def test_lostWorkerRetried(self):
+        worker = self.pool.addRemoteWorker(self.startWorker(), healthCheckSecs = 0.1)
+        await self.waitUntilHealthy([worker])
+        # Keep the local worker busy so the next battle goes to the remote worker.
+        local = self.pool.computeBattle(self.battleground, [0] * 200)
+        remote = self.pool.computeBattle(self.battleground, [1] * 200)
+        self.assertEqual(worker.numRunning, 1)
+
+        self.workerProcesses[0].send_signal(signal.SIGKILL)
+        await asyncio.gather(local, remote)
+
+        self.assertEqual(self.pool.numRetried, 1)
+        self.assertFalse(worker.healthy)
+        self.assertEqual(len((await remote).results.monstersDefeated), 1)
+        worker.close()
+
+    async def test_moreUrgentDuplicateWhileRunningRemotely(self):
+        worker = self.pool.addRemoteWorker(self.startWorker(), healthCheckSecs = 0.1)
+        await self.waitUntilHealthy([worker])
+        local = self.pool.computeBattle(self.battleground, [0] * 200)
+        remote = self.pool.computeBattle(self.battleground, [1] * 200, BattlePriority.BACKGROUND)
+        self.assertEqual(worker.numRunning, 1)
+
+        # The running job is shared, not moved between queues.
+        duplicate = self.pool.computeBattle(self.battleground, [1] * 200, BattlePriority.INTERACTIVE)
+        results = await asyncio.gather(local, remote, duplicate)
+
+        self.assertEqual(results[1].results, results[2].results)
+        self.assertEqual(self.pool.numDeduplicated, 1)
+        self.assertEqual({priority: stats.queued for (priority, stats) in self.pool.stats.items()},
+            {priority: 0 for priority in BattlePriority})
+        self.assertEqual(self.pool.stats[BattlePriority.BACKGROUND].running, 0)
+        worker.close()
+
+if __name__ == "__main__":
+    unittest.main()
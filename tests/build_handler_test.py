@@ -23,7 +23,7 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
         self.gameConfig = test_data.gameConfig
         self.game = Game(self.gameConfig, dbPath = self.dbPath)
 
-        self.game.register(uid="test_uid", name="bob")
+        self.game._db.register(uid="test_uid", name="bob")
 
         return tornado.web.Application([ (r"/build/(.*)", BuildHandler, dict(game=self.game)) ])
 
@@ -38,8 +38,8 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
                 "/build/bob",
                 method="POST",
                 body='{"rows": [0], "cols": [1], "towerIds": [0]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 201)
         expectedBg = BattlegroundState.empty(self.gameConfig)
@@ -55,8 +55,8 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
                 "/build/bob",
                 method="POST",
                 body='{"rows": [0,1,2], "cols": [1,1,1], "towerIds": [0,0,0]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 201)
         expectedBg = BattlegroundState.empty(self.gameConfig)
@@ -84,7 +84,7 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
                 "/build/phil",
                 method="POST",
                 body='{"rows": [1], "cols": [1], "towerIds": [0]}')
-        battleground = self.game.getBattleground("bob")
+        battleground = self.game._db.getBattleground("bob")
 
         self.assertEqual(resp.code, 403)
         self.assertEqual(battleground, BattlegroundState.empty(self.gameConfig))
@@ -100,7 +100,7 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
                 "/build/bob",
                 method="POST",
                 body='{"rows": [3], "cols": [3], "towerIds": [0]}')
-        battleground = self.game.getBattleground("bob")
+        battleground = self.game._db.getBattleground("bob")
 
         self.assertEqual(resp.code, 409)
         self.assertEqual(resp2.code, 409)
@@ -113,15 +113,15 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
                 "/build/bob",
                 method="POST",
                 body='{"rows": [1], "cols": [2], "towerIds": [1]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 409)
         self.assertEqual(battleground, BattlegroundState.empty(self.gameConfig))
         self.assertEqual(user.gold, 100)
 
     def test_insufficientGoldMultiple(self):
-        with self.game.getMutableUserContext("test_uid", "bob") as user:
+        with self.game._db.getMutableUserContext("test_uid") as user:
             user.gold = 2
 
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
@@ -130,8 +130,8 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
                 "/build/bob",
                 method="POST",
                 body='{"rows": [1,2,3], "cols": [1,1,1], "towerIds": [0,0,0]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 409)
         self.assertEqual(battleground, BattlegroundState.empty(self.gameConfig))
@@ -150,8 +150,8 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
                 "/build/bob",
                 method="POST",
                 body='{"rows": [2], "cols": [1], "towerIds": [2]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 409)
         expectedBg = BattlegroundState.empty(self.gameConfig)
@@ -168,8 +168,8 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
                 "/build/bob",
                 method="POST",
                 body='{"rows": [2,2], "cols": [1,1], "towerIds": [0,2]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 409)
         self.assertEqual(battleground, BattlegroundState.empty(self.gameConfig))
@@ -177,7 +177,7 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
         self.assertEqual(user.gold, 100) # pytype: disable=attribute-error
 
     def test_blocksPath(self):
-        with self.game.getMutableUserContext("test_uid", "bob") as user:
+        with self.game._db.getMutableUserContext("test_uid") as user:
             user.battleground.towers.towers[1][0] = BgTowerState(0)
             expectedBattleground = user.battleground
             expectedGold = user.gold
@@ -188,8 +188,8 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
                 "/build/bob",
                 method="POST",
                 body='{"rows": [0], "cols": [1], "towerIds": [0]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 409)
         self.assertEqual(battleground, expectedBattleground)
@@ -197,16 +197,16 @@ class TestBuildHandler(tornado.testing.AsyncHTTPTestCase):
         self.assertEqual(user.gold, expectedGold) # pytype: disable=attribute-error
 
     def test_blocksPathMultiple(self):
-        initialUser = self.game.getUserSummaryByName("bob")
-        expectedBattleground = self.game.getBattleground("bob")
+        initialUser = self.game._db.getUserSummaryByName("bob")
+        expectedBattleground = self.game._db.getBattleground("bob")
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch(
                 "/build/bob",
                 method="POST",
                 body='{"rows": [1, 0], "cols": [0, 1], "towerIds": [0, 0]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 409)
         self.assertEqual(battleground, expectedBattleground)
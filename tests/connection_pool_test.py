@@ -0,0 +1,95 @@
+import unittest
+import tempfile
+import os
+import sqlite3
+import threading
+
+from infinitd_server.connection_pool import ConnectionPool
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        tmp_file, tmp_path = tempfile.mkstemp()
+        self.dbPath = tmp_path
+        self.numSetups = 0
+        def setupConnection(conn: sqlite3.Connection):
+            self.numSetups += 1
+            conn.create_function("double", 1, lambda x: 2 * x)
+        self.setupConnection = setupConnection
+        with sqlite3.connect(self.dbPath) as conn:
+            conn.execute("CREATE TABLE numbers(x INTEGER);")
+
+    def tearDown(self):
+        os.remove(self.dbPath)
+
+    def test_reusesConnections(self):
+        pool = ConnectionPool(self.dbPath, self.setupConnection)
+
+        for _ in range(10):
+            with pool.connection() as conn:
+                self.assertEqual(conn.execute("SELECT double(2);").fetchone()[0], 4)
+
+        self.assertEqual(pool.numCreated, 1)
+        self.assertEqual(self.numSetups, 1)
+        pool.close()
+
+    def test_noIdleConnections(self):
+        pool = ConnectionPool(self.dbPath, self.setupConnection, maxIdle = 0)
+
+        for _ in range(3):
+            with pool.connection() as conn:
+                conn.execute("SELECT 1;")
+
+        self.assertEqual(pool.numCreated, 3)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1;")
+
+    def test_countsConcurrentAcquires(self):
+        pool = ConnectionPool(self.dbPath, self.setupConnection)
+        numThreads = 8
+        barrier = threading.Barrier(numThreads)
+        conns = []
+        def acquire():
+            barrier.wait()
+            conns.append(pool.acquire())
+        threads = [threading.Thread(target = acquire) for _ in range(numThreads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(pool.numCreated, numThreads)
+        for conn in conns:
+            pool.release(conn)
+        pool.close()
+
+    def test_commitsOnSuccess(self):
+        pool = ConnectionPool(self.dbPath, self.setupConnection)
+
+        with pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO numbers (x) VALUES (1);")
+
+        with pool.connection() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM numbers;").fetchone()[0], 1)
+        pool.close()
+
+    def test_rollsBackOnRelease(self):
+        pool = ConnectionPool(self.dbPath, self.setupConnection)
+
+        with self.assertRaises(ValueError):
+            with pool.connection() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("INSERT INTO numbers (x) VALUES (1);")
+                raise ValueError("Abort the transaction")
+        conn = pool.acquire()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("INSERT INTO numbers (x) VALUES (2);")
+        pool.release(conn)
+
+        with pool.connection() as conn:
+            self.assertFalse(conn.in_transaction)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM numbers;").fetchone()[0], 0)
+        pool.close()
+
+if __name__ == "__main__":
+    unittest.main()
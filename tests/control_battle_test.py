@@ -20,8 +20,8 @@ class TestControlBattleHandler(tornado.testing.AsyncHTTPTestCase):
         self.gameConfig = test_data.gameConfig
         self.game = Game(self.gameConfig, dbPath = self.dbPath)
 
-        self.game.register(uid="test_uid", name="bob")
-        with self.game.getMutableUserContext("test_uid", "bob") as user:
+        self.game._db.register(uid="test_uid", name="bob")
+        with self.game._db.getMutableUserContext("test_uid") as user:
             user.wave = [ConfigId(0)]
 
         return tornado.web.Application([
@@ -5,7 +5,7 @@ import asyncio
 
 from aiounittest import AsyncTestCase
 
-from infinitd_server.db import Db
+from infinitd_server.db import BattleJobState, Db
 from infinitd_server.battleground_state import BattlegroundState, BgTowerState
 from infinitd_server.battle_coordinator import BattleCoordinator
 from infinitd_server.game_config import PlayfieldConfig, CellPos, Row, Col, TowerConfig, GameConfig, MiscConfig
@@ -78,7 +78,57 @@ class TestDb(AsyncTestCase):
         sue = self.db.getUserSummaryByName("sue")
         self.assertIsNotNone(sue)
         self.assertEqual(sue.gold, 100) # pytype: disable=attribute-error
-    
+
+    async def test_accumulateGoldSettlesOnChange(self):
+        self.db.register(uid="foo", name="bob")
+        await self.db.accumulateGold()
+        await self.db.accumulateGold()
+
+        # Gold earned so far must be kept when the rate changes.
+        with self.db.getMutableUserContext("foo") as user:
+            self.assertEqual(user.gold, 102)
+            user.goldPerMinuteSelf = 3.0
+        await self.db.accumulateGold()
+        # Nothing is earned while in a battle.
+        self.db.setInBattle("bob", True)
+        await self.db.accumulateGold()
+        self.db.setInBattle("bob", False)
+        await self.db.accumulateGold()
+
+        bob = self.db.getUserSummaryByName("bob")
+        self.assertEqual(bob.gold, 108) # pytype: disable=attribute-error
+        self.assertEqual(bob.accumulatedGold, 108) # pytype: disable=attribute-error
+
+    async def test_accumulateGoldUpdatesRivals(self):
+        self.db.register(uid="foo", name="bob")
+        self.db.register(uid="bar", name="sue")
+        self.db.register(uid="baz", name="joe")
+        self.db.register(uid="qux", name="ann")
+        with self.db.getMutableUserContext("foo") as user:
+            user.accumulatedGold = 10
+            user.goldPerMinuteSelf = 0
+        with self.db.getMutableUserContext("bar") as user:
+            user.accumulatedGold = 9
+            user.goldPerMinuteSelf = 5
+        with self.db.getMutableUserContext("baz") as user:
+            user.accumulatedGold = 5
+            user.goldPerMinuteSelf = 0
+        with self.db.getMutableUserContext("qux") as user:
+            user.accumulatedGold = 1
+            user.goldPerMinuteSelf = 0
+
+        # Sue overtakes bob which only changes the rivals of bob, sue and joe.
+        with self.db.rivalsQueues.queue_context("bob") as bobQueue, \
+                self.db.rivalsQueues.queue_context("sue") as sueQueue, \
+                self.db.rivalsQueues.queue_context("joe") as joeQueue, \
+                self.db.rivalsQueues.queue_context("ann") as annQueue:
+            await self.db.accumulateGold()
+
+            self.assertEqual(bobQueue.get_nowait(), Rivals(["sue"], ["joe"]))
+            self.assertEqual(sueQueue.get_nowait(), Rivals([], ["bob"]))
+            self.assertEqual(joeQueue.get_nowait(), Rivals(["bob"], ["ann"]))
+            self.assertTrue(annQueue.empty())
+
     def test_getUserRivals(self):
         self.db.register(uid="foo", name="bob")
         self.db.register(uid="bar", name="sue")
@@ -97,7 +147,18 @@ class TestDb(AsyncTestCase):
         self.assertEqual(bob_rivals, Rivals([], ["sue"]))
         self.assertEqual(sue_rivals, Rivals(["bob"], ["joe"]))
         self.assertEqual(joe_rivals, Rivals(["sue"], []))
-    
+
+    def test_getUsers(self):
+        self.db.register(uid="foo", name="bob")
+        self.db.register(uid="bar", name="sue")
+        self.db.register(uid="baz", name="joe")
+        with self.db.getMutableUserContext("bar") as user:
+            user.accumulatedGold = 500
+        self.db.deleteAccount("baz")
+
+        self.assertEqual([user.name for user in self.db.getUsers()], ["sue", "bob"])
+        self.assertEqual([user.name for user in self.db.getUsers(start=1, count=5)], ["bob"])
+
     def test_findMissingBattles(self):
         self.db.register(uid="bob_uid", name="bob")
         self.db.register(uid="sue_uid", name="sue")
@@ -149,5 +210,114 @@ class TestDb(AsyncTestCase):
         # No battles involve joe defending so they shouldn't be updated.
         self.assertEqual(joe.goldPerMinuteOthers, 9.0)
 
+    async def test_updateGoldPerMinuteOthersUnchanged(self):
+        self.db.register(uid="bob_uid", name="bob")
+        self.db.register(uid="sue_uid", name="sue")
+        with self.db.getMutableUserContext("bob_uid") as user:
+            user.wave = [0]
+        with self.db.getMutableUserContext("sue_uid") as user:
+            user.wave = [0]
+        self.db.addTestBattle("sue_uid", "bob_uid", goldPerMinute=1.0)
+        self.db.updateGoldPerMinuteOthers()
+        await self.db.accumulateGold()
+
+        def settledTick():
+            with self.db.makeConnection() as conn:
+                return conn.execute("SELECT goldSettledTick FROM users WHERE name = 'bob';").fetchone()[0]
+        tick = settledTick()
+        with self.db.userQueues.queue_context("bob") as bobQueue:
+            # Nothing changed so bob's gold isn't settled and no update is sent.
+            self.db.updateGoldPerMinuteOthers()
+            await asyncio.sleep(0)
+            self.assertTrue(bobQueue.empty())
+        self.assertEqual(settledTick(), tick)
+
+    def test_inputVersionsIncrement(self):
+        self.db.register(uid="foo", name="bob")
+        with self.db.getMutableUserContext("foo") as user:
+            user.gold = 5
+        with self.db.getMutableUserContext("foo") as user:
+            user.wave = [0]
+        with self.db.getMutableUserContext("foo") as user:
+            user.battleground.towers.towers[0][1] = BgTowerState(0)
+
+        bob = self.db.getUserByUid("foo")
+        self.assertEqual(bob.waveVersion, 1) # pytype: disable=attribute-error
+        self.assertEqual(bob.battlegroundVersion, 1) # pytype: disable=attribute-error
+
+    async def test_staleBattleNotSaved(self):
+        self.db.register(uid="foo", name="bob")
+        with self.db.getMutableUserContext("foo") as user:
+            user.wave = [0]
+        staleAttacker = self.db.getUserSummaryByUid("foo")
+        with self.db.getMutableUserContext("foo") as user:
+            user.wave = [0, 1]
+        defender = self.db.getUserByUid("foo")
+
+        battle = await self.db.getOrMakeBattle(staleAttacker, defender, "test", -1)
+
+        # The battle is recalculated with the latest wave before it's saved.
+        self.assertEqual(len(battle.results.monstersDefeated), 2)
+        self.assertEqual(self.db.getBattle(staleAttacker, defender), battle)
+
+    def test_battleJobsQueuedOnChange(self):
+        self.db.register(uid="foo", name="bob")
+        self.db.register(uid="bar", name="sue")
+        with self.db.getMutableUserContext("foo") as user:
+            user.wave = [0]
+
+        # Sue has no wave so she can't attack.
+        jobs = self.db.claimBattleJobs(10)
+        self.assertEqual({(job.attackerUid, job.defenderUid) for job in jobs}, {("foo", "foo"), ("foo", "bar")})
+        self.assertEqual(self.db.claimBattleJobs(10), [])
+
+        # Sue's battleground changes while her battle is being calculated.
+        with self.db.getMutableUserContext("bar") as user:
+            user.battleground.towers.towers[0][1] = BgTowerState(0)
+        for job in jobs:
+            self.db.finishBattleJob(job, BattleJobState.DONE)
+
+        self.assertEqual(self.db.getBattleJobCounts(),
+            {"queued": 1, "running": 0, "done": 1, "failed": 0})
+
+    def test_runningBattleJobsResumed(self):
+        self.db.register(uid="foo", name="bob")
+        with self.db.getMutableUserContext("foo") as user:
+            user.wave = [0]
+        self.db.claimBattleJobs(10)
+
+        self.assertEqual(self.db.requeueRunningBattleJobs(), 1)
+        self.assertEqual(len(self.db.claimBattleJobs(10)), 1)
+
+    async def test_userUpdatesCoalesced(self):
+        self.db.register(uid="foo", name="bob")
+
+        with self.db.userQueues.queue_context("bob") as queue:
+            with self.db.makeConnection() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("UPDATE users SET gold = 5 WHERE uid = 'foo';")
+                conn.execute("UPDATE users SET gold = 7 WHERE uid = 'foo';")
+                # Nothing is sent before the transaction commits.
+                await asyncio.sleep(0)
+                self.assertTrue(queue.empty())
+            await asyncio.sleep(0)
+
+            self.assertEqual(queue.qsize(), 1)
+            self.assertEqual(queue.get_nowait().gold, 7)
+
+    async def test_rolledBackUpdatesNotSent(self):
+        self.db.register(uid="foo", name="bob")
+
+        with self.db.userQueues.queue_context("bob") as queue:
+            with self.assertRaises(ValueError):
+                with self.db.makeConnection() as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.execute("UPDATE users SET gold = 5 WHERE uid = 'foo';")
+                    raise ValueError("Abort the transaction")
+            await asyncio.sleep(0)
+
+            self.assertTrue(queue.empty())
+            self.assertEqual(self.db.getUserSummaryByName("bob").gold, 100)
+
 if __name__ == "__main__":
     unittest.main()
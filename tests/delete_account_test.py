@@ -18,8 +18,8 @@ class TestResetGameData(tornado.testing.AsyncHTTPTestCase):
         self.gameConfig = test_data.gameConfig
         self.game = Game(self.gameConfig, dbPath = self.dbPath)
 
-        self.game.register(uid="test_uid", name="bob")
-        self.game.register(uid="test_uid2", name="sam")
+        self.game._db.register(uid="test_uid", name="bob")
+        self.game._db.register(uid="test_uid2", name="sam")
 
         return tornado.web.Application([(r"/deleteAccount/(.*)", DeleteAccountHandler, dict(game=self.game))])
     
@@ -29,8 +29,8 @@ class TestResetGameData(tornado.testing.AsyncHTTPTestCase):
             mock_verify.return_value = "test_uid"
             mock_delete.return_value = None
             resp = self.fetch("/deleteAccount/bob", method="DELETE")
-        user = self.game.getUserSummaryByName("bob")
-        users = self.game.getUserSummaries()
+        user = self.game._db.getUserSummaryByName("bob")
+        users = self.game._db.getUsers()
 
         self.assertEqual(resp.code, 204)
         self.assertIsNone(user)
@@ -44,9 +44,9 @@ class TestResetGameData(tornado.testing.AsyncHTTPTestCase):
             mock_verify.return_value = "test_uid"
             mock_delete.return_value = None
             self.fetch("/deleteAccount/bob", method="DELETE")
-        self.game.register(uid="test_uid", name="bob")
+        self.game._db.register(uid="test_uid", name="bob")
 
-        user = self.game.getUserSummaryByName("bob")
+        user = self.game._db.getUserSummaryByName("bob")
         self.assertEqual(user.name, "bob")
         self.assertEqual(user.uid, "test_uid")
 
@@ -57,10 +57,10 @@ class TestResetGameData(tornado.testing.AsyncHTTPTestCase):
         
         self.assertEqual(resp.code, 403)
         # Make sure neither user was deleted.
-        bob = self.game.getUserSummaryByName("bob")
+        bob = self.game._db.getUserSummaryByName("bob")
         self.assertEqual(bob.name, "bob")
         self.assertEqual(bob.uid, "test_uid")
-        sam = self.game.getUserSummaryByName("sam")
+        sam = self.game._db.getUserSummaryByName("sam")
         self.assertEqual(sam.name, "sam")
         self.assertEqual(sam.uid, "test_uid2")
 
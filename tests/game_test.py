@@ -21,24 +21,38 @@ class TestGame(AsyncTestCase):
     def tearDown(self):
         os.remove(self.dbPath)
     
+    async def test_mutableUserContextConnection(self):
+        self.game._db.register(uid="bob_uid", name="bob")
+        pool = self.game._db.connectionPool
+        numIdle = len(pool._idle)
+
+        context = await self.game.getMutableUserContext(uid = "bob_uid", expectedName = "bob")
+        # Nothing is held until the context is entered, so dropping it leaks nothing.
+        self.assertEqual(len(pool._idle), numIdle)
+        async with context as user:
+            self.assertIsNotNone(user.conn)
+            user.gold = 5.0
+        self.assertEqual(len(pool._idle), numIdle)
+        self.assertEqual(self.game._db.getUserSummaryByName("bob").gold, 5.0)
+
     async def test_calculateMissingBattlesNothingToDo(self):
-        self.game.register(uid="bob_uid", name="bob")
+        self.game._db.register(uid="bob_uid", name="bob")
 
         # This should do nothing as there's only one user with no wave.
         await self.game.calculateMissingBattles()
 
     async def test_calculateMissingBattles(self):
-        self.game.register(uid="bob_uid", name="bob")
-        self.game.register(uid="sue_uid", name="sue")
-        self.game.register(uid="joe_uid", name="joe")
+        self.game._db.register(uid="bob_uid", name="bob")
+        self.game._db.register(uid="sue_uid", name="sue")
+        self.game._db.register(uid="joe_uid", name="joe")
         # Make all the waves non-empty.
-        with self.game.getMutableUserContext("bob_uid", "bob") as user:
+        with self.game._db.getMutableUserContext("bob_uid") as user:
             user.wave = [0]
-        with self.game.getMutableUserContext("sue_uid", "sue") as user:
+        with self.game._db.getMutableUserContext("sue_uid") as user:
             user.wave = [0]
-        with self.game.getMutableUserContext("joe_uid", "joe") as user:
+        with self.game._db.getMutableUserContext("joe_uid") as user:
             user.wave = [1]
-        with self.game.getMutableUserContext("joe_uid", "joe") as user:
+        with self.game._db.getMutableUserContext("joe_uid") as user:
             user.goldPerMinuteOthers = 9.0 # To check if joe is updated or not.
         # Add fake battles.
         self.game._db.addTestBattle("sue_uid", "bob_uid", goldPerMinute=1.0)
@@ -49,24 +63,70 @@ class TestGame(AsyncTestCase):
 
         await self.game.calculateMissingBattles()
 
-        bob = self.game.getUserSummaryByName("bob")
-        sue = self.game.getUserSummaryByName("sue")
-        joe = self.game.getUserSummaryByName("joe")
+        bob = self.game._db.getUserSummaryByName("bob")
+        sue = self.game._db.getUserSummaryByName("sue")
+        joe = self.game._db.getUserSummaryByName("joe")
 
         # Check the test battles still exist.
-        self.assertIsNotNone(self.game.getBattle(sue, bob))
-        self.assertIsNotNone(self.game.getBattle(bob, sue))
-        self.assertIsNotNone(self.game.getBattle(sue, sue))
-        self.assertIsNotNone(self.game.getBattle(joe, sue))
+        self.assertIsNotNone(self.game._db.getBattle(sue, bob))
+        self.assertIsNotNone(self.game._db.getBattle(bob, sue))
+        self.assertIsNotNone(self.game._db.getBattle(sue, sue))
+        self.assertIsNotNone(self.game._db.getBattle(joe, sue))
 
         # Check that new battles were created.
-        self.assertIsNotNone(self.game.getBattle(bob, bob))
-        self.assertIsNotNone(self.game.getBattle(sue, joe))
-        self.assertIsNotNone(self.game.getBattle(joe, joe))
+        self.assertIsNotNone(self.game._db.getBattle(bob, bob))
+        self.assertIsNotNone(self.game._db.getBattle(sue, joe))
+        self.assertIsNotNone(self.game._db.getBattle(joe, joe))
 
         # Check that goldPerSecondOthers was updated correctly.
         # Note these values are affected by the rival multiplier which is 0.5 here.
         self.assertEqual(bob.goldPerMinuteOthers, 0.5)
         self.assertEqual(sue.goldPerMinuteOthers, 2.5)
         # Joe receives this because the battle Sue vs. Joe will have a +1 participation bonus.
-        self.assertEqual(joe.goldPerMinuteOthers, 0.5)
\ No newline at end of file
+        self.assertEqual(joe.goldPerMinuteOthers, 0.5)
+
+    async def test_calculateMissingBattlesOutOfTime(self):
+        self.game._db.register(uid="bob_uid", name="bob")
+        self.game._db.register(uid="sue_uid", name="sue")
+        with self.game._db.getMutableUserContext("bob_uid") as user:
+            user.wave = [0]
+        with self.game._db.getMutableUserContext("sue_uid") as user:
+            user.wave = [1]
+        self.game.maxConcurrentBattleJobs = 1
+        self.game.battleJobsBudgetSecs = 0.0
+
+        await self.game.calculateMissingBattles()
+
+        # Nothing was started so everything is left queued for the next run.
+        self.assertEqual((await self.game.getBattleJobCounts())["queued"], 4)
+        self.assertEqual(len(self.game._db.findMissingBattles()), 4)
+
+        self.game.battleJobsBudgetSecs = 60.0
+        await self.game.processBattleJobs()
+
+        self.assertEqual((await self.game.getBattleJobCounts())["done"], 4)
+        self.assertEqual(self.game._db.findMissingBattles(), [])
+
+    async def test_slowBattleJobsLeftRunning(self):
+        self.game._db.register(uid="bob_uid", name="bob")
+        self.game._db.register(uid="sue_uid", name="sue")
+        with self.game._db.getMutableUserContext("bob_uid") as user:
+            user.wave = [0]
+        await self.game._db.run(self.game._db.enqueueBattleJobs, self.game._db.findMissingBattles())
+        finishBattle = asyncio.Event()
+        async def slowBattle(*args, **kwargs):
+            await finishBattle.wait()
+        self.game._db.getOrMakeBattle = slowBattle
+        self.game.maxConcurrentBattleJobs = 1
+        self.game.battleJobsBudgetSecs = 0.1
+
+        await asyncio.wait_for(self.game.processBattleJobs(), 1)
+
+        # The job stays claimed and keeps running after the call returns.
+        self.assertEqual((await self.game.getBattleJobCounts())["running"], 1)
+        # It still counts against the limit so nothing else is claimed.
+        await self.game.processBattleJobs()
+        self.assertEqual((await self.game.getBattleJobCounts())["running"], 1)
+        finishBattle.set()
+        await asyncio.sleep(0.1)
+        self.assertEqual((await self.game.getBattleJobCounts())["done"], 1)
@@ -0,0 +1,142 @@
+import random
+import unittest
+
+from infinitd_server.leaderboard import Leaderboard
+
+class TestLeaderboard(unittest.TestCase):
+    def test_orderedByScore(self):
+        leaderboard = Leaderboard()
+        leaderboard.set("bob", 5.0)
+        leaderboard.set("sue", 3.0)
+        leaderboard.set("joe", 7.0)
+        leaderboard.set("sue", 9.0)
+
+        self.assertEqual(list(leaderboard), ["sue", "joe", "bob"])
+        self.assertEqual(leaderboard.rank("bob"), 2)
+        self.assertEqual(leaderboard.score("sue"), 9.0)
+
+    def test_tiesBroken(self):
+        leaderboard = Leaderboard()
+        leaderboard.set("sue", 1.0, tieBreaker = 0)
+        leaderboard.set("bob", 1.0, tieBreaker = 1)
+        leaderboard.set("joe", 1.0, tieBreaker = 1)
+
+        self.assertEqual(list(leaderboard), ["sue", "bob", "joe"])
+
+    def test_aroundAndPage(self):
+        leaderboard = Leaderboard()
+        for i in range(10):
+            leaderboard.set(f"user{i}", float(i), value = i)
+
+        self.assertEqual(leaderboard.around("user5", 2), (["user7", "user6"], ["user4", "user3"]))
+        self.assertEqual(leaderboard.around("user9", 2), ([], ["user8", "user7"]))
+        self.assertEqual(leaderboard.around("user0", 2), (["user2", "user1"], []))
+        self.assertEqual(leaderboard.page(8, 5), ["user1", "user0"])
+        self.assertEqual(leaderboard.page(10, 5), [])
+        self.assertEqual(list(leaderboard.items(9)), [("user0", 0)])
+
+    def test_moves(self):
+        leaderboard = Leaderboard()
+        leaderboard.set("bob", 5.0)
+        leaderboard.set("sue", 3.0)
+        leaderboard.set("joe", 1.0)
+
+        self.assertFalse(leaderboard.moves("sue", 4.0))
+        self.assertTrue(leaderboard.moves("sue", 6.0))
+        leaderboard.set("sue", 4.0)
+        self.assertEqual(leaderboard.score("sue"), 4.0)
+        leaderboard.remove("sue")
+        self.assertEqual(leaderboard.insertionRank("sue", 6.0), 0)
+        self.assertEqual(leaderboard.insertionRank("sue", 2.0), 1)
+
+    def test_matchesSortedList(self):
+        rng = random.Random(1234)
+        leaderboard = Leaderboard()
+        scores = {}
+        for _ in range(2000):
+            name = f"user{rng.randrange(100)}"
+            if name in scores and rng.random() < 0.25:
+                leaderboard.remove(name)
+                del scores[name]
+            else:
+                scores[name] = float(rng.randrange(20))
+                leaderboard.set(name, scores[name])
+
+            expected = sorted(scores, key = lambda name: (-scores[name], name))
+            self.assertEqual(list(leaderboard), expected)
+            if expected:
+                name = rng.choice(expected)
+                self.assertEqual(leaderboard.rank(name), expected.index(name))
+
+    def test_advance(self):
+        leaderboard = Leaderboard()
+        leaderboard.set("bob", 10.0, rate = 1.0)
+        leaderboard.set("sue", 5.0, rate = 2.0)
+        leaderboard.set("joe", 7.0)
+
+        leaderboard.advance(2)
+        self.assertEqual(list(leaderboard), ["bob", "sue", "joe"])
+        self.assertEqual(leaderboard.score("sue"), 9.0)
+        before = leaderboard.advance(6, radius = 1)
+        self.assertEqual(list(leaderboard), ["sue", "bob", "joe"])
+        self.assertEqual(leaderboard.score("bob"), 16.0)
+        self.assertEqual(before, {
+            "bob": ([], ["sue"]),
+            "sue": (["bob"], ["joe"]),
+            "joe": (["sue"], []),
+        })
+        # A score given for an earlier time has accrued since then.
+        leaderboard.set("joe", 10.0, rate = 3.0, scoreTime = 3)
+        self.assertEqual(leaderboard.score("joe"), 19.0)
+        self.assertEqual(list(leaderboard), ["joe", "sue", "bob"])
+
+    def test_advanceOnlyTouchesCrossings(self):
+        leaderboard = Leaderboard()
+        for i in range(1000):
+            leaderboard.set(f"user{i}", float(i), rate = 5.0)
+        leaderboard.set("fast", -1.5, rate = 6.0)
+
+        self.assertEqual(leaderboard.advance(1, radius = 2), {})
+        before = leaderboard.advance(2, radius = 2)
+        self.assertEqual(leaderboard.rank("fast"), 999)
+        self.assertEqual(set(before), {"user2", "user1", "user0", "fast"})
+        self.assertEqual(before["user0"], (["user2", "user1"], ["fast"]))
+
+    def test_advanceMatchesSortedList(self):
+        rng = random.Random(1234)
+        leaderboard = Leaderboard()
+        radius = 2
+        # Name to (score at time 0, rate). Small integers keep the arithmetic exact.
+        users = {}
+        now = 0
+        def expected():
+            return sorted(users, key = lambda name: (-(users[name][0] + users[name][1] * now), name))
+        def around(order, name):
+            rank = order.index(name)
+            return (order[max(rank - radius, 0):rank], order[rank + 1:rank + 1 + radius])
+
+        for _ in range(1000):
+            choice = rng.random()
+            if choice < 0.3:
+                order = expected()
+                now += rng.randrange(1, 4)
+                before = leaderboard.advance(now, radius)
+                newOrder = expected()
+                self.assertEqual(list(leaderboard), newOrder)
+                for name in users:
+                    if around(order, name) != around(newOrder, name):
+                        self.assertEqual(before[name], around(order, name))
+            elif choice < 0.4 and users:
+                name = rng.choice(sorted(users))
+                leaderboard.remove(name)
+                del users[name]
+            else:
+                name = f"user{rng.randrange(50)}"
+                score = float(rng.randrange(100))
+                rate = float(rng.randrange(4))
+                users[name] = (score - rate * now, rate)
+                leaderboard.set(name, score, rate = rate)
+            self.assertEqual(list(leaderboard), expected())
+
+if __name__ == "__main__":
+    unittest.main()
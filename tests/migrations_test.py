@@ -0,0 +1,92 @@
+import unittest
+import tempfile
+import os
+import sqlite3
+
+from infinitd_server.db import Db
+from infinitd_server.battle_coordinator import BattleCoordinator
+from infinitd_server.logger import Logger, MockLogger
+from infinitd_server.sse import SseQueues
+from infinitd_server import migrations
+
+import test_data
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        Logger.setDefault(MockLogger())
+        _, tmp_path = tempfile.mkstemp()
+        self.dbPath = tmp_path
+
+    def tearDown(self):
+        os.remove(self.dbPath)
+
+    def makeDb(self) -> Db:
+        return Db(gameConfig = test_data.gameConfig, userQueues = SseQueues(), bgQueues = SseQueues(),
+                battleGpmQueues = SseQueues(), rivalsQueues = SseQueues(),
+                battleCoordinator = BattleCoordinator(SseQueues()), dbPath = self.dbPath)
+
+    def test_upgradesUnversionedDb(self):
+        # The schema from before migrations, including a duplicated battle.
+        with sqlite3.connect(self.dbPath) as conn:
+            conn.execute("""
+                CREATE TABLE users(
+                uid TEXT PRIMARY KEY,
+                name TEXT UNIQUE,
+                gold REAL,
+                accumulatedGold REAL,
+                goldPerMinuteSelf REAL,
+                goldPerMinuteOthers REAL,
+                inBattle BOOLEAN DEFAULT 0 CHECK (inBattle == 0 || inBattle == 1),
+                battleground TEXT,
+                wave TEXT DEFAULT '[]',
+                admin BOOLEAN DEFAULT 0 CHECK (admin == 0 || admin == 1)
+                );""")
+            conn.execute("""
+                CREATE TABLE battles(
+                attackerUid TEXT KEY,
+                defenderUid TEXT KEY,
+                events BLOB,
+                results BLOB,
+                goldPerMinute REAL
+                );""")
+            conn.execute("INSERT INTO users (uid, name, gold, accumulatedGold, goldPerMinuteSelf, "
+                "goldPerMinuteOthers, battleground) VALUES ('foo', 'bob', 7, 7, 1, 0, '{}');")
+            conn.executemany("INSERT INTO battles VALUES ('foo', 'foo', x'', x'', ?);", [(1.0,), (2.0,)])
+        conn.close()
+
+        db = self.makeDb()
+
+        with db.makeConnection() as conn:
+            self.assertEqual(migrations.schemaVersion(conn), len(migrations.MIGRATIONS))
+            self.assertEqual(conn.execute("SELECT goldPerMinute FROM battles;").fetchall(), [(2.0,)])
+            plan = conn.execute("EXPLAIN QUERY PLAN SELECT events FROM battles "
+                "WHERE attackerUid = 'foo' AND defenderUid = 'bar';").fetchall()
+            self.assertIn("sqlite_autoindex_battles_1", plan[0][3])
+            plan = conn.execute("EXPLAIN QUERY PLAN SELECT events FROM battles "
+                "WHERE defenderUid = 'bar';").fetchall()
+            self.assertIn("battlesByDefender", plan[0][3])
+        self.assertEqual(db.getUserSummaryByName("bob").gold, 7)
+        db.addTestBattle("foo", "foo", goldPerMinute = 3.0)
+        with db.makeConnection() as conn:
+            self.assertEqual(conn.execute("SELECT goldPerMinute FROM battles;").fetchall(), [(3.0,)])
+        db.close()
+
+    def test_migratesOnce(self):
+        self.makeDb().close()
+
+        db = self.makeDb()
+        with db.makeConnection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self.assertEqual(migrations.migrate(conn), 0)
+        db.close()
+
+    def test_rejectsNewerDb(self):
+        with sqlite3.connect(self.dbPath) as conn:
+            conn.execute(f"PRAGMA user_version = {len(migrations.MIGRATIONS) + 1};")
+        conn.close()
+
+        with self.assertRaises(ValueError):
+            self.makeDb()
+
+if __name__ == "__main__":
+    unittest.main()
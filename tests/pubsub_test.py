@@ -0,0 +1,207 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from aiounittest import AsyncTestCase
+
+from infinitd_server.battle import Battle, BattleResults, MoveEvent, ObjectType, FpCellPos, FpRow, FpCol
+from infinitd_server.battle_coordinator import BattleCoordinator, BattleMetadata, LiveBattleMetadata, BattleStatus
+from infinitd_server.db import Db
+from infinitd_server.game_config import ConfigId
+from infinitd_server.logger import Logger, MockLogger
+from infinitd_server.pubsub import UnixSocketPubSub, encodeFrame, SUBSCRIBE
+from infinitd_server.pubsub_broker import PubSubBroker
+from infinitd_server.rivals import Rivals
+from infinitd_server.sse import SseQueues
+
+import test_data
+
+def makeEvent(id: int, startTime: float) -> MoveEvent:
+    return MoveEvent(
+        objType = ObjectType.MONSTER,
+        id = id,
+        configId = ConfigId(0),
+        startPos = FpCellPos(FpRow(1), FpCol(0)),
+        destPos = FpCellPos(FpRow(0), FpCol(0)),
+        startTime = startTime,
+        endTime = startTime + 1.0)
+
+class TestPubSub(AsyncTestCase):
+    def setUp(self):
+        Logger.setDefault(MockLogger())
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.socketPath = os.path.join(self.tmpDir.name, "pubsub.sock")
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    async def startProcesses(self, numProcesses: int):
+        "Start a broker and a PubSub for each pretend server process."
+        server = await asyncio.start_unix_server(PubSubBroker().handleConnection, self.socketPath)
+        pubsubs = [UnixSocketPubSub(self.socketPath, retrySecs = 0.01) for _ in range(numProcesses)]
+        for pubsub in pubsubs:
+            pubsub.start()
+        return (server, pubsubs)
+
+    async def waitFor(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail("Condition never became true.")
+
+    async def stopProcesses(self, server, pubsubs):
+        for pubsub in pubsubs:
+            pubsub.close()
+        # Let the broker see the processes leave.
+        await asyncio.sleep(0.05)
+        server.close()
+        await server.wait_closed()
+
+    async def test_updatesReachOtherProcesses(self):
+        (server, pubsubs) = await self.startProcesses(2)
+        (queuesA, queuesB) = [SseQueues("rivals", pubsub) for pubsub in pubsubs]
+        rivals = Rivals(aheadNames = ["alice"], behindNames = [])
+
+        with queuesB.queue_context("bob") as queue:
+            # Only once A knows about B's listener will it send updates for bob.
+            await self.waitFor(lambda: "bob" in queuesA)
+            self.assertEqual(set(queuesA.keys()), {"bob"})
+            await queuesA.sendUpdate("carol", Rivals(aheadNames = [], behindNames = []))
+            await queuesA.sendUpdate("bob", rivals)
+
+            self.assertEqual(await asyncio.wait_for(queue.get(), 1), rivals)
+            self.assertTrue(queue.empty())
+        await self.stopProcesses(server, pubsubs)
+
+    async def test_slowListenerOnlyHoldsUpItsChannel(self):
+        (server, pubsubs) = await self.startProcesses(2)
+        unblock = asyncio.Event()
+        received = []
+        async def slowListener(key, message):
+            await unblock.wait()
+            received.append(("slow", message))
+        async def fastListener(key, message):
+            received.append(("fast", message))
+        pubsubs[1].listen("slow", slowListener)
+        pubsubs[1].listen("fast", fastListener)
+        pubsubs[1].subscribe("slow", "bob")
+        pubsubs[1].subscribe("fast", "bob")
+        await self.waitFor(lambda: "bob" in pubsubs[0].remoteKeys("slow") and "bob" in pubsubs[0].remoteKeys("fast"))
+
+        pubsubs[0].publish("slow", "bob", 1)
+        pubsubs[0].publish("slow", "bob", 2)
+        pubsubs[0].publish("fast", "bob", 3)
+        await self.waitFor(lambda: received == [("fast", 3)])
+        unblock.set()
+        await self.waitFor(lambda: received == [("fast", 3), ("slow", 1), ("slow", 2)])
+        await self.stopProcesses(server, pubsubs)
+
+    async def test_slowProcessDisconnected(self):
+        broker = PubSubBroker()
+        broker.MAX_BUFFERED_BYTES = 256 * 1024
+        server = await asyncio.start_unix_server(broker.handleConnection, self.socketPath)
+        pubsubs = [UnixSocketPubSub(self.socketPath, retrySecs = 0.01) for _ in range(2)]
+        for pubsub in pubsubs:
+            pubsub.start()
+        received = []
+        async def listener(key, message):
+            received.append(message)
+        pubsubs[1].listen("c", listener)
+        pubsubs[1].subscribe("c", "k")
+        # A process which subscribes but never reads.
+        (_, slowWriter) = await asyncio.open_unix_connection(self.socketPath)
+        slowWriter.write(encodeFrame(SUBSCRIBE, "c", "slow"))
+        await self.waitFor(lambda: {"k", "slow"} <= set(pubsubs[0].remoteKeys("c")))
+
+        message = b"x" * 10000
+        for i in range(200):
+            pubsubs[0].publish("c", "slow", message)
+            pubsubs[0].publish("c", "k", i)
+            await asyncio.sleep(0)
+        await self.waitFor(lambda: "slow" not in pubsubs[0].remoteKeys("c"))
+        self.assertEqual(broker.numSlowDisconnects, 1)
+        # Other processes aren't held up.
+        await self.waitFor(lambda: received == list(range(200)))
+
+        slowWriter.close()
+        await self.stopProcesses(server, pubsubs)
+
+    async def test_liveBattleMirrored(self):
+        (server, pubsubs) = await self.startProcesses(3)
+        (coordinatorA, coordinatorB, coordinatorC) = [
+            BattleCoordinator(SseQueues("battle", pubsub)) for pubsub in pubsubs]
+        await self.waitFor(lambda: all(pubsub.connected for pubsub in pubsubs))
+        battle = Battle(name = "bob vs bob", attackerName = "bob", defenderName = "bob",
+            events = [makeEvent(0, 0.0), makeEvent(1, 5.0)],
+            results = BattleResults(monstersDefeated = {}, bonuses = [], reward = 0.0, timeSecs = 6.0))
+        ended = asyncio.Event()
+        finished = []
+        async def onResults(results):
+            finished.append(results)
+        async def onEnd():
+            ended.set()
+
+        coordinatorA.startBattle("bob", battle, resultsCallback = onResults, endCallback = onEnd)
+        await self.waitFor(lambda: "bob" in pubsubs[1].remoteKeys(BattleCoordinator.SYNC_CHANNEL))
+        # Joining after the battle started fetches its state from where it's streamed.
+        with coordinatorB.battleQueues.queue_context("bob") as queue:
+            joined = await coordinatorB.join("bob")
+            self.assertEqual(joined[0], makeEvent(0, 0.0))
+            self.assertIsInstance(joined[1], LiveBattleMetadata)
+            self.assertEqual(joined[1].name, "bob vs bob")
+
+            # Stopping it from the other process stops the battle where it's streamed.
+            await coordinatorB.stopBattle("bob")
+            await asyncio.wait_for(ended.wait(), 2)
+            pending = BattleMetadata(
+                status = BattleStatus.PENDING, name = "bob vs bob", attackerName = "bob", defenderName = "bob")
+            self.assertEqual(await asyncio.wait_for(queue.get(), 1), pending)
+            self.assertEqual(finished, [])
+            self.assertEqual(await coordinatorB.join("bob"), [pending])
+        # Processes without subscribers never get the battle's updates.
+        self.assertNotIn("bob", coordinatorC.battles)
+        await self.stopProcesses(server, pubsubs)
+
+    async def test_goldClockTicksApplied(self):
+        (server, pubsubs) = await self.startProcesses(2)
+        dbPath = os.path.join(self.tmpDir.name, "data.db")
+        (dbA, dbB) = [Db(gameConfig = test_data.gameConfig, userQueues = SseQueues(), bgQueues = SseQueues(),
+                rivalsQueues = SseQueues(), battleGpmQueues = SseQueues(),
+                battleCoordinator = BattleCoordinator(SseQueues()), dbPath = dbPath, pubsub = pubsub)
+            for pubsub in pubsubs]
+        await self.waitFor(lambda: "goldClock" in pubsubs[0].remoteKeys(Db.LEADERBOARD_CHANNEL))
+        dbA.register(uid = "foo", name = "bob")
+        dbA.register(uid = "bar", name = "sue")
+        with dbA.getMutableUserContext("foo") as user:
+            user.accumulatedGold = 10
+            user.goldPerMinuteSelf = 0
+        with dbA.getMutableUserContext("bar") as user:
+            user.accumulatedGold = 9
+            user.goldPerMinuteSelf = 5
+        await self.waitFor(lambda: "sue" in dbB.leaderboard and dbB.leaderboard.score("sue") == 9)
+
+        # B applies A's tick without reloading.
+        leaderboard = dbB.leaderboard
+        await dbA.accumulateGold()
+        await self.waitFor(lambda: dbB.leaderboard.now == 1)
+        self.assertIs(dbB.leaderboard, leaderboard)
+        self.assertEqual(list(leaderboard), ["sue", "bob"])
+        self.assertEqual(leaderboard.score("sue"), 14)
+
+        # B reloads after missing ticks.
+        with dbA.makeConnection() as conn:
+            conn.execute("UPDATE goldClock SET tick = tick + 2;")
+            conn.commit()
+        await dbA.accumulateGold()
+        await self.waitFor(lambda: dbB.leaderboard.now == 4)
+        self.assertIsNot(dbB.leaderboard, leaderboard)
+        self.assertEqual(dbB.leaderboard.score("sue"), 29)
+
+        await self.stopProcesses(server, pubsubs)
+        dbA.close()
+        dbB.close()
+
+if __name__ == "__main__":
+    unittest.main()
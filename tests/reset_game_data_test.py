@@ -20,29 +20,29 @@ class TestResetGameData(tornado.testing.AsyncHTTPTestCase):
         self.gameConfig = test_data.gameConfig
         self.game = Game(self.gameConfig, dbPath = self.dbPath)
 
-        self.game.register(uid="test_uid", name="bob")
+        self.game._db.register(uid="test_uid", name="bob")
         self.initialBattleground = BattlegroundState.empty(self.gameConfig)
         self.initialBattleground.towers.towers[0][1] = BgTowerState(2)
         self.initialBattleground.towers.towers[1][2] = BgTowerState(1)
 
-        with self.game.getMutableUserContext("test_uid", "bob") as user:
+        with self.game._db.getMutableUserContext("test_uid") as user:
             # These must be set separately or they cause gold per minute to be reset.
             user.wave = [0, 1, 0]
             user.battleground = self.initialBattleground
-        with self.game.getMutableUserContext("test_uid", "bob") as user:
+        with self.game._db.getMutableUserContext("test_uid") as user:
             user.gold = 50
             user.accumulatedGold = 110
             user.goldPerMinuteSelf = 2.5
             user.goldPerMinuteOthers = 1.5
             user.inBattle = True # So we can calculate a battle
 
-        user = self.game.getUserSummaryByName("bob")
+        user = self.game._db.getUserSummaryByName("bob")
         def waitOnAwaitable(x):
             return asyncio.get_event_loop().run_until_complete(x)
         self.initialBattle = waitOnAwaitable(
             self.game.getOrMakeRecordedBattle("bob", "bob", "TestResetGameData", 0))
 
-        self.game.register(uid="admin_uid", name="joe", admin=True)
+        self.game._db.register(uid="admin_uid", name="joe", admin=True)
 
         return tornado.web.Application([(r"/admin/resetGame", ResetGameHandler, dict(game=self.game))])
     
@@ -50,9 +50,9 @@ class TestResetGameData(tornado.testing.AsyncHTTPTestCase):
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "admin_uid"
             resp = self.fetch("/admin/resetGame", method="POST", allow_nonstandard_methods=True)
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
-        battle = self.game.getBattle(user, user)
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
+        battle = self.game._db.getBattle(user, user)
 
         self.assertEqual(resp.code, 200)
         expectedBg = BattlegroundState.empty(self.gameConfig)
@@ -69,9 +69,9 @@ class TestResetGameData(tornado.testing.AsyncHTTPTestCase):
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/admin/resetGame", method="POST", allow_nonstandard_methods=True)
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
-        battle = self.game.getBattle(user, user)
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
+        battle = self.game._db.getBattle(user, user)
 
         self.assertEqual(resp.code, 403)
         self.assertEqual(battleground, self.initialBattleground)
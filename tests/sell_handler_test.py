@@ -22,12 +22,12 @@ class TestSellHandler(tornado.testing.AsyncHTTPTestCase):
         self.gameConfig = test_data.gameConfig
         self.game = Game(self.gameConfig, dbPath = self.dbPath)
 
-        self.game.register(uid="test_uid", name="bob")
+        self.game._db.register(uid="test_uid", name="bob")
         self.initialBattleground = BattlegroundState.empty(self.gameConfig)
         self.initialBattleground.towers.towers[0][1] = BgTowerState(2)
         self.initialBattleground.towers.towers[1][2] = BgTowerState(1)
         self.game.setBattleground("bob", self.initialBattleground)
-        battleground = self.game.getBattleground("bob")
+        battleground = self.game._db.getBattleground("bob")
 
         return tornado.web.Application([(r"/sell/(.*)", SellHandler, dict(game=self.game))])
 
@@ -39,8 +39,8 @@ class TestSellHandler(tornado.testing.AsyncHTTPTestCase):
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/sell/bob", method="POST", body='{"rows": [0], "cols": [1]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 200)
         expectedBg = BattlegroundState.empty(self.gameConfig)
@@ -54,8 +54,8 @@ class TestSellHandler(tornado.testing.AsyncHTTPTestCase):
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/sell/bob", method="POST", body='{"rows": [1, 0], "cols": [2, 1]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 200)
         expectedBg = BattlegroundState.empty(self.gameConfig)
@@ -68,8 +68,8 @@ class TestSellHandler(tornado.testing.AsyncHTTPTestCase):
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/sell/phil", method="POST", body='{"rows": [1], "cols": [1]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 403)
         self.assertEqual(battleground, self.initialBattleground)
@@ -81,8 +81,8 @@ class TestSellHandler(tornado.testing.AsyncHTTPTestCase):
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/sell/bob", method="POST", body='{"rows": [4], "cols": [2]}')
             resp2 = self.fetch("/sell/bob", method="POST", body='{"rows": [3], "cols": [3]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 400)
         self.assertEqual(resp2.code, 400)
@@ -95,8 +95,8 @@ class TestSellHandler(tornado.testing.AsyncHTTPTestCase):
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/sell/bob", method="POST", body='{"rows": [4], "cols": [2]}')
             resp2 = self.fetch("/sell/bob", method="POST", body='{"rows": [3], "cols": [3]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 400)
         self.assertEqual(resp2.code, 400)
@@ -109,8 +109,8 @@ class TestSellHandler(tornado.testing.AsyncHTTPTestCase):
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/sell/bob", method="POST", body='{"rows": [1], "cols": [1]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 400)
         self.assertEqual(battleground, self.initialBattleground)
@@ -121,8 +121,8 @@ class TestSellHandler(tornado.testing.AsyncHTTPTestCase):
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/sell/bob", method="POST", body='{"rows": [0, 3], "cols": [1, 3]}')
-        battleground = self.game.getBattleground("bob")
-        user = self.game.getUserSummaryByName("bob")
+        battleground = self.game._db.getBattleground("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 400)
         self.assertEqual(battleground, self.initialBattleground)
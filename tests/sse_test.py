@@ -0,0 +1,86 @@
+import json
+import unittest
+
+from aiounittest import AsyncTestCase
+
+from infinitd_server.rivals import Rivals
+from infinitd_server.sse import SseQueues, QueuePolicy, QueueOverflow
+
+class TestSseQueues(AsyncTestCase):
+    async def test_encodedOncePerUpdate(self):
+        queues = SseQueues()
+        numEncodings = 0
+        def encode(rivals: Rivals) -> str:
+            nonlocal numEncodings
+            numEncodings += 1
+            return json.dumps(rivals.aheadNames)
+
+        with queues.queue_context("bob", sharedEncoding = True) as first, \
+                queues.queue_context("bob", sharedEncoding = True) as second, \
+                queues.queue_context("bob") as plain:
+            await queues.sendUpdate("bob", Rivals(["sue"], []))
+            messages = [queue.get_nowait().encode("rivals/bob", encode) for queue in [first, second]]
+
+            self.assertEqual(plain.get_nowait(), Rivals(["sue"], []))
+        self.assertEqual(messages[0], b'rivals/bob:["sue"]')
+        self.assertIs(messages[0], messages[1])
+        self.assertEqual(numEncodings, 1)
+
+    async def test_unsubscribed(self):
+        queues = SseQueues()
+        with queues.queue_context("bob") as queue:
+            pass
+        await queues.sendUpdate("bob", Rivals([], []))
+
+        self.assertTrue(queue.empty())
+        # Params are dropped once their last subscriber leaves.
+        self.assertNotIn("bob", queues)
+        self.assertEqual(queues.getStats()["params"], 0)
+
+    async def test_stats(self):
+        queues = SseQueues()
+        with queues.queue_context("bob") as first, queues.queue_context("bob") as second, \
+                queues.queue_context("sue"):
+            await queues.sendUpdate("bob", Rivals(["sue"], []))
+            stats = queues.getStats()
+
+        self.assertEqual(stats["params"], 2)
+        self.assertEqual(stats["subscribers"], 3)
+        self.assertEqual(stats["queuedUpdates"], 2)
+        self.assertGreater(stats["approxBytes"], 0)
+
+    async def test_latestPolicy(self):
+        queues = SseQueues(policy = QueuePolicy.LATEST)
+        with queues.queue_context("bob") as queue:
+            for name in ["sue", "joe", "ann"]:
+                await queues.sendUpdate("bob", Rivals([name], []))
+
+            self.assertEqual(queue.qsize(), 1)
+            self.assertEqual(queue.get_nowait(), Rivals(["ann"], []))
+        self.assertEqual(queues.numCoalesced, 2)
+
+    async def test_resyncPolicy(self):
+        queues = SseQueues(policy = QueuePolicy.RESYNC, maxQueued = 2)
+        with queues.queue_context("bob") as queue:
+            for i in range(4):
+                await queues.sendUpdate("bob", i)
+            # Updates are dropped until the subscriber sees it must resync.
+            self.assertEqual(queue.get_nowait(), QueueOverflow.RESYNC)
+            self.assertTrue(queue.empty())
+            await queues.sendUpdate("bob", 4)
+            self.assertEqual(queue.get_nowait(), 4)
+
+        self.assertEqual((queues.numDropped, queues.numResyncs), (4, 1))
+
+    async def test_disconnectPolicy(self):
+        queues = SseQueues(maxQueued = 1)
+        with queues.queue_context("bob") as queue:
+            for i in range(3):
+                await queues.sendUpdate("bob", i)
+            self.assertEqual(queue.get_nowait(), QueueOverflow.DISCONNECT)
+            await queues.sendUpdate("bob", 3)
+            self.assertTrue(queue.empty())
+        self.assertEqual(queues.numDisconnects, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,12 +5,14 @@ import os
 import json
 
 import cattr
+import msgpack
 import tornado
 import tornado.testing
 
 from infinitd_server.game import Game
 from infinitd_server.logger import Logger, MockLogger
 from infinitd_server.handler.stream import StreamHandler
+from infinitd_server.stream_encoding import BINARY_SUBPROTOCOL, CHANNEL_ID, KIND, CHANNEL, MSGPACK
 import test_data
 
 class TestWebSockets(tornado.testing.AsyncHTTPTestCase):
@@ -21,8 +23,8 @@ class TestWebSockets(tornado.testing.AsyncHTTPTestCase):
         self.gameConfig = test_data.gameConfig
         self.game = Game(self.gameConfig, dbPath = self.dbPath)
 
-        self.game.register(uid="test_uid1", name="bob")
-        self.game.register(uid="test_uid2", name="sue")
+        self.game._db.register(uid="test_uid1", name="bob")
+        self.game._db.register(uid="test_uid2", name="sue")
 
         self.ws_url = "ws://localhost:" + str(self.get_http_port()) + "/stream"
         return tornado.web.Application([
@@ -40,18 +42,20 @@ class TestWebSockets(tornado.testing.AsyncHTTPTestCase):
         # Subscribe to update about bob
         ws_client.write_message("+user/bob")
         # Check we get the initial state
-        initialBob = self.game.getUserSummaryByName("bob")
+        initialBob = self.game._db.getUserSummaryByName("bob")
         response = yield ws_client.read_message()
         initialBobEncoded = json.dumps(cattr.unstructure(initialBob))
         self.assertEqual(response, f"user/bob:{initialBobEncoded}")
+        # Versions are only for the server.
+        self.assertNotIn("waveVersion", json.loads(initialBobEncoded))
 
         # Modify bob to trigger an update
-        with self.game.getMutableUserContext("test_uid1", "bob") as user:
+        with self.game._db.getMutableUserContext("test_uid1") as user:
             user.accumulatedGold = 5
         # Check for an update
         response = yield ws_client.read_message()
 
-        bob = self.game.getUserSummaryByName("bob")
+        bob = self.game._db.getUserSummaryByName("bob")
         bobEncoded = json.dumps(cattr.unstructure(bob))
         self.assertEqual(response, f"user/bob:{bobEncoded}")
 
@@ -63,7 +67,7 @@ class TestWebSockets(tornado.testing.AsyncHTTPTestCase):
         ws_client.write_message("+user/bob")
 
         # Check we get the initial state
-        initialBob = self.game.getUserSummaryByName("bob")
+        initialBob = self.game._db.getUserSummaryByName("bob")
         response = yield ws_client.read_message()
         initialBobEncoded = json.dumps(cattr.unstructure(initialBob))
         self.assertEqual(response, f"user/bob:{initialBobEncoded}")
@@ -72,17 +76,17 @@ class TestWebSockets(tornado.testing.AsyncHTTPTestCase):
         ws_client.write_message("+user/sue")
 
         # Check we get the initial state
-        initialSue = self.game.getUserSummaryByName("sue")
+        initialSue = self.game._db.getUserSummaryByName("sue")
         response = yield ws_client.read_message()
         initialSueEncoded = json.dumps(cattr.unstructure(initialSue))
         self.assertEqual(response, f"user/sue:{initialSueEncoded}")
 
         # Modify bob to trigger an update
-        with self.game.getMutableUserContext("test_uid1", "bob") as user:
+        with self.game._db.getMutableUserContext("test_uid1") as user:
             user.accumulatedGold = 5
         # Check for an update
         response = yield ws_client.read_message()
-        bob = self.game.getUserSummaryByName("bob")
+        bob = self.game._db.getUserSummaryByName("bob")
         bobEncoded = json.dumps(cattr.unstructure(bob))
         self.assertEqual(response, f"user/bob:{bobEncoded}")
 
@@ -92,15 +96,15 @@ class TestWebSockets(tornado.testing.AsyncHTTPTestCase):
         yield asyncio.sleep(0.01)
 
         # Modify sue. We shouldn't receive this update
-        with self.game.getMutableUserContext("test_uid2", "sue") as user:
+        with self.game._db.getMutableUserContext("test_uid2") as user:
             user.accumulatedGold = 7
 
         # Modify bob to trigger an another update
-        with self.game.getMutableUserContext("test_uid1", "bob") as user:
+        with self.game._db.getMutableUserContext("test_uid1") as user:
             user.accumulatedGold = 9
         # Check for an update
         response = yield ws_client.read_message()
-        bob = self.game.getUserSummaryByName("bob")
+        bob = self.game._db.getUserSummaryByName("bob")
         bobEncoded = json.dumps(cattr.unstructure(bob))
         self.assertEqual(response, f"user/bob:{bobEncoded}")
 
@@ -108,7 +112,7 @@ class TestWebSockets(tornado.testing.AsyncHTTPTestCase):
     def test_receiveBattleGpm(self):
         ws_client = yield tornado.websocket.websocket_connect(self.ws_url)
 
-        with self.game.getMutableUserContext("test_uid1", "bob") as user:
+        with self.game._db.getMutableUserContext("test_uid1") as user:
             user.wave = [0] 
 
         # Subscribe to updates about the battle where bob attacks sue.
@@ -126,8 +130,43 @@ class TestWebSockets(tornado.testing.AsyncHTTPTestCase):
         self.assertEqual(response, f"battleGpm/sue/bob:1.0")
 
         # Change bob to cause the battle to become invalid.
-        with self.game.getMutableUserContext("test_uid1", "bob") as user:
+        with self.game._db.getMutableUserContext("test_uid1") as user:
             user.wave = [0, 0] 
         response = yield ws_client.read_message()
         # Default value when battle doesn't exist.
-        self.assertEqual(response, f"battleGpm/sue/bob:-1.0")
\ No newline at end of file
+        self.assertEqual(response, f"battleGpm/sue/bob:-1.0")
+
+    def decodeBinary(self, message: bytes):
+        "Returns the channel ID, kind and body of a binary message."
+        (channelId,) = CHANNEL_ID.unpack_from(message)
+        (kind,) = KIND.unpack_from(message, CHANNEL_ID.size)
+        return (channelId, kind, message[CHANNEL_ID.size + KIND.size:])
+
+    @tornado.testing.gen_test
+    def test_receiveBinaryUpdates(self):
+        ws_client = yield tornado.websocket.websocket_connect(self.ws_url, subprotocols=[BINARY_SUBPROTOCOL])
+        self.assertEqual(ws_client.selected_subprotocol, BINARY_SUBPROTOCOL)
+
+        ws_client.write_message("+user/bob")
+        ws_client.write_message("+battle/sue")
+        # Each subscription gets a channel.
+        response = yield ws_client.read_message()
+        self.assertEqual(self.decodeBinary(response), (0, CHANNEL, b"user/bob"))
+        response = yield ws_client.read_message()
+        self.assertEqual(self.decodeBinary(response), (1, CHANNEL, b"battle/sue"))
+
+        responses = []
+        for _ in range(2):
+            response = yield ws_client.read_message()
+            responses.append(self.decodeBinary(response))
+        initialBob = self.game._db.getUserSummaryByName("bob")
+        self.assertIn((0, MSGPACK, msgpack.packb(cattr.unstructure(initialBob))), responses)
+        self.assertIn((1, MSGPACK, msgpack.packb({"status": 1, "name": "", "attackerName": "", "defenderName": ""})),
+            responses)
+
+        with self.game._db.getMutableUserContext("test_uid1") as user:
+            user.accumulatedGold = 5
+        response = yield ws_client.read_message()
+        (channelId, kind, body) = self.decodeBinary(response)
+        self.assertEqual((channelId, kind), (0, MSGPACK))
+        self.assertEqual(msgpack.unpackb(body)["accumulatedGold"], 5)
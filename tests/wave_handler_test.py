@@ -21,7 +21,7 @@ class TestWaveHandlerPost(tornado.testing.AsyncHTTPTestCase):
         self.gameConfig = test_data.gameConfig
         self.game = Game(self.gameConfig, dbPath=self.dbPath)
 
-        self.game.register(uid="test_uid", name="bob")
+        self.game._db.register(uid="test_uid", name="bob")
 
         return tornado.web.Application([(r"/wave/(.*)", WaveHandler, dict(game=self.game))])
 
@@ -50,7 +50,7 @@ class TestWaveHandlerPost(tornado.testing.AsyncHTTPTestCase):
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/wave/bob", method="POST", body='{"monsters": [10]}')
-        user = self.game.getUserSummaryByName("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 400)
         self.assertIsNotNone(user)
@@ -60,7 +60,7 @@ class TestWaveHandlerPost(tornado.testing.AsyncHTTPTestCase):
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/wave/bob", method="POST", body='{"monsters": [1, 0]}')
-        user = self.game.getUserSummaryByName("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 201)
         self.assertIsNotNone(user)
@@ -71,7 +71,7 @@ class TestWaveHandlerPost(tornado.testing.AsyncHTTPTestCase):
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/wave/bob", method="POST", body=f'{{"monsters": {enormousWave}}}')
-        user = self.game.getUserSummaryByName("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 400)
         self.assertIsNotNone(user)
@@ -80,12 +80,12 @@ class TestWaveHandlerPost(tornado.testing.AsyncHTTPTestCase):
     def test_userInBattle(self):
         def waitOnAwaitable(x):
             asyncio.get_event_loop().run_until_complete(x)
-        with self.game.getMutableUserContext("test_uid", "bob") as user:
+        with self.game._db.getMutableUserContext("test_uid") as user:
             user.inBattle = True
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/wave/bob", method="POST", body='{"monsters": [1, 0]}')
-        user = self.game.getUserSummaryByName("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 409)
         self.assertIsNotNone(user)
@@ -98,10 +98,10 @@ class TestWaveHandlerDelete(tornado.testing.AsyncHTTPTestCase):
         self.gameConfig = test_data.gameConfig
         self.game = Game(self.gameConfig, dbPath=self.dbPath)
 
-        self.game.register(uid="test_uid", name="bob")
+        self.game._db.register(uid="test_uid", name="bob")
         def waitOnAwaitable(x):
             asyncio.get_event_loop().run_until_complete(x)
-        with self.game.getMutableUserContext("test_uid", "bob") as user:
+        with self.game._db.getMutableUserContext("test_uid") as user:
             self.game.setWave(user, [1])
 
         return tornado.web.Application([(r"/wave/(.*)", WaveHandler, dict(game=self.game))])
@@ -121,7 +121,7 @@ class TestWaveHandlerDelete(tornado.testing.AsyncHTTPTestCase):
         with unittest.mock.patch('infinitd_server.handler.base.BaseHandler.verifyAuthentication') as mock_verify:
             mock_verify.return_value = "test_uid"
             resp = self.fetch("/wave/bob", method="DELETE")
-        user = self.game.getUserSummaryByName("bob")
+        user = self.game._db.getUserSummaryByName("bob")
 
         self.assertEqual(resp.code, 200)
         self.assertIsNotNone(user)
@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import cattr
+
+from infinitd_server.game_config import GameConfig, GameConfigData
+from infinitd_server.battle_coordinator import BattleCoordinator
+from infinitd_server.db import Db
+from infinitd_server.logger import Logger, MockLogger
+from infinitd_server.sse import SseQueues
+
+def makeDb(gameConfig: GameConfig, dbPath: str, maxIdleConnections: int) -> Db:
+    return Db(
+        gameConfig = gameConfig,
+        userQueues = SseQueues(),
+        bgQueues = SseQueues(),
+        rivalsQueues = SseQueues(),
+        battleGpmQueues = SseQueues(),
+        battleCoordinator = BattleCoordinator(SseQueues()),
+        dbPath = dbPath,
+        maxIdleConnections = maxIdleConnections)
+
+def timeRequests(db: Db, numUsers: int, numRequests: int) -> float:
+    "Simulates the reads of a typical request and returns the requests per second."
+    startTime = time.monotonic()
+    for i in range(numRequests):
+        userNum = i % numUsers
+        db.getUserSummaryByUid(f"uid{userNum}")
+        db.getUserSummaryByName(f"user{userNum}")
+        db.getBattleground(f"user{userNum}")
+    duration = time.monotonic() - startTime
+    return numRequests / duration
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Small script to time database reads with and without connection pooling.")
+    parser.add_argument('-u', '--users', action="store", type=int, default=100)
+    parser.add_argument('-r', '--requests', action="store", type=int, default=5000)
+    args = parser.parse_args()
+
+    Logger.setDefault(MockLogger())
+    gameConfigPath = Path('./game_config.json')
+    with open(gameConfigPath) as gameConfigFile:
+        gameConfigData = cattr.structure(json.loads(gameConfigFile.read()), GameConfigData)
+        gameConfig = GameConfig.fromGameConfigData(gameConfigData)
+
+    _, dbPath = tempfile.mkstemp()
+    try:
+        setupDb = makeDb(gameConfig, dbPath, maxIdleConnections = 1)
+        for i in range(args.users):
+            setupDb.register(uid=f"uid{i}", name=f"user{i}")
+        setupDb.close()
+
+        # A pool which keeps no idle connections opens a new one for every call.
+        unpooledDb = makeDb(gameConfig, dbPath, maxIdleConnections = 0)
+        unpooledRps = timeRequests(unpooledDb, args.users, args.requests)
+        print(f"New connection per call: {unpooledRps:.0f} requests/s")
+
+        pooledDb = makeDb(gameConfig, dbPath, maxIdleConnections = 8)
+        pooledRps = timeRequests(pooledDb, args.users, args.requests)
+        pooledDb.close()
+        print(f"Connection pool: {pooledRps:.0f} requests/s ({pooledRps / unpooledRps:.1f}x)")
+    finally:
+        os.remove(dbPath)
+
+if __name__ == "__main__":
+    main()
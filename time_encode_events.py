@@ -0,0 +1,56 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+import cattr
+
+from infinitd_server.game_config import GameConfig, GameConfigData
+from infinitd_server.battle import Battle
+from infinitd_server.battleground_state import BattlegroundState
+from infinitd_server.battle_computer import BattleComputer
+
+def timeEncoder(name: str, encode, iters: int) -> float:
+    startTime = time.monotonic()
+    for _ in range(iters):
+        encode()
+    duration = time.monotonic() - startTime
+    print(f"{name}: encoded {iters} times in {duration:.3f}s "
+        f"({duration / iters * 1000:.3f}ms each)")
+    return duration
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Small script to compare the speed of the battle event encoders.")
+    parser.add_argument('battleInputFile', metavar='file', type=str,
+            help="A JSON file containing a battleground and wave.")
+    parser.add_argument('-i', '--iters', action="store", type=int, default=10)
+    args = parser.parse_args()
+
+    gameConfigPath = Path('./game_config.json')
+    with open(gameConfigPath) as gameConfigFile:
+        gameConfigData = cattr.structure(json.loads(gameConfigFile.read()), GameConfigData)
+        gameConfig = GameConfig.fromGameConfigData(gameConfigData)
+
+    # Decode battle input from file
+    with open(args.battleInputFile) as battleInputFile:
+        battleInput = json.loads(battleInputFile.read())
+    battleground = BattlegroundState.from_dict(battleInput['battleground'])
+    wave = battleInput['wave']
+
+    battleComputer = BattleComputer(gameConfig, debug=False)
+    battleCalcResults = battleComputer.computeBattle(battleground, wave)
+    battle = Battle(
+        name = "benchmark",
+        attackerName = "attacker",
+        defenderName = "defender",
+        events = Battle.fbToEvents(battleCalcResults.fb.EventsNestedRoot()),
+        results = battleCalcResults.results)
+    print(f"Battle has {len(battle.events)} events.")
+
+    builderDuration = timeEncoder("Python builder", battle.encodeEventsFbWithBuilder, args.iters)
+    nativeDuration = timeEncoder("Native encoder", battle.encodeEventsFb, args.iters)
+    print(f"Native encoder is {builderDuration / nativeDuration:.1f}x faster.")
+
+if __name__ == "__main__":
+    main()
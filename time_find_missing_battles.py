@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import cattr
+
+from infinitd_server.game_config import GameConfig, GameConfigData
+from infinitd_server.battle_coordinator import BattleCoordinator
+from infinitd_server.db import Db
+from infinitd_server.logger import Logger, MockLogger
+from infinitd_server.sse import SseQueues
+
+# How findMissingBattles used to work, kept to compare against.
+SELF_JOIN_QUERY = """
+    WITH users_and_ranks AS (
+        SELECT
+            uid,
+            row_number() OVER (ORDER BY accumulatedGold DESC) as rank,
+            wave = "[]" as empty_wave
+        FROM
+            users
+        WHERE
+            inBattle = FALSE
+    )
+    SELECT
+        attackerUid, defenderUid
+    FROM
+        (SELECT
+            u1.uid as attackerUid,
+            u2.uid as defenderUid
+        FROM
+            users_and_ranks as u1, users_and_ranks as u2
+        WHERE
+            abs(u1.rank - u2.rank) <= :rivalRadius
+            AND u1.empty_wave = FALSE
+        ) LEFT JOIN
+        battles USING (attackerUid, defenderUid)
+    WHERE
+        events IS NULL
+;"""
+
+def makeDb(gameConfig: GameConfig, dbPath: str) -> Db:
+    return Db(
+        gameConfig = gameConfig,
+        userQueues = SseQueues(),
+        bgQueues = SseQueues(),
+        rivalsQueues = SseQueues(),
+        battleGpmQueues = SseQueues(),
+        battleCoordinator = BattleCoordinator(SseQueues()),
+        dbPath = dbPath)
+
+def populate(db: Db, numUsers: int, battleSize: int):
+    """Adds synthetic users and battles for half of their rivals.
+
+    Most users have a wave and a few are in a battle."""
+    rng = random.Random(numUsers)
+    with db.makeConnection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO users (uid, name, gold, accumulatedGold, goldPerMinuteSelf, "
+            "goldPerMinuteOthers, inBattle, battleground, wave) VALUES (?, ?, 0, ?, 1, 0, ?, '{}', ?);",
+            ((f"uid{i}", f"user{i}", rng.randrange(100 * numUsers), rng.random() < 0.05,
+                "[]" if rng.random() < 0.1 else "[0]") for i in range(numUsers)))
+    battle = bytes(battleSize)
+    with db.makeConnection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO battles (attackerUid, defenderUid, events, results, goldPerMinute) "
+            "VALUES (?, ?, ?, ?, 0);",
+            ((attackerUid, defenderUid, battle, battle)
+                for (i, (attackerUid, defenderUid)) in enumerate(db.findMissingBattles()) if i % 2 == 0))
+
+def timeCall(name: str, fn, iters: int):
+    startTime = time.monotonic()
+    for _ in range(iters):
+        numMissing = len(fn())
+    duration = time.monotonic() - startTime
+    print(f"  {name}: {numMissing} missing battles in {duration / iters * 1000:.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Small script to time finding missing battles with many users.")
+    parser.add_argument('-u', '--users', action="store", type=int, nargs="+",
+            default=[1000, 10000, 100000])
+    parser.add_argument('-i', '--iters', action="store", type=int, default=3)
+    parser.add_argument('--battle-size', action="store", type=int, default=2048,
+            help="Size in bytes of each synthetic battle's events and results.")
+    parser.add_argument('--max-self-join-users', action="store", type=int, default=10000,
+            help="Only time the old self-join query up to this many users since it's quadratic.")
+    args = parser.parse_args()
+
+    Logger.setDefault(MockLogger())
+    gameConfigPath = Path('./game_config.json')
+    with open(gameConfigPath) as gameConfigFile:
+        gameConfigData = cattr.structure(json.loads(gameConfigFile.read()), GameConfigData)
+        gameConfig = GameConfig.fromGameConfigData(gameConfigData)
+
+    for numUsers in args.users:
+        _, dbPath = tempfile.mkstemp()
+        try:
+            setupDb = makeDb(gameConfig, dbPath)
+            populate(setupDb, numUsers, args.battle_size)
+            setupDb.close()
+
+            # A new Db so the leaderboard is loaded the same way as on startup.
+            db = makeDb(gameConfig, dbPath)
+            print(f"{numUsers} users:")
+            timeCall("Rank bands", db.findMissingBattles, args.iters)
+            if numUsers <= args.max_self_join_users:
+                def selfJoin():
+                    with db.makeConnection() as conn:
+                        return conn.execute(SELF_JOIN_QUERY,
+                            { "rivalRadius": gameConfig.misc.rivalRadius }).fetchall()
+                timeCall("Self join", selfJoin, args.iters)
+            db.close()
+        finally:
+            os.remove(dbPath)
+
+if __name__ == "__main__":
+    main()
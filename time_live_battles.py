@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+from collections import deque
+import random
+import time
+from typing import List
+
+from infinitd_server.battle import Battle, BattleResults, MoveEvent, ObjectType, FpCellPos, FpRow, FpCol
+from infinitd_server.battle_coordinator import BattleScheduler, StreamingBattle
+from infinitd_server.game_config import ConfigId
+from infinitd_server.logger import Logger, MockLogger
+
+class QuietLogger(MockLogger):
+    "Printing every battle start would swamp the timings."
+    def _log(self, handler: str, requestId: int, msg: str, verbosity: int, uid = None):
+        pass
+
+class Stats:
+    numEvents: int = 0
+    maxLateness: float = 0.0
+
+def makeBattle(numEvents: int, durationSecs: float) -> Battle:
+    eventTimes = sorted(random.uniform(0.0, durationSecs) for _ in range(numEvents))
+    events = [MoveEvent(
+            objType = ObjectType.MONSTER,
+            id = i,
+            configId = ConfigId(0),
+            startPos = FpCellPos(FpRow(1), FpCol(0)),
+            destPos = FpCellPos(FpRow(0), FpCol(0)),
+            startTime = startTime,
+            endTime = startTime + 1.0)
+        for (i, startTime) in enumerate(eventTimes)]
+    return Battle(name = "benchmark", attackerName = "attacker", defenderName = "defender",
+        events = events, results = BattleResults(monstersDefeated = {}, bonuses = [], reward = 0.0,
+            timeSecs = durationSecs))
+
+def makeUpdateFn(battle: StreamingBattle, stats: Stats):
+    async def updateFn(update):
+        if isinstance(update, MoveEvent):
+            stats.numEvents += 1
+            if battle.startTime == -1.0:
+                return # Sent before the battle started.
+            stats.maxLateness = max(stats.maxLateness, time.time() - battle.startTime - update.startTime)
+    return updateFn
+
+async def streamWithOwnLoop(battle: StreamingBattle, events: List[MoveEvent]):
+    "How StreamingBattle used to send events: one coroutine, sleep and clock read per event."
+    battle.startTime = time.time()
+    futureEvents = deque(events)
+    while futureEvents:
+        timeToEvent = futureEvents[0].startTime - (time.time() - battle.startTime)
+        if timeToEvent > battle.BUFFER_TIME_SECS:
+            await asyncio.sleep(timeToEvent - battle.BUFFER_TIME_SECS + 0.0001)
+            continue
+        await battle.sendUpdate(futureEvents.popleft())
+
+async def runBattles(numBattles: int, battle: Battle, withScheduler: bool) -> Stats:
+    stats = Stats()
+    scheduler = BattleScheduler()
+    async def noResults(results):
+        pass
+    coroutines = []
+    for _ in range(numBattles):
+        streamingBattle = StreamingBattle(None, scheduler)
+        streamingBattle.updateFn = makeUpdateFn(streamingBattle, stats)
+        if withScheduler:
+            coroutines.append(streamingBattle.start(battle, noResults))
+        else:
+            coroutines.append(streamWithOwnLoop(streamingBattle, battle.events))
+    await asyncio.gather(*coroutines)
+    return stats
+
+def timeBattles(name: str, numBattles: int, battle: Battle, withScheduler: bool):
+    startCpu = time.process_time()
+    startTime = time.monotonic()
+    stats = asyncio.get_event_loop().run_until_complete(runBattles(numBattles, battle, withScheduler))
+    cpuSecs = time.process_time() - startCpu
+    duration = time.monotonic() - startTime
+    # Events are meant to be sent up to BUFFER_TIME_SECS early, never late.
+    keptUp = stats.maxLateness <= 0.0
+    print(f"{name}: {numBattles} battles sent {stats.numEvents} events in {duration:.2f}s "
+        f"using {cpuSecs / duration * 100:.0f}% CPU, at most {stats.maxLateness * 1000:.0f}ms late "
+        f"({'kept up' if keptUp else 'fell behind'})")
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Small script to find how many live battles one process can stream.")
+    parser.add_argument('-b', '--battles', action="store", type=str, default="100,1000,5000",
+            help="Comma separated numbers of concurrent battles to try.")
+    parser.add_argument('-e', '--events', action="store", type=int, default=200,
+            help="Events in each battle.")
+    parser.add_argument('-d', '--duration', action="store", type=float, default=5.0,
+            help="How long each battle lasts in seconds.")
+    args = parser.parse_args()
+
+    Logger.setDefault(QuietLogger())
+    battle = makeBattle(args.events, args.duration)
+    for numBattles in [int(num) for num in args.battles.split(",")]:
+        timeBattles("Loop per battle", numBattles, battle, withScheduler = False)
+        timeBattles("Timer wheel", numBattles, battle, withScheduler = True)
+
+if __name__ == "__main__":
+    main()